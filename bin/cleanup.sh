@@ -3,4 +3,4 @@
 # put this is cron.weekly or cron.daily
 
 # delete files older than 3 days
-find . -mtime +3 -name "*_20*.csv" -delete
+find . -mtime +3 -name "*_20*.csv*" -delete
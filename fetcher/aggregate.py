@@ -0,0 +1,130 @@
+'''
+Aggregation pushdown: let the server add up the rows, instead of downloading them.
+
+A query can declare the aggregation it needs, as field -> sum|count:
+    - url: .../FeatureServer/0/query
+      params: {where: facility_filter=1, outFields: '*', f: json}
+      type: arcgis
+      aggregate: {pos_susp_vent: sum}
+
+The query is rewritten into ArcGIS `outStatistics`, or a SODA `$select`, with the
+aggregated values named like the fields, so the mapping applies the same way. When the
+server can't do it (an error response), the original query is fetched, and the rows
+are aggregated locally into the same result shape.
+
+csv queries (static files) are always aggregated locally.
+'''
+
+from dataclasses import replace
+import json
+import logging
+import urllib.error
+
+
+AGGREGATE_FUNCTIONS = ['sum', 'count']
+AGGREGATE_QUERY_TYPES = ['arcgis', 'soda', 'csv']
+# arcgis params that don't apply to a statistics query
+ARCGIS_ROW_PARAMS = ['outFields', 'orderByFields', 'resultRecordCount', 'resultOffset', 'returnGeometry']
+# SODA params that select or page rows
+SODA_ROW_PARAMS = ['$select', '$order', '$limit', '$offset']
+
+
+def validate(query):
+    '''Raises ValueError if query's aggregate option is invalid'''
+    if query.type not in AGGREGATE_QUERY_TYPES:
+        raise ValueError("aggregate is not supported for {} queries ({})".format(query.type, query.url))
+    for field, func in query.aggregate.items():
+        if func not in AGGREGATE_FUNCTIONS:
+            raise ValueError("Unknown aggregate function {} for {} ({})".format(func, field, query.url))
+
+
+def pushdown(query):
+    '''The query rewritten to aggregate on the server, or None if it can't be'''
+    params = dict(query.params or {})
+    if query.type == 'arcgis':
+        if params.get('outStatistics') or params.get('groupByFieldsForStatistics'):
+            return None
+        params = {k: v for k, v in params.items() if k not in ARCGIS_ROW_PARAMS}
+        params['outStatistics'] = json.dumps([
+            {'statisticType': func, 'onStatisticField': field, 'outStatisticFieldName': field}
+            for field, func in query.aggregate.items()])
+    elif query.type == 'soda':
+        if '$query' in params or '$group' in params:
+            # a full SoQL query, don't try to rewrite it
+            return None
+        params = {k: v for k, v in params.items() if k not in SODA_ROW_PARAMS}
+        params['$select'] = ', '.join(
+            '{func}({field}) as {field}'.format(func=func, field=field)
+            for field, func in query.aggregate.items())
+    else:
+        return None
+    # the projection doesn't apply anymore
+    return replace(query, params=params, aggregate=None, full_params=None)
+
+
+def _number(value):
+    if isinstance(value, (int, float)):
+        return value
+    value = float(str(value).replace(',', ''))
+    return int(value) if value.is_integer() else value
+
+
+def aggregate_records(records, aggregate):
+    '''Aggregate a list of records (dicts) into a single record'''
+    aggregated = {}
+    for field, func in aggregate.items():
+        values = [r.get(field) for r in records if r.get(field) not in [None, '']]
+        aggregated[field] = len(values) if func == 'count' else sum(_number(v) for v in values)
+    return aggregated
+
+
+def aggregate_locally(query, res):
+    '''Aggregate the result of the original query, into the shape of an aggregated result'''
+    if query.type == 'arcgis':
+        records = [f.get('attributes', {}) for f in res.get('features', [])]
+        return dict(res, features=[{'attributes': aggregate_records(records, query.aggregate)}])
+    return [aggregate_records(res, query.aggregate)]
+
+
+def _pushed_result(query, res):
+    '''The result of the pushed down query, or None if the server failed to aggregate'''
+    if query.type == 'arcgis':
+        return res if isinstance(res, dict) and 'features' in res else None
+    if not isinstance(res, list):
+        return None
+    # SODA returns aggregated values as strings
+    return [{k: _number(v) if v is not None else v for k, v in r.items()} for r in res]
+
+
+def fetch_aggregated(query, fetch):
+    '''Fetch an aggregated query
+
+    fetch: the function fetching a query (without aggregate)
+    '''
+    pushed = pushdown(query)
+    if pushed:
+        try:
+            res = _pushed_result(query, fetch(pushed))
+            if res is not None:
+                return res
+        except urllib.error.HTTPError as e:
+            logging.debug("Failed to aggregate on the server: %s", e)
+        logging.info("Server can't aggregate %s, aggregating locally", query.url)
+    return aggregate_locally(query, fetch(replace(query, aggregate=None)))
+
+
+async def fetch_aggregated_async(query, fetch):
+    '''asyncio equivalent of fetch_aggregated, fetch is a coroutine function'''
+    # imported here to not force it as a dependency if not using this engine
+    import aiohttp
+
+    pushed = pushdown(query)
+    if pushed:
+        try:
+            res = _pushed_result(query, await fetch(pushed))
+            if res is not None:
+                return res
+        except (urllib.error.HTTPError, aiohttp.ClientResponseError) as e:
+            logging.debug("Failed to aggregate on the server: %s", e)
+        logging.info("Server can't aggregate %s, aggregating locally", query.url)
+    return aggregate_locally(query, await fetch(replace(query, aggregate=None)))
@@ -0,0 +1,231 @@
+'''
+asyncio fetch engine, an alternative to fetching with threads.
+
+A single event loop keeps all the requests in flight (bounded by `fetch.max_in_flight`
+and the per host limits), instead of a thread per request.
+Query types that are plain HTTP requests are fetched with aiohttp and parsed the same
+way the synchronous helpers in `fetcher.utils` parse them. Everything else (pandas,
+tableau, extras handlers) is blocking code, and runs on a thread pool.
+
+aiohttp is imported only when this engine is used, it's not needed otherwise.
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+import logging
+
+from bs4 import BeautifulSoup
+
+from fetcher import jsonlib
+from fetcher.aggregate import fetch_aggregated_async
+from fetcher.arcgis import fetch_arcgis_async
+from fetcher.client import Response, current_client
+from fetcher.projection import fetch_projected_async
+from fetcher.streaming import extract_body
+from fetcher.source_utils import NETWORK_QUERY_TYPES, _request_query, process_source_responses, release_shared
+from fetcher.utils import USER_AGENT, build_url, parse_csv
+
+
+JSON_QUERY_TYPES = ['arcgis', 'json', 'ckan', 'soda']
+# Query types handled by the event loop, the rest are sent to the thread pool
+ASYNC_QUERY_TYPES = JSON_QUERY_TYPES + ['csv', 'html', 'html:soup']
+
+
+async def request_async(session, url, query=None, encoding=None, method=None, verify=True, cache=None,
+                        archive=None, executor=None):
+    '''asyncio equivalent of fetcher.utils.request'''
+    if not encoding:
+        encoding = 'utf-8'
+    res = await request_bytes_async(session, url, query, method, verify, cache, archive, executor)
+    return res.decode(encoding)
+
+
+async def request_bytes_async(session, url, query=None, method=None, verify=True, cache=None, archive=None,
+                              executor=None):
+    '''asyncio equivalent of fetcher.utils.request_bytes
+
+    cache: an optional ResponseCache, used the same way the run client uses it
+    archive: an optional RunArchive, used the same way the run client uses it
+    executor: the pool the cache and the archive (disk I/O) run on, not to block the loop
+    '''
+    # imported here to not force it as a dependency if not using this engine
+    from yarl import URL
+
+    if not method:
+        method = 'GET'
+    url = build_url(url, query)
+    headers = {'user-agent': USER_AGENT}
+    loop = asyncio.get_running_loop()
+    if archive and archive.replaying:
+        return await loop.run_in_executor(executor, archive.replay, method, url)
+
+    entry = await loop.run_in_executor(executor, cache.lookup, method, url) if cache else None
+    if entry:
+        if cache.is_fresh(entry):
+            return entry.body
+        headers.update(cache.conditional_headers(entry))
+
+    # build the URL the same way as the synchronous request does, and don't let
+    # aiohttp re-encode it
+    async with session.request(method, URL(url, encoded=True), headers=headers,
+                               ssl=None if verify else False) as resp:
+        if resp.status == 304 and entry:
+            body = await loop.run_in_executor(executor, cache.revalidated, entry)
+        else:
+            resp.raise_for_status()
+            body = await resp.read()
+            if cache and resp.status == 200:
+                await loop.run_in_executor(executor, cache.store, method, url, resp.headers, body)
+    if archive:
+        await loop.run_in_executor(executor, archive.record, method, url, body)
+    return body
+
+
+async def fetch_query_async(session, state, query, scheduler=None, executor=None, mapping=None):
+    '''asyncio equivalent of fetcher.source_utils.fetch_query'''
+    def fetch(query):
+        return fetch_projected_async(
+            query, lambda q: _fetch_query_async(session, q, scheduler, executor, mapping))
+
+    try:
+        if query.aggregate:
+            return await fetch_aggregated_async(query, fetch)
+        return await fetch(query)
+    except Exception:
+        logging.error("{}: Failed to fetch {}".format(state, query.url), exc_info=True)
+        raise
+    finally:
+        release_shared(query)
+
+
+async def _fetch_query_async(session, query, scheduler=None, executor=None, mapping=None):
+    if query.type not in NETWORK_QUERY_TYPES:
+        return _request_query(query)
+    if query.type not in ASYNC_QUERY_TYPES:
+        # blocking libraries (pandas, tableau scraper): run them on the pool
+        loop = asyncio.get_running_loop()
+        if scheduler:
+            async with scheduler.async_slot(query.url):
+                return await loop.run_in_executor(executor, _request_query, query, mapping)
+        return await loop.run_in_executor(executor, _request_query, query, mapping)
+
+    async def request(query):
+        if scheduler:
+            async with scheduler.async_slot(query.url):
+                res = await _request_query_async(session, query, executor)
+        else:
+            res = await _request_query_async(session, query, executor)
+        return await _parse_response(query, res, executor, mapping)
+
+    if query.type == 'arcgis':
+        return await fetch_arcgis_async(query, lambda params: request(replace(query, params=params)))
+    return await request(query)
+
+
+async def _request_query_async(session, query, executor=None):
+    # Same certificate verification policy as the synchronous helpers
+    client = current_client()
+    if query.type in JSON_QUERY_TYPES:
+        method = query.method
+        verify = client.verify_for(query.url) if client else False
+    else:
+        method = None
+        verify = client.verify_for(query.url) if client else True
+
+    url = build_url(query.url, query.params)
+
+    async def fetch():
+        body = await request_bytes_async(
+            session, url, method=method, verify=verify, cache=client.cache if client else None,
+            archive=client.archive if client else None, executor=executor)
+        return Response(url, 200, {}, body)
+
+    shared = client.shared if client else None
+    # requests of several queries are made once, even when they're in flight at the same time
+    res = await shared.get_async(method, url, fetch) if shared else await fetch()
+    return res.body
+
+
+async def _parse_response(query, body, executor, mapping=None):
+    loop = asyncio.get_running_loop()
+    if query.type in JSON_QUERY_TYPES:
+        if query.stream:
+            # the body was read already, but it still saves building the whole tree
+            return await loop.run_in_executor(executor, extract_body, query, body, mapping)
+        # large bodies take a while to decode
+        return await loop.run_in_executor(executor, jsonlib.loads, body)
+
+    res = body.decode(query.encoding or 'utf-8')
+    if query.type == 'csv':
+        return parse_csv(res, header=query.header)
+    if query.type == 'html:soup':
+        return await loop.run_in_executor(executor, BeautifulSoup, res, 'html.parser')
+    return res
+
+
+async def fetch_source_async(session, source, scheduler=None, executor=None):
+    '''Fetch all the queries of a source concurrently, returning the results in query order
+
+    The first failure fails the source, and cancels its queries that are still running
+    '''
+    tasks = [
+        asyncio.ensure_future(fetch_query_async(session, source.name, query, scheduler, executor, source.mapping))
+        for query in source.fetch_queries]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # let them release their host slots
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return source.split_results(results)
+
+
+def fetch_states(fetcher, states, on_done=None):
+    '''Fetch and process states with the asyncio engine
+
+    Returns a list of (ok, fetched_result, parsed_data) tuples, in the order of `states`
+    (same as Fetcher._try_fetch_state)
+    on_done: called with (state, outcome) as soon as a state is fetched and processed,
+        in a single output thread (it blocks, e.g. writing the state, and isn't run
+        concurrently)
+    '''
+    return asyncio.run(_fetch_states(fetcher, states, on_done))
+
+
+async def _fetch_states(fetcher, states, on_done=None):
+    # imported here to not force it as a dependency if not using this engine
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(limit=fetcher.max_in_flight)
+    with ThreadPoolExecutor(max_workers=fetcher.workers, thread_name_prefix='fetch') as executor, \
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix='output') as output:
+        # proxies from the environment, the same as the run client
+        async with aiohttp.ClientSession(connector=connector, trust_env=True) as session:
+            async def fetch_state(state):
+                outcome = await _fetch_state(fetcher, session, executor, state)
+                if on_done:
+                    # off the loop, not to stall the requests in flight
+                    await asyncio.get_running_loop().run_in_executor(output, on_done, state, outcome)
+                return outcome
+
+            return await asyncio.gather(*[fetch_state(state) for state in states])
+
+
+async def _fetch_state(fetcher, session, executor, state):
+    logging.debug("Fetching: %s", state)
+    source = fetcher.sources.get(state)
+    if not source or not source.queries:
+        return True, None, {}
+
+    try:
+        results = await fetch_source_async(session, source, fetcher.scheduler, executor)
+        # Parsing is blocking (and sometimes makes more requests in extras handlers)
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(executor, process_source_responses, source, results)
+        return True, results, data
+    except Exception:
+        logging.error("Failed to fetch %s", state, exc_info=True)
+        return False, None, None
@@ -0,0 +1,170 @@
+'''
+ArcGIS feature layer queries, with pagination.
+
+A layer query returns at most the server's max record count (often 1000 or 2000)
+features, and sets `exceededTransferLimit` when there are more. When that happens,
+the number of matching features is queried (`returnCountOnly`), and the rest of the
+pages (`resultOffset`/`resultRecordCount`, sized like the first page) are fetched
+concurrently and merged into the `features` of the first page, so the result looks
+like a single response to `extract_arcgis_attributes`.
+
+An explicit `resultRecordCount` in the query params is the max number of features
+the query wants (e.g. 1, for the latest record), pages are fetched up to it.
+
+Offsets are only consistent between requests in a stable order, so a query without
+`orderByFields` is paged ordered by the layer's object id field (`objectIdFieldName`
+of the first page, OBJECTID if it's missing), and its first page is fetched again
+with the others, in that order.
+
+Layers that don't support pagination ignore `resultOffset`, and answer every page
+with the first one: a feature id that repeats across the pages fails the query,
+rather than returning (and summing up) the same features again.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
+from fetcher.streaming import request_and_extract
+from fetcher.utils import request_and_parse
+
+
+# Queries that don't return features (or can't be paged)
+NO_PAGES_PARAMS = ['outStatistics', 'returnCountOnly', 'returnIdsOnly', 'returnExtentOnly']
+# Pages fetched concurrently, when the host has no concurrency limit
+PAGE_WORKERS = 4
+
+
+def _has_more(params, first):
+    if not first.get('exceededTransferLimit') or not first.get('features'):
+        return False
+    if any(params.get(p) for p in NO_PAGES_PARAMS):
+        return False
+    limit = params.get('resultRecordCount')
+    return not limit or len(first['features']) < int(limit)
+
+
+def count_params(params):
+    params = {k: v for k, v in params.items()
+              if k not in ['outFields', 'orderByFields', 'resultOffset', 'resultRecordCount']}
+    params['returnCountOnly'] = 'true'
+    return params
+
+
+def page_params(params, first, count):
+    '''The params of the pages after the first one'''
+    page_size = len(first['features'])
+    start = int(params.get('resultOffset') or 0)
+    end = count
+    if params.get('resultRecordCount'):
+        end = min(end, start + int(params['resultRecordCount']))
+    return [
+        {**params, 'resultOffset': offset, 'resultRecordCount': min(page_size, end - offset)}
+        for offset in range(start + page_size, end, page_size)]
+
+
+def order_params(params, first):
+    '''params, ordered by the object ids of the layer if they have no order'''
+    if params.get('orderByFields'):
+        return params
+    return {**params, 'orderByFields': first.get('objectIdFieldName') or 'OBJECTID'}
+
+
+def _pages(params, first, count):
+    '''The params of the pages to fetch, and whether the first of them is the first page
+    again (in the order of the others)'''
+    ordered = order_params(params, first)
+    pages = page_params(ordered, first, count)
+    if pages and ordered is not params:
+        return [ordered] + pages, True
+    return pages, False
+
+
+def merge_pages(first, pages):
+    if 'features' not in first:
+        raise ValueError("Failed to fetch page: {}".format(first.get('error', first)))
+    features = list(first['features'])
+    for page in pages:
+        if 'features' not in page:
+            raise ValueError("Failed to fetch page: {}".format(page.get('error', page)))
+        if page['features'] and page['features'] == first['features']:
+            raise ValueError("Pages repeat the first one, the layer doesn't support pagination")
+        features.extend(page['features'])
+    _check_ids(features, first.get('objectIdFieldName') or 'OBJECTID')
+    merged = dict(first, features=features)
+    merged.pop('exceededTransferLimit', None)
+    return merged
+
+
+def _check_ids(features, id_field):
+    '''Raises ValueError if a feature id repeats (pages that overlap)'''
+    seen = set()
+    for f in features:
+        fid = f.get('attributes', {}).get(id_field)
+        if fid is None:
+            continue
+        if fid in seen:
+            raise ValueError("Feature {}={} is in several pages, the layer doesn't page by resultOffset".format(
+                id_field, fid))
+        seen.add(fid)
+
+
+def _count(res):
+    if 'count' not in res:
+        raise ValueError("Failed to count features: {}".format(res.get('error', res)))
+    return res['count']
+
+
+def _page_workers(scheduler, url, pages):
+    limit = scheduler.limit_for(scheduler.host_of(url)).concurrency if scheduler else None
+    return min(pages, limit or PAGE_WORKERS)
+
+
+def fetch_arcgis(query, scheduler=None, mapping=None):
+    '''Fetch an arcgis query, with all of its pages
+
+    scheduler: an optional HostScheduler, each page waits for its own slot
+    mapping: the source mapping, for streamed queries (see fetcher.streaming)
+    '''
+    params = dict(query.params or {})
+
+    def request(page):
+        if query.stream:
+            return request_and_extract(query, page, mapping)
+        return request_and_parse(query.url, page, query.method)
+
+    def request_json(page):
+        if scheduler:
+            with scheduler.slot(query.url):
+                return request(page)
+        return request(page)
+
+    first = request_json(params)
+    if not _has_more(params, first):
+        return first
+
+    pages, refetched = _pages(params, first, _count(request_json(count_params(params))))
+    if not pages:
+        return merge_pages(first, [])
+    with ThreadPoolExecutor(max_workers=_page_workers(scheduler, query.url, len(pages)),
+                            thread_name_prefix='arcgis') as executor:
+        pages = list(executor.map(request_json, pages))
+    if refetched:
+        first, pages = pages[0], pages[1:]
+    return merge_pages(first, pages)
+
+
+async def fetch_arcgis_async(query, request_json):
+    '''asyncio equivalent of fetch_arcgis
+
+    request_json: a coroutine function, requesting the query with the given params
+    '''
+    params = dict(query.params or {})
+    first = await request_json(params)
+    if not _has_more(params, first):
+        return first
+
+    pages, refetched = _pages(params, first, _count(await request_json(count_params(params))))
+    pages = await asyncio.gather(*[request_json(page) for page in pages])
+    if refetched:
+        first, pages = pages[0], pages[1:]
+    return merge_pages(first, pages)
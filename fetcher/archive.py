@@ -0,0 +1,115 @@
+'''
+Run archive: record the raw responses of a run, and replay them later.
+
+fetch.mode=record saves every response body the run client gets into the archive
+directory, and fetch.mode=replay serves them back from it without any network access.
+Parsing, extras handlers and building the dataframe run the same way they do live, so
+a replayed run can be used to rerun a parse, or to get repeatable timings of the CPU
+side of a run.
+
+Tableau results don't go through the run client (the scraper has its own requests),
+so they are pickled as the parsed objects.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+
+
+LIVE = 'live'
+RECORD = 'record'
+REPLAY = 'replay'
+
+
+class NotArchivedError(LookupError):
+    '''Replaying a request that wasn't recorded'''
+
+
+class RunArchive:
+    def __init__(self, directory, mode=RECORD):
+        if mode not in [RECORD, REPLAY]:
+            raise ValueError("Unknown archive mode: {}".format(mode))
+        self.directory = directory
+        self.mode = mode
+        self.stats = {'recorded': 0, 'replayed': 0}
+        self._lock = threading.Lock()
+        if mode == RECORD:
+            os.makedirs(directory, exist_ok=True)
+        elif not os.path.isdir(directory):
+            raise ValueError("No archive to replay at {}".format(directory))
+
+    @classmethod
+    def from_config(cls, fetch_cfg):
+        '''Returns an archive for record/replay modes, or None for live runs'''
+        mode = fetch_cfg.get('mode') or LIVE
+        if mode == LIVE:
+            return None
+        return cls(fetch_cfg.get('archive'), mode)
+
+    @property
+    def replaying(self):
+        return self.mode == REPLAY
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(" ".join(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def record(self, method, url, body):
+        '''Save a response body'''
+        key = self.key(method.upper(), url)
+        self._write(self._path(key, '.body'), body)
+        meta = {'method': method.upper(), 'url': url, 'size': len(body)}
+        self._write(self._path(key, '.json'), json.dumps(meta).encode('utf-8'))
+        self._count('recorded')
+
+    def replay(self, method, url):
+        '''Returns a recorded response body'''
+        path = self._path(self.key(method.upper(), url), '.body')
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            raise NotArchivedError("{} {} is not in the archive".format(method.upper(), url))
+        self._count('replayed')
+        return body
+
+    def record_object(self, kind, url, params, obj):
+        '''Save a parsed result, for sources that aren't fetched with the run client'''
+        key = self.key(kind, url, json.dumps(params, sort_keys=True, default=str))
+        self._write(self._path(key, '.pickle'), pickle.dumps(obj))
+        self._count('recorded')
+
+    def replay_object(self, kind, url, params):
+        key = self.key(kind, url, json.dumps(params, sort_keys=True, default=str))
+        try:
+            with open(self._path(key, '.pickle'), 'rb') as f:
+                obj = pickle.load(f)
+        except FileNotFoundError:
+            raise NotArchivedError("{} {} is not in the archive".format(kind, url))
+        self._count('replayed')
+        return obj
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _write(self, path, content):
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def report(self):
+        logging.info("Archive (%s) %s: %d recorded, %d replayed",
+                     self.mode, self.directory, self.stats['recorded'], self.stats['replayed'])
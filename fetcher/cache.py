@@ -0,0 +1,197 @@
+'''
+On disk HTTP response cache.
+
+Many sources (especially the big pandas/xlsx/zip downloads) change once a day, but
+we fetch them on every run. The cache stores response bodies on disk, keyed by method
+and URL (the URL includes the query params), and revalidates them with conditional
+requests (If-None-Match / If-Modified-Since). On a `304 Not Modified` the cached body
+is used.
+
+ttl: seconds in which a cached response is used without revalidating it (0 means
+    always revalidate). Can be set per URL pattern (fnmatch style) with `ttls`
+max_size: max total size of the cached bodies (in MB), least recently used entries
+    are evicted first
+
+Responses without validators (ETag/Last-Modified) are only stored when their ttl > 0,
+since they can't be revalidated.
+'''
+
+from collections import namedtuple
+from fnmatch import fnmatch
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+CacheEntry = namedtuple('CacheEntry', ['key', 'meta', 'body'])
+
+META_SUFFIX = '.json'
+BODY_SUFFIX = '.body'
+MB = 1024 * 1024
+
+
+class ResponseCache:
+    def __init__(self, directory, ttl=0, ttls=None, max_size=None):
+        self.directory = directory
+        self.ttl = ttl or 0
+        self.ttls = dict(ttls or {})
+        self.max_size = max_size * MB if max_size else None
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = self._scan()
+
+    @classmethod
+    def from_config(cls, cache_cfg):
+        '''Returns a cache, or None when it's not configured'''
+        if not cache_cfg or not cache_cfg.get('dir'):
+            return None
+        return cls(cache_cfg.get('dir'), cache_cfg.get('ttl'), cache_cfg.get('ttls'),
+                   cache_cfg.get('max_size'))
+
+    @staticmethod
+    def key(method, url):
+        return hashlib.sha256("{} {}".format(method.upper(), url).encode('utf-8')).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def _scan(self):
+        sizes = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(BODY_SUFFIX):
+                    path = os.path.join(root, name)
+                    sizes[name[:-len(BODY_SUFFIX)]] = (os.path.getsize(path), os.path.getmtime(path))
+        return sizes
+
+    def ttl_for(self, url):
+        for pattern, ttl in self.ttls.items():
+            if fnmatch(url, pattern):
+                return ttl or 0
+        return self.ttl
+
+    def lookup(self, method, url):
+        '''Returns the cached entry for the request, or None'''
+        key = self.key(method, url)
+        try:
+            with open(self._path(key, META_SUFFIX), 'r') as f:
+                meta = json.load(f)
+            with open(self._path(key, BODY_SUFFIX), 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            with self._lock:
+                self.stats['misses'] += 1
+            return None
+
+        self._touch(key)
+        return CacheEntry(key, meta, body)
+
+    def is_fresh(self, entry):
+        ttl = self.ttl_for(entry.meta['url'])
+        fresh = ttl > 0 and time.time() - entry.meta['stored_at'] < ttl
+        if fresh:
+            with self._lock:
+                self.stats['hits'] += 1
+        return fresh
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry.meta.get('etag'):
+            headers['If-None-Match'] = entry.meta['etag']
+        if entry.meta.get('last_modified'):
+            headers['If-Modified-Since'] = entry.meta['last_modified']
+        return headers
+
+    def revalidated(self, entry):
+        '''The server says the entry is still valid (304): restart its ttl'''
+        meta = dict(entry.meta, stored_at=time.time())
+        self._write(self._path(entry.key, META_SUFFIX), json.dumps(meta).encode('utf-8'))
+        with self._lock:
+            self.stats['revalidated'] += 1
+        return entry.body
+
+    def store(self, method, url, headers, body):
+        etag = headers.get('etag')
+        last_modified = headers.get('last-modified')
+        if not etag and not last_modified and self.ttl_for(url) <= 0:
+            # nothing to revalidate with, and it can't be used without revalidating
+            return
+
+        key = self.key(method, url)
+        meta = {
+            'url': url,
+            'method': method.upper(),
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored_at': time.time(),
+            'size': len(body),
+        }
+        os.makedirs(os.path.join(self.directory, key[:2]), exist_ok=True)
+        self._write(self._path(key, BODY_SUFFIX), body)
+        self._write(self._path(key, META_SUFFIX), json.dumps(meta).encode('utf-8'))
+
+        with self._lock:
+            self.stats['stored'] += 1
+            self._sizes[key] = (len(body), time.time())
+        self._evict()
+
+    def _write(self, path, content):
+        # write to a temp file and rename, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def _touch(self, key):
+        now = time.time()
+        try:
+            os.utime(self._path(key, BODY_SUFFIX), (now, now))
+        except OSError:
+            return
+        with self._lock:
+            if key in self._sizes:
+                self._sizes[key] = (self._sizes[key][0], now)
+
+    def size(self):
+        with self._lock:
+            return sum(size for size, _ in self._sizes.values())
+
+    def _evict(self):
+        if not self.max_size:
+            return
+        with self._lock:
+            total = sum(size for size, _ in self._sizes.values())
+            if total <= self.max_size:
+                return
+            # least recently used first
+            victims = []
+            for key, (size, _) in sorted(self._sizes.items(), key=lambda x: x[1][1]):
+                if total <= self.max_size:
+                    break
+                victims.append(key)
+                total -= size
+                del self._sizes[key]
+            self.stats['evicted'] += len(victims)
+
+        for key in victims:
+            for suffix in [META_SUFFIX, BODY_SUFFIX]:
+                try:
+                    os.unlink(self._path(key, suffix))
+                except OSError:
+                    pass
+
+    def report(self):
+        logging.info("Cache: %(hits)d hits, %(revalidated)d revalidated, %(misses)d misses, "
+                     "%(stored)d stored, %(evicted)d evicted", self.stats)
+        logging.info("Cache size: %.1f MB", self.size() / MB)
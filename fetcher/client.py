@@ -0,0 +1,392 @@
+'''
+Run-scoped HTTP client.
+
+Dozens of queries in a row go to the same few hosts, and most responses are small,
+so setting up a new TCP + TLS connection for each request is a big part of the
+latency. HttpClient keeps idle keep-alive connections per host and reuses them, and
+when a new connection is needed, it resumes the last TLS session of that host.
+
+Certificate verification is a per host policy (`insecure_hosts` patterns), instead of
+replacing the default SSL context of the whole process.
+
+Proxies are taken from the environment (HTTP_PROXY, HTTPS_PROXY and NO_PROXY), the same
+way urllib takes them: plain HTTP requests are sent to the proxy, HTTPS ones are
+tunneled through it (CONNECT).
+
+The client is installed for the duration of a run (see `use_client`); the request
+helpers in `fetcher.utils` use it when it's installed, and plain urllib otherwise.
+'''
+
+import base64
+from collections import namedtuple
+from contextlib import contextmanager
+from fnmatch import fnmatch
+import http.client
+from io import BytesIO
+import logging
+import ssl
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from fetcher.archive import RunArchive
+from fetcher.cache import ResponseCache
+
+Response = namedtuple('Response', ['url', 'status', 'headers', 'body'])
+
+REDIRECT_CODES = [301, 302, 303, 307, 308]
+MAX_REDIRECTS = 10
+# requests that are sent again on a new connection when a kept-alive one turns out closed
+RETRY_METHODS = ['GET', 'HEAD']
+
+_current = None
+
+
+def current_client():
+    '''The installed client, or None'''
+    return _current
+
+
+@contextmanager
+def use_client(client):
+    '''Install `client` for the helpers in fetcher.utils, for the duration of the block'''
+    global _current
+    previous = _current
+    _current = client
+    try:
+        yield client
+    finally:
+        _current = previous
+
+
+class _HTTPSConnection(http.client.HTTPSConnection):
+    '''HTTPS connection that resumes the TLS session of its pool'''
+
+    def __init__(self, host, port=None, *, pool, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self._pool = pool
+
+    def connect(self):
+        # connects to the proxy, and tunnels to the host, when there is one
+        http.client.HTTPConnection.connect(self)
+        session = self._pool.tls_session
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname, session=session)
+        if session is not None and self.sock.session_reused:
+            self._pool.stats['tls_resumed'] += 1
+
+
+class Proxy(namedtuple('Proxy', ['host', 'port', 'headers'])):
+    '''A proxy, with the headers to send it (Proxy-Authorization, for proxies with credentials)'''
+
+    @classmethod
+    def parse(cls, url):
+        if '://' not in url:
+            url = 'http://' + url
+        parts = urllib.parse.urlsplit(url)
+        headers = {}
+        if parts.username:
+            credentials = '{}:{}'.format(urllib.parse.unquote(parts.username),
+                                         urllib.parse.unquote(parts.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+        return cls(parts.hostname, parts.port or 80, headers)
+
+
+class HostPool:
+    '''Idle keep-alive connections to a single (scheme, host, port)'''
+
+    def __init__(self, scheme, host, port, context=None, maxsize=8, timeout=None, proxy=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.context = context
+        # an optional Proxy, the connections are made through
+        self.proxy = proxy
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.tls_session = None
+        self.stats = {'requests': 0, 'connections': 0, 'tls_resumed': 0}
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        '''Returns (connection, reused): an idle connection if there is one, or a new one'''
+        with self._lock:
+            self.stats['requests'] += 1
+            if self._idle:
+                return self._idle.pop(), True
+        return self.connect(), False
+
+    def connect(self):
+        '''A new connection, it connects on its first request'''
+        with self._lock:
+            self.stats['connections'] += 1
+        if self.proxy and self.scheme == 'https':
+            conn = _HTTPSConnection(
+                self.proxy.host, self.proxy.port, pool=self, context=self.context, timeout=self.timeout)
+            conn.set_tunnel(self.host, self.port, headers=self.proxy.headers)
+            return conn
+        if self.proxy:
+            # requests have the absolute URL, see HttpClient._start
+            return http.client.HTTPConnection(self.proxy.host, self.proxy.port, timeout=self.timeout)
+        if self.scheme == 'https':
+            return _HTTPSConnection(
+                self.host, self.port, pool=self, context=self.context, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def save_session(self, session):
+        '''Keep the most recent TLS session, new connections resume it'''
+        if session is not None:
+            self.tls_session = session
+
+    def put(self, conn):
+        if conn.sock is None:
+            return
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class HttpClient:
+    def __init__(self, insecure_hosts=None, pool_size=8, timeout=None, headers=None, cache=None,
+                 archive=None):
+        '''
+        insecure_hosts: host patterns (fnmatch style) to skip certificate verification for
+        pool_size: max number of idle connections to keep per host
+        timeout: socket timeout in seconds, None for the global default
+        headers: default headers to send with every request
+        cache: an optional ResponseCache
+        archive: an optional RunArchive, to record responses to or to replay them from
+        '''
+        self.cache = cache
+        self.archive = archive
+        # optional SharedResponses, set when fetching several datasets in one run
+        self.shared = None
+        self.insecure_hosts = list(insecure_hosts or [])
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.headers = dict(headers or {})
+        self._verified_context = ssl.create_default_context()
+        self._unverified_context = ssl._create_unverified_context()
+        # scheme -> proxy URL, and `no` for the hosts to reach directly
+        self._proxies = urllib.request.getproxies()
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, fetch_cfg, headers=None):
+        return cls(insecure_hosts=fetch_cfg.get('insecure_hosts'),
+                   pool_size=fetch_cfg.get('pool_size') or 8,
+                   timeout=fetch_cfg.get('timeout'),
+                   headers=headers,
+                   cache=ResponseCache.from_config(fetch_cfg.get('cache')),
+                   archive=RunArchive.from_config(fetch_cfg))
+
+    def verify_for(self, url):
+        '''Whether to verify certificates of url's host'''
+        host = urllib.parse.urlsplit(url).hostname or ''
+        return not any(fnmatch(host, pattern) for pattern in self.insecure_hosts)
+
+    def proxy_for(self, scheme, host):
+        '''The Proxy to reach host through, or None'''
+        proxy = self._proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass_environment(host, self._proxies):
+            return None
+        return Proxy.parse(proxy)
+
+    def _pool_for(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                context = None
+                if scheme == 'https':
+                    context = self._verified_context if self.verify_for("https://" + host) \
+                        else self._unverified_context
+                pool = HostPool(scheme, host, port, context, self.pool_size, self.timeout,
+                                proxy=self.proxy_for(scheme, host))
+                self._pools[key] = pool
+        return pool
+
+    def request(self, url, method=None, headers=None, body=None):
+        '''Make a request, following redirects, and returns its body (bytes)
+
+        Raises urllib.error.HTTPError on error status codes, like urllib does
+        '''
+        return self.fetch(url, method, headers, body).body
+
+    def fetch(self, url, method=None, headers=None, body=None):
+        '''Same as request, returning a Response'''
+        method = method or 'GET'
+        if self.shared and body is None:
+            return self.shared.get(method, url, lambda: self._fetch_archived(url, method, headers, body))
+        return self._fetch_archived(url, method, headers, body)
+
+    def _fetch_archived(self, url, method, headers, body):
+        if self.archive and self.archive.replaying:
+            return Response(url, 200, {}, self.archive.replay(method, url))
+
+        res = self._fetch_cached(url, method, headers, body)
+        if self.archive:
+            self.archive.record(method, url, res.body)
+        return res
+
+    def _fetch_cached(self, url, method, headers, body):
+        if not self.cache:
+            return self._fetch(url, method, headers, body)
+
+        entry = self.cache.lookup(method, url)
+        if entry and self.cache.is_fresh(entry):
+            return Response(url, 200, {}, entry.body)
+
+        conditional = self.cache.conditional_headers(entry) if entry else {}
+        res = self._fetch(url, method, {**(headers or {}), **conditional}, body)
+        if res.status == 304 and entry:
+            return Response(url, 200, res.headers, self.cache.revalidated(entry))
+        if res.status == 200:
+            self.cache.store(method, url, res.headers, res.body)
+        return res
+
+    def _fetch(self, url, method, headers, body):
+        all_headers = {**self.headers, **(headers or {})}
+
+        for _ in range(MAX_REDIRECTS + 1):
+            res = self._send(url, method, all_headers, body)
+            location = res.headers.get('location')
+            if res.status not in REDIRECT_CODES or not location:
+                break
+            url = urllib.parse.urljoin(url, location)
+            if res.status == 303 or (res.status in [301, 302] and method not in ['GET', 'HEAD']):
+                method, body = 'GET', None
+
+        if res.status >= 400:
+            raise urllib.error.HTTPError(url, res.status, http.client.responses.get(res.status, ''),
+                                         res.headers, BytesIO(res.body))
+        return res
+
+    def _send(self, url, method, headers, body):
+        pool, conn, resp = self._start(url, method, headers, body)
+        try:
+            data = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        self._release(pool, conn, resp)
+        return Response(url, resp.status, resp.headers, data)
+
+    def _start(self, url, method, headers, body):
+        '''Send a request, returning (pool, connection, response) before reading the body'''
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ['http', 'https']:
+            raise ValueError("Unsupported URL scheme: {}".format(url))
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        pool = self._pool_for(scheme, parts.hostname, parts.port)
+        if pool.proxy and scheme == 'http':
+            # to the proxy: the absolute URL
+            path = urllib.parse.urlunsplit((scheme, parts.netloc, parts.path or '/', parts.query, ''))
+            headers = {**headers, **pool.proxy.headers}
+
+        conn, reused = pool.get()
+        try:
+            resp, session = self._roundtrip(conn, method, path, headers, body)
+        except (http.client.RemoteDisconnected, ConnectionError, http.client.BadStatusLine):
+            # the server might have gotten the request: only the ones that are safe to repeat
+            if not reused or method.upper() not in RETRY_METHODS:
+                raise
+            # the server closed an idle keep-alive connection: retry on a new one
+            logging.debug("Stale connection to %s, reconnecting", parts.hostname)
+            conn = pool.connect()
+            resp, session = self._roundtrip(conn, method, path, headers, body)
+
+        pool.save_session(session)
+        return pool, conn, resp
+
+    @staticmethod
+    def _release(pool, conn, resp):
+        # a connection can be reused only once its response was read
+        if resp.will_close or not resp.isclosed():
+            conn.close()
+        else:
+            pool.put(conn)
+
+    @staticmethod
+    def _roundtrip(conn, method, path, headers, body):
+        '''Returns (response, tls session)'''
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            sock = conn.sock
+            resp = conn.getresponse()
+            # grab the session now: a response that closes the connection
+            # takes the socket away from it
+            return resp, getattr(sock, 'session', None)
+        except Exception:
+            conn.close()
+            raise
+
+    @contextmanager
+    def stream(self, url, method=None):
+        '''Make a request, yielding a file object to read the body from as it arrives
+
+        The cache, the archive and shared responses keep whole bodies, so when one
+        of them is used, the body is read first
+        '''
+        method = method or 'GET'
+        if self.cache or self.archive or self.shared:
+            yield BytesIO(self.request(url, method))
+            return
+
+        for _ in range(MAX_REDIRECTS + 1):
+            pool, conn, resp = self._start(url, method, self.headers, None)
+            location = resp.headers.get('location')
+            if resp.status not in REDIRECT_CODES or not location:
+                break
+            resp.read()
+            self._release(pool, conn, resp)
+            url = urllib.parse.urljoin(url, location)
+            if resp.status == 303:
+                method = 'GET'
+
+        try:
+            if resp.status >= 400:
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, BytesIO(resp.read()))
+            yield resp
+        finally:
+            self._release(pool, conn, resp)
+
+    def stats(self):
+        return {
+            "{}://{}".format(scheme, host if not port else "{}:{}".format(host, port)): pool.stats
+            for (scheme, host, port), pool in self._pools.items()}
+
+    def report(self):
+        for host, s in sorted(self.stats().items()):
+            logging.info("Client %s: %d requests over %d connections, %d TLS sessions resumed",
+                         host, s['requests'], s['connections'], s['tls_resumed'])
+        if self.cache:
+            self.cache.report()
+        if self.archive:
+            self.archive.report()
+        if self.shared:
+            self.shared.report()
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
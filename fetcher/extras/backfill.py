@@ -1,4 +1,5 @@
 from datetime import datetime
+from io import BytesIO
 import logging
 import os
 import re
@@ -6,7 +7,7 @@ import numpy as np
 import pandas as pd
 
 from fetcher.extras.common import atoi, MaRawData, zipContextManager
-from fetcher.utils import Fields, extract_arcgis_attributes, extract_attributes
+from fetcher.utils import Fields, arcgis_frame, extract_arcgis_attributes, extract_attributes, request_bytes
 
 
 logger = logging.getLogger(__name__)
@@ -59,6 +60,9 @@ def _yet_another_prep_cumsum_df(df, index_field=Fields.DATE.name,
             df.index = pd.to_datetime(df.index)
         # normalize
         df.index = df.index.normalize().tz_localize(None)
+    elif df.index.name == TS:
+        # already converted from epoch ms (see arcgis_frame)
+        df.index = df.index.normalize()
 
     # convert everything to numeric
     if convert_to_num:
@@ -86,18 +90,17 @@ def make_cumsum_df(data, timestamp_field=Fields.TIMESTAMP.name,
 
 
 def handle_ak(res, mapping, queries):
-    tests = extract_arcgis_attributes(res[0], mapping)
+    tests = arcgis_frame(res[0], mapping)
     cumsum_tests_df = make_cumsum_df(tests)
     add_query_constants(cumsum_tests_df, queries[0])
-    tagged = cumsum_tests_df.to_dict(orient='records')
+    tagged = [cumsum_tests_df]
 
     # cases
-    cases = pd.DataFrame([x['attributes'] for x in res[1]['features']]).rename(columns=mapping)
-    cases[TS] = pd.to_datetime(cases[TS], unit='ms')
+    cases = arcgis_frame(res[1], mapping)
     cases = cases.set_index(TS).sort_index().cumsum().resample('1d').ffill()
     cases[TS] = cases.index
     add_query_constants(cases, queries[1])
-    tagged.extend(cases.to_dict(orient='records'))
+    tagged.append(cases)
 
     # last item: already cumulative
     data = extract_arcgis_attributes(res[2], mapping)
@@ -117,19 +120,19 @@ def handle_al(res, mapping, queries):
             x.update(query_constants)
         tagged.extend(data)
 
-    tests = pd.DataFrame([x['attributes'] for x in res[-1]['features']]).rename(columns=mapping)
+    tests = arcgis_frame(res[-1], mapping)
     tests['DATE'] = '20' + tests['DATE']
     cumsum_df = _yet_another_prep_cumsum_df(tests)
     add_query_constants(cumsum_df, queries[-1])
-    tagged.extend(cumsum_df.to_dict(orient='records'))
+    tagged.append(cumsum_df)
     return tagged
 
 
 def handle_ar(res, mapping):
     # simply a cumsum table
-    data = extract_arcgis_attributes(res[0], mapping)
+    data = arcgis_frame(res[0], mapping)
     cumsum_df = make_cumsum_df(data)
-    return cumsum_df.to_dict(orient='records')
+    return cumsum_df
 
 
 def handle_az(res, mapping, queries):
@@ -142,7 +145,7 @@ def handle_az(res, mapping, queries):
         df = df.set_index(DATE).sort_index().cumsum()
         df[TS] = df.index
         add_query_constants(df, queries[i])
-        mapped.extend(df.to_dict(orient='records'))
+        mapped.append(df)
 
     return mapped
 
@@ -157,7 +160,7 @@ def handle_ca(res, mapping, queries):
         df = df.loc[df.index.notna()]
         add_query_constants(df, query)
         df[TS] = df.index
-        mapped.extend(df.to_dict(orient='records'))
+        mapped.append(df)
 
     return mapped
 
@@ -174,20 +177,20 @@ def handle_ct(res, mapping, queries):
     df[TS] = pd.to_datetime(df.index)
     df[TS] = df[TS].values.astype(np.int64) // 10 ** 9
     add_query_constants(df, queries[0])
-    tagged = df.to_dict(orient='records')
+    tagged = [df]
 
     # by report
     df = res[1].rename(columns=mapping).sort_values('DATE')
     add_query_constants(df, queries[1])
     df[TS] = df['DATE']
-    tagged.extend(df.to_dict(orient='records'))
+    tagged.append(df)
 
     # death + cases
     for i, df in enumerate(res[2:]):
         df = res[2+i].rename(columns=mapping).set_index('DATE').sort_index().cumsum()
         add_query_constants(df, queries[2+i])
         df[TS] = df.index
-        tagged.extend(df.to_dict(orient='records'))
+        tagged.append(df)
 
     return tagged
 
@@ -204,7 +207,7 @@ def handle_dc(res, mapping, queries):
     df = df.loc[df.index.dropna()].rename(columns=mapping)
     add_query_constants(df, queries[0])
     df[TS] = df.index
-    return df.to_dict(orient='records')
+    return df
 
 
 def handle_de(res, mapping):
@@ -221,7 +224,7 @@ def handle_de(res, mapping):
         df = df.droplevel(1)
         df['Date'] = df.index
         df = df.replace(mapping).rename(columns=mapping)
-        return df.to_dict(orient='records')
+        return [df]
 
     # Death
     deaths_df = df[(df['Statistic'].str.find('Death') >= 0) & (df['Unit'] == 'people')]
@@ -244,10 +247,10 @@ def handle_fl(res, mapping, queries):
     # simply a cumsum table
     tagged = []
     for i, data in enumerate(res[:-2]):
-        df = extract_arcgis_attributes(res[i], mapping)
+        df = arcgis_frame(res[i], mapping)
         cumsum_df = make_cumsum_df(df, convert_to_num=mapping.values(), fill_na_val=0)
         add_query_constants(cumsum_df, queries[i])
-        tagged.extend(cumsum_df.to_dict(orient='records'))
+        tagged.append(cumsum_df)
 
     # The last item is the aggregated case-line data
     try:
@@ -263,7 +266,7 @@ def handle_fl(res, mapping, queries):
             df = df.to_frame()
         add_query_constants(df, queries[-1])
         df[TS] = df.index
-        tagged.extend(df.to_dict(orient='records'))
+        tagged.append(df)
     except Exception as e:
         logger.warning(str(e))
 
@@ -281,7 +284,7 @@ def handle_ga(res, mapping):
             by_date = file_mapping[filename].pop(DATE_USED)
             df = df.rename(columns=file_mapping[filename])
             df[DATE_USED] = by_date
-            tagged.extend(df.to_dict(orient='records'))
+            tagged.append(df)
     return tagged
 
 
@@ -291,14 +294,14 @@ def handle_id(res, mapping, queries):
     testing = testing.rename(columns=mapping)
     df = _yet_another_prep_cumsum_df(testing)
     add_query_constants(df, queries[0])
-    return df.to_dict(orient='records')
+    return df
 
 
 def handle_il(res, mapping, queries):
     df = res[0].rename(columns=mapping)
     df[TS] = df[DATE]
     add_query_constants(df, queries[0])
-    mapped = df.to_dict(orient='records')
+    mapped = [df]
 
     # testing
     df = pd.DataFrame(res[1].get('test_group_counts')).rename(columns=mapping)
@@ -306,7 +309,7 @@ def handle_il(res, mapping, queries):
     df[DATE] = pd.to_datetime(df[DATE])
     df = df.set_index(DATE).sort_index().cumsum()
     df[TS] = df.index
-    mapped.extend(df.to_dict(orient='records'))
+    mapped.append(df)
     return mapped
 
 
@@ -332,7 +335,7 @@ def handle_in(res, mapping):
             subset.columns = ['POSITIVE']
         subset[DATE_USED] = by_date
         subset[TS] = subset.index
-        tagged.extend(subset.to_dict(orient='records'))
+        tagged.append(subset)
 
     return tagged
 
@@ -349,7 +352,7 @@ def handle_ks(res, mapping, queries):
 
     add_query_constants(testing, queries[0])
 
-    return testing.to_dict(orient='records')
+    return testing
 
 
 def handle_la(res, mapping):
@@ -361,7 +364,7 @@ def handle_la(res, mapping):
         df = df.sort_index().cumsum()
         df[TS] = df.index
         df[DATE_USED] = 'Specimen Collection'
-        tagged.extend(df.to_dict(orient='records'))
+        tagged.append(df)
     return tagged
 
 
@@ -389,7 +392,7 @@ def handle_ma(res, mapping):
             df[DATE] = df.index
 
         df[DATE_USED] = by_date
-        tagged.extend(df.to_dict(orient='records'))
+        tagged.append(df)
 
     return tagged
 
@@ -400,17 +403,17 @@ def handle_md(res, mapping, queries):
         x[DATE_USED] = 'Report'
 
     for i, result in enumerate(res[1:]):
-        data = extract_arcgis_attributes(result, mapping, 'MD')
+        data = arcgis_frame(result, mapping, 'MD')
         cumsum_df = make_cumsum_df(data)
         add_query_constants(cumsum_df, queries[i+1])
-        mapped.extend(cumsum_df.to_dict(orient='records'))
+        mapped.append(cumsum_df)
     return mapped
 
 
 def handle_me(res, mapping, queries):
     cases = res[0].rename(columns=mapping).groupby(DATE).sum().sort_index().cumsum()
     cases[TS] = cases.index
-    mapped = cases.to_dict(orient='records')
+    mapped = [cases]
     df = res[1].rename(columns=mapping).set_index(DATE)
     df['positive'] = df['Positive Tests'].fillna(0) + df['Positive Tests Flexible'].fillna(0)
     df = df.pivot(columns='Type', values=['All Tests', 'positive'])
@@ -418,7 +421,7 @@ def handle_me(res, mapping, queries):
     df = df.cumsum().rename(columns=mapping)
     add_query_constants(df, queries[1])
     df[TS] = df.index
-    mapped.extend(df.to_dict(orient='records'))
+    mapped.append(df)
 
     return mapped
 
@@ -435,7 +438,7 @@ def handle_mi(res, mapping):
     tagged = []
 
     # cases:
-    df = pd.read_excel(cases_url, engine='xlrd', parse_dates=['Date'])
+    df = pd.read_excel(BytesIO(request_bytes(cases_url)), engine='xlrd', parse_dates=['Date'])
     df = df.groupby(['Date', 'CASE_STATUS']).sum().filter(like='Cumulative').unstack()
     df.columns = df.columns.map("-".join)
 
@@ -444,13 +447,13 @@ def handle_mi(res, mapping):
         foo = df.filter(like=like).rename(columns=mapping)
         foo[TS] = foo.index
         foo[DATE_USED] = by_date
-        tagged.extend(foo.to_dict(orient='records'))
+        tagged.append(foo)
 
     # tests
-    df = pd.read_excel(tests_url, engine='xlrd', parse_dates=['MessageDate'])
+    df = pd.read_excel(BytesIO(request_bytes(tests_url)), engine='xlrd', parse_dates=['MessageDate'])
     df = df.groupby('MessageDate').sum().sort_index().cumsum().rename(columns=mapping)
     df[TS] = df.index
-    tagged.extend(df.to_dict(orient='records'))
+    tagged.append(df)
 
     return tagged
 
@@ -516,7 +519,7 @@ def handle_mo(res, mapping, queries):
         mo = mo.cumsum().rename(columns=mapping)
         add_query_constants(mo, queries[i])
         mo[TS] = mo.index
-        mapped.extend(mo.to_dict(orient='records'))
+        mapped.append(mo)
 
     # death by day of death
     df = res[2].rename(columns={'Measure Values': 'DEATH'}).rename(columns=mapping)
@@ -530,15 +533,15 @@ def handle_mo(res, mapping, queries):
     df = df.reindex(dates).ffill()
     df[TS] = df.index
     add_query_constants(df, queries[2])
-    mapped.extend(df.to_dict(orient='records'))
+    mapped.append(df)
 
     return mapped
 
 
 def handle_mp(res, mapping):
-    data = extract_arcgis_attributes(res[0], mapping)
+    data = arcgis_frame(res[0], mapping)
     cumsum_df = make_cumsum_df(data, fill_na_val=0)
-    return cumsum_df.to_dict(orient='records')
+    return cumsum_df
 
 
 def handle_nc(res, mapping, queries):
@@ -562,7 +565,7 @@ def handle_nc(res, mapping, queries):
 
             add_query_constants(tot, queries[i])
             tot[TS] = tot.index
-            tagged.extend(tot.to_dict(orient='records'))
+            tagged.append(tot)
 
         else:
             # cases and such
@@ -574,7 +577,7 @@ def handle_nc(res, mapping, queries):
                 df = pd.DataFrame(tot[c].rename(tag)).fillna(0).sort_index().cumsum()
                 df[TS] = df.index
                 df[DATE_USED] = dating
-                tagged.extend(df.to_dict(orient='records'))
+                tagged.append(df)
 
     return tagged
 
@@ -584,7 +587,7 @@ def handle_nd(res, mapping):
     res = res[0].rename(columns=mapping)
     res = res.groupby(DATE).sum().filter(mapping.values()).cumsum()
     res[DATE] = res.index
-    records = res.to_dict(orient='records')
+    records = [res]
     return records
 
 
@@ -595,12 +598,12 @@ def handle_nh(res, mapping, queries):
     df = res[0].rename(columns=mapping).set_index(TS).sort_index().cumsum()
     df[TS] = df.index
     add_query_constants(df, queries[0])
-    mapped.extend(df.to_dict(orient='records'))
+    mapped.append(df)
 
     for df, query in zip(res[1:], queries[1:]):
         df = df.rename(columns=mapping)
         add_query_constants(df, query)
-        mapped.extend(df.to_dict(orient='records'))
+        mapped.append(df)
 
     return mapped
 
@@ -634,18 +637,18 @@ def handle_nv(res, mapping):
 
         df[DATE_USED] = date_used
         df[TS] = df.index
-        mapped.extend(df.to_dict(orient='records'))
+        mapped.append(df)
 
     return mapped
 
 
 def handle_oh(res, mapping):
     testing_url = res[0]['url']
-    df = pd.read_csv(testing_url, parse_dates=['Date'])
+    df = pd.read_csv(BytesIO(request_bytes(testing_url)), parse_dates=['Date'])
     df = df.set_index('Date').sort_index().cumsum().rename(columns=mapping)
     df[TS] = df.index
     df[DATE_USED] = 'Test Result'
-    tagged = df.to_dict(orient='records')
+    tagged = [df]
 
     oh = res[1].iloc[:-1]
     oh['Case Count'] = pd.to_numeric(oh['Case Count'])
@@ -657,14 +660,14 @@ def handle_oh(res, mapping):
         like='Death').sort_index().cumsum().rename(columns=mapping)
     death[TS] = death.index
     death[DATE_USED] = 'Death'
-    tagged.extend(death.to_dict(orient='records'))
+    tagged.append(death)
 
     # cases
     cases = oh.groupby('Onset Date').sum().filter(
         like='Case').sort_index().cumsum().rename(columns=mapping)
     cases[TS] = cases.index
     cases[DATE_USED] = 'Symptom Onset'
-    tagged.extend(cases.to_dict(orient='records'))
+    tagged.append(cases)
 
     return tagged
 
@@ -680,7 +683,7 @@ def handle_or(res, mapping, queries):
     testing[TS] = testing.index
     add_query_constants(testing, queries[0])
 
-    return testing.to_dict(orient='records')
+    return testing
 
 
 def handle_pa(res, mapping, queries):
@@ -695,7 +698,7 @@ def handle_pa(res, mapping, queries):
         df = df.cumsum()
         add_query_constants(df, queries[i])
         df[TS] = df.index
-        tagged.extend(df.to_dict(orient='records'))
+        tagged.append(df)
 
     return tagged
 
@@ -710,8 +713,8 @@ def handle_ri(res, mapping):
     deaths[DATE_USED] = 'Death'
     res = res.drop(columns='DEATH')
 
-    records = res.to_dict(orient='records')
-    records.extend(deaths.to_dict(orient='records'))
+    records = [res]
+    records.append(deaths)
     return records
 
 
@@ -728,7 +731,7 @@ def handle_tn(res, mapping):
     for d, date_used in df_date:
         d[DATE_USED] = date_used
         d[TS] = d.index
-        tagged.append(d.to_dict(orient='records'))
+        tagged.append(d)
 
     return tagged
 
@@ -771,7 +774,7 @@ def handle_ut(res, mapping):
                 df[TS] = df.index
                 df[DATE_USED] = entry_mapping[DATE_USED]
 
-                mapped.extend(df.to_dict(orient='records'))
+                mapped.append(df)
 
     return mapped
 
@@ -784,7 +787,7 @@ def handle_va(res, mapping, queries):
     df[TS] = pd.to_datetime(df.index)
     df[TS] = df[TS].values.astype(np.int64) // 10 ** 9
     add_query_constants(df, queries[0])
-    tagged = df.to_dict(orient='records')
+    tagged = [df]
 
     # 2nd source is cases and death by status, by report date
     report_date = res[1]
@@ -794,7 +797,7 @@ def handle_va(res, mapping, queries):
     df = df.rename(columns=mapping)
     df[TS] = df.index
     add_query_constants(df, queries[1])
-    tagged.extend(df.to_dict(orient='records'))
+    tagged.append(df)
 
     event_date = res[2]
     df = prep_df(event_date, mapping).pivot(
@@ -806,7 +809,7 @@ def handle_va(res, mapping, queries):
         subset = df.filter(like=series).rename(columns=mapping)
         subset[TS] = subset.index
         subset[DATE_USED] = by_date
-        tagged.extend(subset.to_dict(orient='records'))
+        tagged.append(subset)
 
     return tagged
 
@@ -820,7 +823,7 @@ def handle_vt(res, mapping, queries):
     df = res[1].rename(columns=mapping).set_index(DATE).sort_index().cumsum()
     add_query_constants(df, queries[1])
     df[TS] = df.index.normalize().tz_localize(None)
-    mapped.extend(df.to_dict(orient='records'))
+    mapped.append(df)
 
     return mapped
 
@@ -839,7 +842,7 @@ def handle_wa(res, mapping, queries):
             df = df.resample('1d').ffill()
             df[TS] = df.index
             add_query_constants(df, queries[i])
-            tagged.extend(df.to_dict(orient='records'))
+            tagged.append(df)
 
     # last one is testing
     df = res[-1].rename(columns=mapping).set_index(DATE)
@@ -848,7 +851,7 @@ def handle_wa(res, mapping, queries):
         df[Fields.SPECIMENS_POS.name] + df[Fields.SPECIMENS_NEG.name]
     df[TS] = pd.to_datetime(df.index)
     add_query_constants(df, queries[-1])
-    tagged.extend(df.to_dict(orient='records'))
+    tagged.append(df)
 
     return tagged
 
@@ -860,7 +863,7 @@ def handle_wi(res, mapping, queries):
         df = res[key].rename(columns=mapping)
         add_query_constants(df, queries[key])
         df[TS] = df[DATE]
-        tagged.extend(df.to_dict(orient='records'))
+        tagged.append(df)
 
     # tests
     df = res[2].rename(columns=mapping)
@@ -868,13 +871,13 @@ def handle_wi(res, mapping, queries):
     df = df.set_index(DATE).sort_index().cumsum()
     df[TS] = df.index
     add_query_constants(df, queries[2])
-    tagged.extend(df.to_dict(orient='records'))
+    tagged.append(df)
 
     # confirmed by onset
     df = res[3].rename(columns=mapping).groupby(DATE).sum().sort_index()
     df[TS] = df.index
     add_query_constants(df, queries[3])
-    tagged.extend(df.to_dict(orient='records'))
+    tagged.append(df)
 
     return tagged
 
@@ -888,4 +891,4 @@ def handle_wy(res, mapping, queries):
     testing = testing.sort_index().cumsum()
     testing[TS] = testing.index
     add_query_constants(testing, queries[0])
-    return testing.to_dict(orient='records')
+    return testing
@@ -4,8 +4,8 @@ import shutil
 from contextlib import contextmanager
 import pandas as pd
 import re
-import urllib
-import urllib.request
+
+from fetcher.utils import request_bytes
 
 
 def atoi(val):
@@ -16,20 +16,17 @@ def atoi(val):
 
 @contextmanager
 def zipContextManager(file_url, archive_type='zip'):
-    req = urllib.request.Request(file_url, headers={'User-Agent': 'Mozilla/5.0'})
+    tmpfile = NamedTemporaryFile(delete=True)
+    tmpdir = TemporaryDirectory()
 
     try:
-        with urllib.request.urlopen(req) as response:
-            tmpfile = NamedTemporaryFile(delete=True)
-            tmpdir = TemporaryDirectory()
-
-            shutil.copyfileobj(response, tmpfile)
-            tmpfile.flush()
-            if archive_type:
-                shutil.unpack_archive(tmpfile.name, tmpdir.name, format=archive_type)
-                yield tmpdir.name
-            else:
-                yield tmpfile.name
+        tmpfile.write(request_bytes(file_url))
+        tmpfile.flush()
+        if archive_type:
+            shutil.unpack_archive(tmpfile.name, tmpdir.name, format=archive_type)
+            yield tmpdir.name
+        else:
+            yield tmpfile.name
     finally:
         # close everything, it should also unlink the dirs to be deleted
         tmpfile.close()
@@ -42,7 +39,5 @@ def MaRawData(res, link_text='COVID-19 Raw Data'):
     link_part = link['href']
     url = "https://www.mass.gov{}".format(link_part)
 
-    req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-    res = urllib.request.urlopen(req)
-    df = pd.read_excel(BytesIO(res.read()), sheet_name=None)
+    df = pd.read_excel(BytesIO(request_bytes(url)), sheet_name=None)
     return df
@@ -13,7 +13,7 @@ def handle_dc(res, mapping):
     ppr['UNITS'] = 'Tests'
     ppr['WINDOW'] = 'Week'
     ppr['SID'] = 'dc-1'
-    return ppr.to_dict(orient='records')
+    return ppr
 
 
 def handle_ga(res, mapping):
@@ -58,7 +58,7 @@ def handle_ga(res, mapping):
             pct['WINDOW'] = window
             pct['UNITS'] = 'Tests'
             pct['SID'] = get_sid()
-            tagged.append(pct.to_dict(orient='records'))
+            tagged.append(pct)
 
     return tagged
 
@@ -85,7 +85,7 @@ def handle_mo(res, mapping):
     df['WINDOW'] = 'Week'
     df['SID'] = 'mo-3'
     df = df[df['Measure Names'].isin(list(mapping.keys()))]
-    return df.to_dict(orient='records')
+    return df
 
 
 def handle_md(res, mapping):
@@ -94,13 +94,13 @@ def handle_md(res, mapping):
     df['UNITS'] = 'Tests'
     df['WINDOW'] = 'Day'
     df['SID'] = 'md-1'
-    tagged.extend(df.to_dict(orient='records'))
+    tagged.append(df)
 
     weekly = df.drop(columns=['TOTAL', 'POSITIVE', 'PPR'])
     weekly['PPR'] = df['rolling_avg']
     weekly['WINDOW'] = 'Week'
     weekly['SID'] = 'md-2'
-    tagged.extend(weekly.to_dict(orient='records'))
+    tagged.append(weekly)
     return tagged
 
 
@@ -118,14 +118,14 @@ def handle_ut(res, mapping):
                     ppr = df.loc[:, ['TIMESTAMP', 'PPR', 'UNITS']]
                     ppr['WINDOW'] = 'Week'
                     ppr['SID'] = 'ut-1'
-                    tagged.extend(ppr.to_dict(orient='records'))
+                    tagged.append(ppr)
 
                     # add the daily values
                     totals = df.loc[:, ['TIMESTAMP', 'UNITS', 'POSITIVE']]
                     totals['TOTAL'] = df['POSITIVE'] + df['NEGATIVE']
                     totals['WINDOW'] = 'Day'
                     totals['SID'] = 'ut-2'
-                    tagged.extend(totals.to_dict(orient='records'))
+                    tagged.append(totals)
 
                     break
     return tagged
@@ -138,7 +138,7 @@ def handle_va(res, mapping):
     df['WINDOW'] = 'Week'
     df['UNITS'] = 'Tests'
     df['SID'] = 'va-1'
-    return df.to_dict(orient='records')
+    return df
 
 
 def handle_wa(res, mapping):
@@ -165,7 +165,7 @@ def handle_wa(res, mapping):
         pct['WINDOW'] = window
         pct['SID'] = get_sid()
         sid += 1
-        tagged.extend(pct.to_dict(orient='records'))
+        tagged.append(pct)
 
     return tagged
 
@@ -192,6 +192,6 @@ def handle_wi(res, mapping):
         df['WINDOW'] = 'Week'
         df['SID'] = get_sid()
         sid += 1
-        mapped.append(df.to_dict(orient='records'))
+        mapped.append(df)
 
     return mapped
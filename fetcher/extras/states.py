@@ -7,6 +7,7 @@ The parameters are:
 
 
 from datetime import datetime
+from io import BytesIO
 import csv
 import logging
 import math
@@ -14,7 +15,7 @@ import os
 import re
 import pandas as pd
 
-from fetcher.utils import map_attributes, Fields, csv_sum, extract_arcgis_attributes
+from fetcher.utils import map_attributes, Fields, csv_sum, extract_arcgis_attributes, request_bytes
 from fetcher.extras.common import atoi, MaRawData, zipContextManager
 
 
@@ -578,7 +579,7 @@ def handle_mi(res, mapping):
     results_url = base_url + links[4]['href']
 
     try:
-        df = pd.read_excel(cases_url, engine='xlrd')
+        df = pd.read_excel(BytesIO(request_bytes(cases_url)), engine='xlrd')
         filter_col = 'CASE_STATUS'
         summed = df.groupby(filter_col).sum()
         for m in ['Cases', 'Deaths']:
@@ -588,7 +589,7 @@ def handle_mi(res, mapping):
         logging.warning("Exception getting cases by status", e)
 
     try:
-        df = pd.read_excel(tests_url, engine='xlrd')
+        df = pd.read_excel(BytesIO(request_bytes(tests_url)), engine='xlrd')
         filter_col = 'TestType'
         summed = df.groupby(filter_col).sum()
         for m in ['Diagnostic', 'Serology']:
@@ -597,7 +598,7 @@ def handle_mi(res, mapping):
         logging.warning("[MI] failed to fetch test results")
 
     try:
-        df = pd.read_excel(results_url, engine='xlrd')
+        df = pd.read_excel(BytesIO(request_bytes(results_url)), engine='xlrd')
         fields = ['Negative', 'Positive']
         summed = df[fields].sum()
         for x in fields:
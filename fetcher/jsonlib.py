@@ -0,0 +1,76 @@
+'''
+JSON decoding of response bodies.
+
+Decoding responses is a big part of the CPU time of a run. `loads` parses straight
+from the response bytes (without decoding them to a str first) with the fastest
+backend that's installed, and falls back to the stdlib `json` module otherwise.
+
+Backends produce the same dicts/lists/numbers as `json.loads`. A body that a fast
+backend rejects (e.g. NaN values, or integers larger than 64 bits, which `json`
+accepts) is decoded with `json`.
+
+The backend is set with `fetch.json` (auto, orjson, json).
+'''
+
+import json
+import logging
+
+
+AUTO = 'auto'
+
+
+def _orjson():
+    # imported here to not force it as a dependency
+    import orjson
+    return orjson.loads
+
+
+# name -> function returning the loads function of the backend (raises ImportError
+# if it's not installed), fastest first
+BACKENDS = {
+    'orjson': _orjson,
+    'json': lambda: json.loads,
+}
+
+_backend = None
+_loads = None
+
+
+def use(name=None):
+    '''Set the backend by name, or the fastest installed one for auto (or None)'''
+    global _backend, _loads
+    name = name or AUTO
+    if name == AUTO:
+        for candidate, factory in BACKENDS.items():
+            try:
+                _loads = factory()
+            except ImportError:
+                continue
+            _backend = candidate
+            break
+    else:
+        if name not in BACKENDS:
+            raise ValueError("Unknown JSON backend: {}".format(name))
+        _loads = BACKENDS[name]()
+        _backend = name
+    logging.debug("JSON backend: %s", _backend)
+    return _backend
+
+
+def backend():
+    if _backend is None:
+        use()
+    return _backend
+
+
+def loads(data):
+    '''Decode a JSON document, from bytes or str'''
+    if _loads is None:
+        use()
+    if _loads is json.loads:
+        return _loads(data)
+    try:
+        return _loads(data)
+    except ValueError:
+        # something the fast backend doesn't support: let json decide
+        return json.loads(data)
@@ -1,10 +1,23 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextlib
+import copy
 import logging
+import os
+import sys
+import time
 import typing
 import hydra
+import numpy as np
+from omegaconf import OmegaConf, open_dict
 import pandas as pd
 
-from fetcher.utils import Fields
+from fetcher import jsonlib
+from fetcher.client import HttpClient, use_client
+from fetcher.utils import Fields, USER_AGENT
+from fetcher.aio import fetch_states
+from fetcher.scheduler import HostScheduler
+from fetcher.shared import SharedResponses
+from fetcher.sinks import CsvSink, csv_names, open_sinks, save_df_to_db, split_stream_sinks  # noqa: F401
 from fetcher.source_utils import fetch_source, process_source_responses
 from fetcher.sources import build_sources
 
@@ -15,43 +28,109 @@ STATE = Fields.STATE.name
 
 
 class Fetcher:
-    def __init__(self, cfg):
-        '''Initialize source information'''
+    def __init__(self, cfg, client=None, scheduler=None):
+        '''Initialize source information
+
+        client, scheduler: share a run client and a scheduler with other fetchers,
+            instead of creating them from the fetch config
+        '''
         self.dataset = cfg.dataset  # store dataset config
+        fetch_cfg = cfg.get('fetch') or {}
         self.sources = build_sources(
-            cfg.dataset.sources_file, cfg.dataset.mapping_file, cfg.dataset.extras_module)
+            cfg.dataset.sources_file, cfg.dataset.mapping_file, cfg.dataset.extras_module,
+            coalesce=fetch_cfg.get('coalesce'), conditional=fetch_cfg.get('coalesce_conditional'),
+            project=fetch_cfg.get('project'))
+
+        # number of states fetched in parallel, 1 means one after the other
+        self.workers = max(1, fetch_cfg.get('workers') or 1)
+        # number of queries of a single state that run in parallel
+        self.query_workers = max(1, fetch_cfg.get('query_workers') or 1)
+        # 'threads' or 'asyncio'
+        self.engine = fetch_cfg.get('engine') or 'threads'
+        # max number of requests in flight with the asyncio engine
+        self.max_in_flight = fetch_cfg.get('max_in_flight') or 100
+        # per host concurrency and rate limits, shared by all states
+        self.scheduler = scheduler or HostScheduler(fetch_cfg.get('hosts'))
+        # JSON decoding backend: auto (the fastest installed), orjson or json
+        jsonlib.use(fetch_cfg.get('json'))
+        # keep-alive connections, shared by all states for the run
+        self.client = client or HttpClient.from_config(fetch_cfg, headers={'user-agent': USER_AGENT})
 
     def has_state(self, state):
         return state in self.sources
 
-    def fetch_all(self, states):
+    def fetch_all(self, states, on_state=None):
+        '''Fetch and parse states, returning a dict of state -> parsed data
+
+        on_state: called with (state, parsed_data) as soon as a state is fetched and parsed
+            (e.g. to write it right away), one state at a time: in the thread that called
+            fetch_all, or in an output thread with the asyncio engine
+        '''
         results = {}
         success = 0
         failures = []
 
-        for state in states:
-            if not self.has_state(state):
-                # Nothing to do for a state without sources
-                continue
-            try:
-                res, data = self.fetch_state(state)
-                if res:
-                    if data:
-                        results[state] = data
-                        success += 1
-                    else:
-                        # failed parsing
-                        logging.warning("Failed parsing %s", state)
-                        failures.append(state)
-            except Exception:
-                logging.error("Failed to fetch %s", state, exc_info=True)
+        def done(state, outcome):
+            ok, res, data = outcome
+            if on_state and ok and res and len(data):
+                try:
+                    on_state(state, data)
+                except Exception:
+                    logging.error("Failed handling the data of %s", state, exc_info=True)
+
+        states = [s for s in states if self.has_state(s)]
+        start = time.monotonic()
+        with use_client(self.client):
+            if self.engine == 'asyncio':
+                outcomes = fetch_states(self, states, done)
+            elif self.workers > 1 and len(states) > 1:
+                with ThreadPoolExecutor(max_workers=self.workers,
+                                        thread_name_prefix='fetch') as executor:
+                    futures = {executor.submit(self._try_fetch_state, state): state for state in states}
+                    fetched = {}
+                    for future in as_completed(futures):
+                        fetched[futures[future]] = future.result()
+                        done(futures[future], fetched[futures[future]])
+                    # in the order of states, so results is built the same way it's
+                    # built when fetching sequentially
+                    outcomes = [fetched[state] for state in states]
+            else:
+                outcomes = []
+                for state in states:
+                    outcomes.append(self._try_fetch_state(state))
+                    done(state, outcomes[-1])
+
+        for state, (ok, res, data) in zip(states, outcomes):
+            if not ok:
                 failures.append(state)
-
-        logging.info("Fetched data for {} states".format(success))
+            elif res:
+                # a list of records, or a DataFrame
+                if len(data):
+                    results[state] = data
+                    success += 1
+                else:
+                    # failed parsing
+                    logging.warning("Failed parsing %s", state)
+                    failures.append(state)
+
+        logging.info("Fetched data for {} states in {:.2f}s".format(success, time.monotonic() - start))
         if failures:
             logging.info("Failed to fetch: %r", failures)
+        self.scheduler.report()
+        self.client.report()
         return results
 
+    def _try_fetch_state(self, state):
+        ''' Fetch a single state, never raising: returns a tuple of
+        (ok, fetched_result, parsed_data)
+        '''
+        try:
+            res, data = self.fetch_state(state)
+            return True, res, data
+        except Exception:
+            logging.error("Failed to fetch %s", state, exc_info=True)
+            return False, None, None
+
     def fetch_state(self, state):
         ''' Fetch data for a single state, returning a tuple of
         (fetched_result, parsed_data)
@@ -64,11 +143,67 @@ class Fetcher:
         if not source or not source.queries:
             return res, {}
 
-        results = fetch_source(source)
+        results = fetch_source(source, self.query_workers, self.scheduler)
         data = process_source_responses(source, results)
         return results, data
 
 
+DAY_NS = 24 * 3600 * 10**9
+
+
+def _resample_ffill(df, part):
+    return df.reset_index(part).groupby(part, observed=True).apply(
+        lambda d: d.ffill().resample('1D', closed='right').ffill()
+    ).drop(columns=part)
+
+
+def daily_ffill(df, part):
+    '''Forward fill each series (the rows of the same part values) and resample it to
+    one row a day, indexed by part + [TIMESTAMP]
+
+    Same as resampling every series with `d.ffill().resample('1D', closed='right').ffill()`,
+    for all of them at once: the days of a series are from its first timestamp (rounded up
+    to a day) to its last one (rounded up), and each day has the last row at or before it.
+    '''
+    ts = df.index.get_level_values(TS)
+    if df.empty or ts.dtype != 'datetime64[ns]' or ts.hasnans:
+        # time zones and missing dates: resample each series
+        return _resample_ffill(df, part)
+
+    columns = list(df.columns)
+    rows = df.reset_index()
+    codes = rows.groupby(part, sort=True, observed=True).ngroup().to_numpy()
+    if (codes < 0).any():
+        # missing part values, not a series
+        return _resample_ffill(df, part)
+    ts = rows[TS].to_numpy().view('int64')
+    order = np.lexsort((ts, codes))
+    rows, codes, ts = rows.iloc[order].reset_index(drop=True), codes[order], ts[order]
+    rows[columns] = rows.groupby(codes, sort=False)[columns].ffill()
+
+    # the days of every series: from its first timestamp to its last one, rounded up
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(codes)] - 1
+    first = -(-ts[starts] // DAY_NS) * DAY_NS
+    days = (-(-ts[ends] // DAY_NS) * DAY_NS - first) // DAY_NS + 1
+    series = np.repeat(np.arange(len(starts)), days)
+    offsets = np.arange(len(series)) - np.repeat(np.cumsum(days) - days, days)
+
+    # a row is the last one at or before the days from its own (rounded up) on, until
+    # the next row of its series
+    positions = (np.cumsum(days) - days)[codes] + -(-(ts - first[codes]) // DAY_NS)
+    last = np.r_[positions[1:] != positions[:-1], True]
+    picked = np.full(len(series), -1)
+    picked[positions[last]] = np.flatnonzero(last)
+    picked = np.maximum.accumulate(picked)
+
+    daily = rows[columns].iloc[picked]
+    daily.index = pd.MultiIndex.from_arrays(
+        [rows[p].to_numpy()[picked] for p in part] + [
+            pd.DatetimeIndex(first[series] + offsets * DAY_NS)], names=part + [TS])
+    return daily
+
+
 def _fix_index_and_columns(index, columns):
     index = index if isinstance(index, str) else list(index)
     if isinstance(index, list) and len(index) == 1:
@@ -85,36 +220,76 @@ def _fix_index_and_columns(index, columns):
     return index
 
 
-def build_dataframe(results, states_to_index, dataset_cfg, output_date_format, filename=None):
-    # TODO: move file generation out of here
-    # results is a *dict*: state -> []
-    if not results:
-        return {}
+def _coerce(values, dtype):
+    dtype = str(dtype)
+    if dtype == 'category':
+        return values.astype('category')
+    if dtype.startswith('datetime64'):
+        return pd.to_datetime(values).astype(dtype)
+    if values.dtype == object:
+        # numbers, numpy scalars and numeric strings
+        values = pd.to_numeric(values)
+    return values.astype(dtype)
+
+
+def apply_dtypes(df, dtypes):
+    '''Coerce the columns of df to the dtypes of the dataset schema, in place
+
+    dtypes: field -> dtype, with `default` for the fields that aren't listed, and
+        `object` to leave a field as is.
+    A column that doesn't fit its dtype (e.g. fractions or text in a count) is left as is,
+    with a warning: text fields are listed as object (or category), not left to `default`.
+    '''
+    if not dtypes:
+        return df
+    default = dtypes.get('default')
+    for c in df.columns:
+        dtype = dtypes.get(c, default)
+        if not dtype or dtype == 'object' or df[c].dtype == dtype:
+            continue
+        try:
+            df[c] = _coerce(df[c], dtype)
+        except (TypeError, ValueError, OverflowError) as e:
+            logging.warning("Keeping %s as %s, it doesn't fit %s: %s", c, df[c].dtype, dtype, e)
+    return df
 
-    # need to prepare the index and preparing the data, and the columns
-    # data: a list of dicts
-    # index: a string or a list of len 2+
-    # columns: add state even if not listed, if it's in index
-    index = dataset_cfg.index
-    columns = dataset_cfg.fields
-    index = _fix_index_and_columns(index, columns)
 
+def _assemble(results, columns):
+    '''The frame of the results (state -> records or DataFrame), in the order of the states'''
     items = []
+    frames = []
     for _, v in results.items():
-        if isinstance(v, typing.List):
+        if isinstance(v, pd.DataFrame):
+            # keep the order of the states
+            if items:
+                frames.append(pd.DataFrame(items, columns=columns))
+                items = []
+            frames.append(v.reindex(columns=columns))
+        elif isinstance(v, typing.List):
             items.extend(v)
         elif isinstance(v, typing.Dict):
             items.append(v)
         else:
             logging.warning("This shouldnt happen: %r", v)
 
-    df = pd.DataFrame(items, columns=columns)
+    if frames:
+        if items:
+            frames.append(pd.DataFrame(items, columns=columns))
+        return pd.concat(frames, ignore_index=True)
+    return pd.DataFrame(items, columns=columns)
+
+
+def _build(df, index, states_to_index, dtypes, output_date_format):
+    # typed columns: counts as (nullable) integers, labels as categories
+    apply_dtypes(df, dtypes)
     # special casing here, because of groupby+dropna bug
     if isinstance(index, list) and len(index) > 1:
         for c in index:
+            if isinstance(df[c].dtype, pd.CategoricalDtype) and 'n/a' not in df[c].cat.categories:
+                df[c] = df[c].cat.add_categories('n/a')
             df[c] = df[c].fillna('n/a')
     df = df.set_index(index)
-    df = df.groupby(level=df.index.names, dropna=False).last()
+    df = df.groupby(level=df.index.names, dropna=False, observed=True).last()
 
     # Notice: Reindexing and then sorting means that we're always sorting
     # the index, and not using the order that comes from configuration
@@ -127,21 +302,36 @@ def build_dataframe(results, states_to_index, dataset_cfg, output_date_format, f
         # For each state, we forward fill, and resample to 1-day intervals
         # and forward fill the newely added days
         part = [x for x in index if x != TS]
-        df = df.reset_index(part).groupby(part).apply(
-            lambda d: d.ffill().resample('1D', closed='right').ffill()
-        ).drop(columns=part)
+        df = daily_ffill(df, part)
         df.sort_index(level=TS, ascending=False, inplace=True)
 
     df.sort_index(level=STATE, kind='mergesort', ascending=True, sort_remaining=False, inplace=True)
     # Add existing date format when we're done with all other updates
     if TS in df.index.names:
         df['DATE'] = df.index.get_level_values(level=TS).strftime(output_date_format)
+    return df
+
+
+def build_dataframe(results, states_to_index, dataset_cfg, output_date_format, filename=None):
+    # TODO: move file generation out of here
+    # results is a *dict*: state -> []
+    if not results:
+        return {}
+
+    # need to prepare the index and preparing the data, and the columns
+    # data: a list of dicts
+    # index: a string or a list of len 2+
+    # columns: add state even if not listed, if it's in index
+    index = dataset_cfg.index
+    columns = dataset_cfg.fields
+    index = _fix_index_and_columns(index, columns)
+
+    df = _assemble(results, columns)
+    df = _build(df, index, states_to_index, getattr(dataset_cfg, 'dtypes', None), output_date_format)
 
     if filename:
-        base_name = "{}.csv".format(filename)
-        now_name = '{}_{}.csv'.format(filename, datetime.now().strftime('%Y%m%d%H%M%S'))
-        df.to_csv('{}'.format(now_name))
-        df.to_csv('{}'.format(base_name))
+        with CsvSink(csv_names(filename)) as sink:
+            sink.write(df)
         # TODO: if indexing by more than state, store individual state files?
 
     # Report an interesting metric:
@@ -151,38 +341,226 @@ def build_dataframe(results, states_to_index, dataset_cfg, output_date_format, f
     return df
 
 
-def save_df_to_db(db_config, df):
-    # verify again that we should store to db
-    if not db_config.store:
+def can_chunk(dataset_cfg):
+    '''Whether the frame of the dataset can be built one state at a time: its index has
+    more than STATE (states aren't reindexed), and states never share a row'''
+    index = dataset_cfg.index
+    return not isinstance(index, str) and len(index) > 1 and STATE in index
+
+
+def _settle_dtypes(results, columns, dtypes):
+    '''The dtypes of the columns in the frame of all the states, from their frames one at a time
+
+    A column has its schema dtype if it fits in every state (as apply_dtypes would do on
+    all of them), otherwise the dtype the values of all the states make together.
+    '''
+    if dtypes:
+        default = dtypes.get('default')
+        dtypes = {c: dtypes.get(c, default) for c in columns}
+    fits = set(columns)
+    found = {}
+    for state, v in results.items():
+        df = _assemble({state: v}, columns)
+        typed = apply_dtypes(df.copy(), dtypes)
+        for c in columns:
+            if not (dtypes and dtypes[c] and typed[c].dtype == dtypes[c]):
+                fits.discard(c)
+            if df[c].notna().any():
+                found.setdefault(c, set()).add(df[c].dtype)
+
+    settled = {}
+    for c in columns:
+        kinds = found.get(c, {np.dtype(object)})
+        if c in fits:
+            settled[c] = dtypes[c]
+        elif len(kinds) == 1:
+            settled[c] = next(iter(kinds))
+        elif all(isinstance(k, np.dtype) and k.kind in 'iuf' for k in kinds):
+            settled[c] = np.result_type(*kinds)
+        else:
+            settled[c] = np.dtype(object)
+    return settled
+
+
+def build_dataframe_chunks(results, states_to_index, dataset_cfg, output_date_format):
+    '''The frame of build_dataframe, one state at a time: yields the frames of the states,
+    in the order of the rows of the whole frame, to write them one after the other
+
+    Only the rows of one state are built at a time, and a state's results are removed
+    from `results` once its frame is built. The columns have the same dtypes in every
+    frame, so the written rows are the same as the ones of the whole frame.
+    Datasets that can't be chunked (see can_chunk) are built at once.
+    '''
+    if not can_chunk(dataset_cfg):
+        if results:
+            yield build_dataframe(results, states_to_index, dataset_cfg, output_date_format)
         return
 
-    print("Storing to DB {db_name}.{table}".format(**db_config))
+    index = _fix_index_and_columns(dataset_cfg.index, dataset_cfg.fields)
+    columns = dataset_cfg.fields
+    dtypes = _settle_dtypes(results, columns, getattr(dataset_cfg, 'dtypes', None))
+    # the frame is sorted by state
+    for state in sorted(results):
+        df = _assemble({state: results.pop(state)}, columns)
+        yield _build(df, index, states_to_index, dtypes, output_date_format)
+
+
+def cast_dtypes(df, dtypes):
+    '''Cast the columns of df to the dtypes of the schema whatever their values, in place
+
+    Unlike apply_dtypes, the dtypes don't depend on the values, so frames cast separately
+    (like the states written as they're fetched) all have the same ones: values that don't
+    fit are missing (with a warning), and counts are floats, since a state can have fractions.
+    '''
+    if not dtypes:
+        return df
+    default = dtypes.get('default')
+    for c in df.columns:
+        dtype = str(dtypes.get(c, default) or 'object')
+        if dtype == 'object':
+            continue
+        values = df[c]
+        if dtype == 'category':
+            df[c] = values.astype('category')
+            continue
+        if dtype.startswith('datetime64'):
+            cast = pd.to_datetime(values, errors='coerce')
+            if cast.dt.tz is not None:
+                cast = cast.dt.tz_convert(None)
+            cast = cast.astype(dtype)
+        else:
+            cast = pd.to_numeric(values, errors='coerce').astype('float64')
+        lost = values.notna().sum() - cast.notna().sum()
+        if lost:
+            logging.warning("%d values of %s don't fit %s, they're missing", lost, c, dtype)
+        df[c] = cast
+    return df
+
+
+def build_state_frame(state, data, dataset_cfg, output_date_format):
+    '''The rows of a single state in the frame of build_dataframe, to write them before
+    the other states are fetched (cast to the schema, see cast_dtypes)'''
+    index = _fix_index_and_columns(dataset_cfg.index, dataset_cfg.fields)
+    df = _assemble({state: data}, dataset_cfg.fields)
+    cast_dtypes(df, getattr(dataset_cfg, 'dtypes', None))
+    return _build(df, index, [state], None, output_date_format)
+
+
+def peak_memory():
+    '''Peak resident memory of the process in MB (None where it's not available)'''
+    try:
+        # imported here, it's only available on unix
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kB on linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def dataset_config(cfg, name):
+    '''The run config of cfg, for dataset `name` instead of the one it was loaded with'''
+    root = hydra.utils.get_original_cwd()
+    base = OmegaConf.load(os.path.join(root, 'config.yaml')).dataset
+    dataset = OmegaConf.merge(base, OmegaConf.load(os.path.join(root, 'dataset', '{}.yaml'.format(name))))
+
+    dataset_cfg = copy.deepcopy(cfg)
+    with open_dict(dataset_cfg):
+        dataset_cfg.dataset = dataset
+    return dataset_cfg
+
+
+def run_datasets(cfg, names):
+    '''Fetch several datasets in one run
+
+    The datasets share the run client and the scheduler, and every request that
+    several queries make (in any of the datasets) is made once, see fetcher.shared
+    '''
+    fetch_cfg = cfg.get('fetch') or {}
+    scheduler = HostScheduler(fetch_cfg.get('hosts'))
+    client = HttpClient.from_config(fetch_cfg, headers={'user-agent': USER_AGENT})
+
+    fetchers = []
+    for name in names:
+        dataset_cfg = dataset_config(cfg, name)
+        fetcher = Fetcher(dataset_cfg, client, scheduler)
+        sources = [fetcher.sources[state] for state in cfg.state if fetcher.has_state(state)]
+        fetchers.append((dataset_cfg, fetcher, sources, open_sinks(dataset_cfg)))
+    client.shared = SharedResponses.plan([source for _, _, sources, _ in fetchers for source in sources])
+
+    with client:
+        for dataset_cfg, fetcher, sources, sinks in fetchers:
+            logging.info("Fetching dataset %s", dataset_cfg.dataset.name)
+            try:
+                fetch_and_output(dataset_cfg, fetcher, sinks)
+            finally:
+                client.shared.finish(sources)
+
+
+def fetch_and_output(cfg, fetcher, sinks):
+    '''Fetch the states of cfg, and write the output to the sinks
 
-    # import it here to not force it as a dependency if not storing anywhere
-    from sqlalchemy import create_engine
+    With `stream`, the rows of every state are written to the stream sinks (see
+    split_stream_sinks) as soon as the state is parsed, and the rest of the output, which
+    needs all the states (reindexed and sorted), once they're all fetched.
+    '''
+    if not cfg.get('stream'):
+        _output(cfg, fetcher.fetch_all(cfg.state), sinks)
+        return
 
-    renames = Fields.map()
-    df.rename(columns=renames, inplace=True)
-    df.index.rename([renames[x] for x in df.index.names], inplace=True)
-    engine_conf = "{driver}://{username}:{password}@{host}:{port}/{db_name}".format(
-        **db_config)
-    engine = create_engine(engine_conf)
-    df.to_sql(db_config.table, engine, if_exists='append', chunksize=200, method='multi')
+    streams, sinks = split_stream_sinks(cfg, sinks)
+    with contextlib.ExitStack() as stack:
+        for sink in streams:
+            stack.enter_context(sink)
+
+        def write(state, data):
+            df = build_state_frame(state, data, cfg.dataset, cfg.output_date_format)
+            for sink in streams:
+                sink.write(df)
+            logging.info("Wrote the %d rows of %s", len(df), state)
+
+        results = fetcher.fetch_all(cfg.state, on_state=write)
+    _output(cfg, results, sinks)
+
+
+def _output(cfg, results, sinks):
+    '''Build the frame of the results, and write it to the sinks of the output'''
+    with contextlib.ExitStack() as stack:
+        for sink in sinks:
+            stack.enter_context(sink)
+
+        if cfg.dataset.get('chunked') and can_chunk(cfg.dataset):
+            rows = cells = 0
+            for df in build_dataframe_chunks(results, cfg.state, cfg.dataset, cfg.output_date_format):
+                for sink in sinks:
+                    sink.write(df)
+                rows += len(df)
+                cells += df.notnull().sum().sum()
+            logging.info("Fetched a total of %d cells", cells)
+            print("Wrote {} rows".format(rows))
+        else:
+            # This stores the requsted fields in order
+            df = build_dataframe(results, cfg.state, cfg.dataset, cfg.output_date_format)
+            print(df)
+            if len(df):
+                for sink in sinks:
+                    sink.write(df)
+    logging.info("Peak memory: %s MB", peak_memory())
 
 
 @hydra.main(config_path='..', config_name="config")
 def main(cfg):
-    print(cfg.dataset.pretty())
-
     if cfg.state and isinstance(cfg.state, str):
         cfg.state = cfg.state.split(',')
 
-    fetcher = Fetcher(cfg)
-    results = fetcher.fetch_all(cfg.state)
-
-    # This stores the CSV with the requsted fields in order
-    df = build_dataframe(results, cfg.state, cfg.dataset, cfg.output_date_format, cfg.output)
-    print(df)
+    if cfg.get('datasets'):
+        names = cfg.datasets.split(',') if isinstance(cfg.datasets, str) else list(cfg.datasets)
+        run_datasets(cfg, names)
+        return
 
-    if 'db' in cfg.dataset and cfg.dataset.db.store:
-        save_df_to_db(cfg.dataset.db, df)
+    print(cfg.dataset.pretty())
+    fetcher = Fetcher(cfg)
+    # before fetching, to fail early when a sink can't be written
+    sinks = open_sinks(cfg)
+    with fetcher.client:
+        fetch_and_output(cfg, fetcher, sinks)
@@ -0,0 +1,179 @@
+'''
+Query planner: coalesce ArcGIS statistics queries that hit the same layer.
+
+Many states send several `outStatistics` queries to the same layer, that differ only
+in their statistics, or in their filter (e.g. counting all the tests, the negative
+ones, and the positive ones). The planner merges them into a single request, and
+splits its response back into the per query responses the handlers expect, so
+`source.queries` (and what extras handlers get) doesn't change.
+
+Queries are merged only when it's safe:
+- same url, method and params, except for `outStatistics` (and `where`, see below)
+- plain statistics: no `groupByFieldsForStatistics`, and every statistic has a
+  unique `outStatisticFieldName`, to split the response by
+
+With `conditional`, queries that differ in their `where` too are merged into
+conditional statistics (`sum` of a CASE expression over the OR of the filters).
+Not all servers support SQL expressions in statistics, so it's opt-in, and only
+for count and sum statistics.
+'''
+
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+import json
+import logging
+from typing import List
+
+
+CONDITIONAL_STATISTICS = ['count', 'sum']
+
+
+@dataclass
+class Request:
+    '''A query to fetch, and the indices of the source queries it answers'''
+    query: object
+    members: List[int]
+    # outStatisticFieldName of each member, None for a query fetched as is
+    fields: List[List[str]] = None
+
+
+class QueryPlan:
+    def __init__(self, requests, num_queries):
+        self.requests = requests
+        self.num_queries = num_queries
+
+    @property
+    def queries(self):
+        return [r.query for r in self.requests]
+
+    def split(self, results):
+        '''The results of the planned queries, back to the results of the source queries'''
+        split = [None] * self.num_queries
+        for request, res in zip(self.requests, results):
+            if request.fields is None:
+                split[request.members[0]] = res
+                continue
+            for i, fields in zip(request.members, request.fields):
+                split[i] = _select_fields(res, fields)
+        return split
+
+
+def _select_fields(res, fields):
+    if not isinstance(res, dict) or 'features' not in res:
+        # an error: every query gets it
+        return res
+    names = {f.lower() for f in fields}
+    features = [
+        dict(feature, attributes={
+            k: v for k, v in feature.get('attributes', {}).items() if k.lower() in names})
+        for feature in res['features']]
+    return dict(res, features=features)
+
+
+def _statistics(query):
+    '''The outStatistics of query if it can be merged, None otherwise'''
+    params = query.params
+    if query.type != 'arcgis' or not isinstance(params, dict) or 'outStatistics' not in params:
+        return None
+    if query.stream:
+        # its result is already mapped records
+        return None
+    if params.get('groupByFieldsForStatistics'):
+        return None
+    stats = params['outStatistics']
+    if isinstance(stats, str):
+        try:
+            stats = json.loads(stats)
+        except ValueError:
+            return None
+    if not isinstance(stats, list) or not all(isinstance(s, dict) and s.get('outStatisticFieldName')
+                                              for s in stats):
+        return None
+    return stats
+
+
+def _group_key(query, ignore):
+    params = {k: v for k, v in query.params.items() if k not in ignore}
+    return (query.url, (query.method or 'GET').upper(), json.dumps(params, sort_keys=True, default=str))
+
+
+def _unique_names(stats_list):
+    names = [s['outStatisticFieldName'].lower() for stats in stats_list for s in stats]
+    return len(names) == len(set(names))
+
+
+def _merge(queries, indices, stats_list, conditional=False):
+    first = queries[indices[0]]
+    if conditional:
+        wheres = [str(queries[i].params.get('where', '1=1')) for i in indices]
+        merged_stats = [
+            _conditional_statistic(s, where)
+            for stats, where in zip(stats_list, wheres) for s in stats]
+        params = dict(first.params, where=' OR '.join('({})'.format(w) for w in wheres))
+    else:
+        params = dict(first.params)
+        merged_stats = [s for stats in stats_list for s in stats]
+    # as JSON, the expressions have quotes in them
+    params['outStatistics'] = json.dumps(merged_stats)
+
+    query = replace(first, params=params, desc=' + '.join(queries[i].desc or '' for i in indices))
+    fields = [[s['outStatisticFieldName'] for s in stats] for stats in stats_list]
+    return Request(query, list(indices), fields)
+
+
+def _conditional_statistic(stat, where):
+    field = stat['onStatisticField']
+    if stat['statisticType'].lower() == 'count':
+        # count doesn't count null values
+        value = "CASE WHEN ({}) AND {} IS NOT NULL THEN 1 ELSE 0 END".format(where, field)
+    else:
+        value = "CASE WHEN ({}) THEN {} ELSE 0 END".format(where, field)
+    return {'statisticType': 'sum', 'onStatisticField': value,
+            'outStatisticFieldName': stat['outStatisticFieldName']}
+
+
+def plan_queries(queries, conditional=False):
+    '''Returns a QueryPlan for queries, or None if nothing can be merged'''
+    stats = [_statistics(q) for q in queries]
+
+    # group the mergeable queries by everything that has to be the same
+    ignore = ['outStatistics', 'where'] if conditional else ['outStatistics']
+    groups = OrderedDict()
+    for i, query in enumerate(queries):
+        key = _group_key(query, ignore) if stats[i] is not None else ('query', i)
+        groups.setdefault(key, []).append(i)
+
+    requests = {}
+    for indices in groups.values():
+        group_stats = [stats[i] for i in indices]
+        if len(indices) == 1 or not _unique_names(group_stats):
+            continue
+        same_filter = len({str(queries[i].params.get('where')) for i in indices}) == 1
+        if same_filter:
+            requests[indices[0]] = _merge(queries, indices, group_stats)
+        elif all(s['statisticType'].lower() in CONDITIONAL_STATISTICS for st in group_stats for s in st):
+            requests[indices[0]] = _merge(queries, indices, group_stats, conditional=True)
+
+    if not requests:
+        return None
+
+    merged = {i for r in requests.values() for i in r.members}
+    plan = []
+    # in the order of the source queries, a merged request where its first member was
+    for i, query in enumerate(queries):
+        if i in requests:
+            plan.append(requests[i])
+        elif i not in merged:
+            plan.append(Request(query, [i]))
+    return QueryPlan(plan, len(queries))
+
+
+def plan_sources(sources, conditional=False):
+    '''Set the query plan of every source that has queries to merge'''
+    requests = 0
+    for source in sources.values():
+        source.plan = plan_queries(source.queries, conditional)
+        if source.plan:
+            requests += len(source.queries) - len(source.plan.requests)
+    if requests:
+        logging.info("Query planner: saving %d requests by merging statistics queries", requests)
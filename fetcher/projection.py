@@ -0,0 +1,128 @@
+'''
+Column projection: request only the fields the mapping uses.
+
+Most arcgis queries ask for `outFields: '*'`, and soda/ckan queries for every column,
+but only the fields in the state's mapping are used. `build_sources` rewrites those
+queries to ask for the mapped fields only (and no geometry for arcgis).
+
+A state's mapping covers all of its queries, so a query of a state with several queries
+would ask for the fields of the other ones too, which servers reject. Those queries are
+projected only when they ask for it with `project: true`. When a server rejects the
+projected fields (HTTP 400, or 409 and `success: false` for ckan), the query is fetched
+again with its original params, and a warning says to set `project: false` for it.
+
+Extras handlers can read columns that aren't in the mapping, so queries of states with
+a handler are projected only with `project: true`, and `project: false` turns it off
+for any query.
+'''
+
+from dataclasses import replace
+import logging
+import urllib.error
+
+from fetcher.utils import Mapping
+
+
+# HTTP statuses of rejected fields: arcgis and soda answer 400, ckan 409
+REJECTED_STATUSES = (400, 409)
+
+
+def needed_fields(mapping):
+    if isinstance(mapping, Mapping):
+        return mapping.fields
+    return sorted(k.strip() for k in mapping if not k.startswith('__'))
+
+
+def project_params(query, fields):
+    '''The params of query, asking only for fields, or None if it can't be projected'''
+    params = query.params
+    if not fields or not isinstance(params, dict):
+        return None
+
+    if query.type == 'arcgis':
+        if any(params.get(p) for p in ['outStatistics', 'returnCountOnly', 'returnIdsOnly']):
+            return None
+        out_fields = [f.strip() for f in str(params.get('outFields', '*')).split(',')]
+        if '*' not in out_fields:
+            return None
+        # keep the expressions (e.g. 'Value as positive') next to the '*', their
+        # names aren't layer fields
+        aliases = {f.split()[-1] for f in out_fields if ' as ' in f.lower()}
+        projected = []
+        for f in out_fields:
+            projected.extend([x for x in fields if x not in aliases] if f == '*' else [f])
+        return dict(params, outFields=','.join(dict.fromkeys(projected)),
+                    returnGeometry=params.get('returnGeometry', 'false'))
+
+    if query.type == 'soda':
+        if any(p in params for p in ['$select', '$query', '$group']):
+            return None
+        return dict(params, **{'$select': ','.join(fields)})
+
+    if query.type == 'ckan':
+        if not query.url.rstrip('/').endswith('datastore_search') or 'fields' in params:
+            return None
+        return dict(params, fields=','.join(fields))
+
+    return None
+
+
+def project_source(source):
+    '''Rewrite the params of the queries of source to ask for the mapped fields only'''
+    fields = needed_fields(source.mapping)
+    projected = 0
+    # the mapping covers all the queries: with several of them, every query would ask for
+    # the fields of the others as well
+    default = not source.extras and len(source.queries) == 1
+    for i, query in enumerate(source.queries):
+        enabled = query.project if query.project is not None else default
+        if not enabled:
+            continue
+        params = project_params(query, fields)
+        if params:
+            source.queries[i] = replace(query, params=params, full_params=query.params)
+            projected += 1
+    return projected
+
+
+def _rejected(query, res):
+    if not isinstance(res, dict):
+        return False
+    if query.type == 'arcgis':
+        return 'error' in res
+    if query.type == 'ckan':
+        return res.get('success') is False
+    return False
+
+
+def fetch_projected(query, fetch):
+    '''Fetch a query, falling back to its original params if the projection is rejected'''
+    if query.full_params is None:
+        return fetch(query)
+    try:
+        res = fetch(query)
+        if not _rejected(query, res):
+            return res
+    except urllib.error.HTTPError as e:
+        if e.code not in REJECTED_STATUSES:
+            raise
+    logging.warning("Projected fields were rejected for %s, set `project: false` for it", query.url)
+    return fetch(replace(query, params=query.full_params, full_params=None))
+
+
+async def fetch_projected_async(query, fetch):
+    '''asyncio equivalent of fetch_projected, fetch is a coroutine function'''
+    # imported here to not force it as a dependency if not using this engine
+    import aiohttp
+
+    if query.full_params is None:
+        return await fetch(query)
+    try:
+        res = await fetch(query)
+        if not _rejected(query, res):
+            return res
+    except (urllib.error.HTTPError, aiohttp.ClientResponseError) as e:
+        if e.status not in REJECTED_STATUSES:
+            raise
+    logging.warning("Projected fields were rejected for %s, set `project: false` for it", query.url)
+    return await fetch(replace(query, params=query.full_params, full_params=None))
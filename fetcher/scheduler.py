@@ -0,0 +1,183 @@
+'''
+Host aware scheduling for requests.
+
+Most queries go to a handful of hosts (ArcGIS, SODA/CKAN portals, Tableau servers).
+When fetching in parallel, the scheduler makes sure we don't open too many
+concurrent requests to the same host, or send them too fast.
+
+Limits are configured by host pattern (fnmatch style), e.g.:
+    hosts:
+      default: {concurrency: 4}
+      'services*.arcgis.com': {concurrency: 8, rate: 20}
+
+concurrency: max number of requests in flight to a host
+rate: max number of requests per second to a host (null for no limit)
+'''
+
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from fnmatch import fnmatch
+import logging
+import threading
+import time
+import urllib.parse
+
+
+DEFAULT = 'default'
+
+
+class HostLimit:
+    '''Concurrency and rate limits of a single host, with queue wait stats'''
+
+    def __init__(self, host, concurrency=None, rate=None):
+        self.host = host
+        self.concurrency = concurrency
+        self.rate = rate
+        self._semaphore = threading.BoundedSemaphore(concurrency) if concurrency else None
+        # created on first use, within the event loop of the asyncio engine, and again
+        # for the loop of the next dataset of the run (they're bound to their loop)
+        self._async_semaphore = None
+        self._async_loop = None
+        self._interval = 1.0 / rate if rate else 0
+        self._next_start = 0
+        self._lock = threading.Lock()
+
+        # stats
+        self.requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self):
+        start = time.monotonic()
+        if self._semaphore:
+            self._semaphore.acquire()
+
+        delay = self._reserve_start()
+        if delay > 0:
+            time.sleep(delay)
+
+        return self._record_wait(time.monotonic() - start)
+
+    def release(self):
+        if self._semaphore:
+            self._semaphore.release()
+
+    async def acquire_async(self):
+        '''Same as acquire, for the asyncio engine'''
+        start = time.monotonic()
+        if self.concurrency:
+            loop = asyncio.get_running_loop()
+            if self._async_loop is not loop:
+                self._async_semaphore = asyncio.Semaphore(self.concurrency)
+                self._async_loop = loop
+            await self._async_semaphore.acquire()
+
+        delay = self._reserve_start()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        return self._record_wait(time.monotonic() - start)
+
+    def release_async(self):
+        if self._async_semaphore:
+            self._async_semaphore.release()
+
+    def _reserve_start(self):
+        '''Reserve the next start time allowed by the rate limit, returning how long to wait for it'''
+        if not self._interval:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_start)
+            self._next_start = slot + self._interval
+        return slot - now
+
+    def _record_wait(self, wait):
+        with self._lock:
+            self.requests += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return wait
+
+
+class HostScheduler:
+    def __init__(self, hosts=None):
+        hosts = dict(hosts or {})
+        self.default = dict(hosts.pop(DEFAULT, None) or {})
+        # keep config order: first matching pattern wins
+        self.patterns = OrderedDict((k, dict(v or {})) for k, v in hosts.items())
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def host_of(url):
+        return urllib.parse.urlsplit(url).hostname or ''
+
+    def limit_for(self, host):
+        with self._lock:
+            limit = self._hosts.get(host)
+            if limit is None:
+                conf = self.default
+                for pattern, pattern_conf in self.patterns.items():
+                    if fnmatch(host, pattern):
+                        conf = pattern_conf
+                        break
+                limit = HostLimit(host, conf.get('concurrency'), conf.get('rate'))
+                self._hosts[host] = limit
+        return limit
+
+    @contextmanager
+    def slot(self, url):
+        '''Wait until a request to url's host is allowed, and hold it until done'''
+        limit = self.limit_for(self.host_of(url))
+        limit.acquire()
+        try:
+            yield
+        finally:
+            limit.release()
+
+    @asynccontextmanager
+    async def async_slot(self, url):
+        '''Same as slot, for the asyncio engine'''
+        limit = self.limit_for(self.host_of(url))
+        await limit.acquire_async()
+        try:
+            yield
+        finally:
+            limit.release_async()
+
+    def interleave(self, queries):
+        '''Returns the indices of queries, ordered round-robin by host
+
+        Submitting in this order means that a slow or limited host doesn't
+        hold back the queries that go to other hosts
+        '''
+        by_host = OrderedDict()
+        for i, query in enumerate(queries):
+            by_host.setdefault(self.host_of(query.url), []).append(i)
+
+        order = []
+        queues = list(by_host.values())
+        while queues:
+            for q in queues:
+                order.append(q.pop(0))
+            queues = [q for q in queues if q]
+        return order
+
+    def stats(self):
+        return {
+            host: {
+                'requests': limit.requests,
+                'total_wait': limit.total_wait,
+                'max_wait': limit.max_wait,
+                'mean_wait': limit.total_wait / limit.requests if limit.requests else 0.0,
+            } for host, limit in self._hosts.items()
+        }
+
+    def report(self):
+        '''Log queue wait time per host, to help tuning the limits'''
+        stats = sorted(self.stats().items(), key=lambda x: x[1]['total_wait'], reverse=True)
+        for host, s in stats:
+            logging.info("Host %s: %d requests, waited %.2fs total, %.2fs mean, %.2fs max",
+                         host, s['requests'], s['total_wait'], s['mean_wait'], s['max_wait'])
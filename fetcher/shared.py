@@ -0,0 +1,170 @@
+'''
+Responses shared between datasets fetched in the same run.
+
+The datasets (states, backfill, positivity, races) query many of the same URLs: the
+same ArcGIS FeatureServers, the same state pages. When several datasets are fetched
+in one run (see `fetcher.lib.run_datasets`), their queries are planned together, and
+every request that more than one query makes is sent once: its response is kept in
+memory until all the queries that planned it are done fetching, and then dropped.
+
+The plan is on the URLs of the queries as they're written, and fetching can make other
+requests instead (pagination, aggregates, projection): a query that doesn't make its
+planned request releases it all the same when it's done (see done), and the queries a
+dataset never got to (after a failure) are released when the dataset is done (see finish).
+
+Requests are identified by method and URL (including the query params), the same way
+the run client sends them, so each dataset still parses the response on its own.
+'''
+
+import asyncio
+from collections import Counter
+import logging
+import threading
+
+from fetcher.source_utils import NETWORK_QUERY_TYPES
+from fetcher.utils import build_url
+
+
+# Query types whose params are URL params, the others (pandas) use them differently
+URL_PARAMS_QUERY_TYPES = ['arcgis', 'json', 'ckan', 'soda', 'csv', 'html', 'html:soup']
+# Query types fetched with the run client. tableau has its own client, so it's not shared
+SHARED_QUERY_TYPES = [t for t in NETWORK_QUERY_TYPES if t != 'tableau']
+
+
+def request_key(method, url):
+    return ((method or 'GET').upper(), url)
+
+
+def query_key(query):
+    '''The request key of query, or None if it's not made with the run client'''
+    if query.type not in SHARED_QUERY_TYPES:
+        return None
+    if query.type in URL_PARAMS_QUERY_TYPES:
+        method = query.method if query.type in ['arcgis', 'json', 'ckan', 'soda'] else None
+        return request_key(method, build_url(query.url, query.params))
+    return request_key(None, query.url)
+
+
+class SharedResponses:
+    def __init__(self, uses):
+        '''
+        uses: request key -> number of queries making it. Only requests made more than
+            once are kept
+        '''
+        self._uses = {key: n for key, n in uses.items() if n > 1}
+        self._responses = {}
+        self._locks = {key: threading.Lock() for key in self._uses}
+        # created on the event loop that uses them (see get_async)
+        self._async_locks = {}
+        self._async_loop = None
+        # number of planned queries done since the last dataset finished (see finish)
+        self._done = Counter()
+        self._lock = threading.Lock()
+        self.stats = {'fetched': 0, 'shared': 0}
+
+    @classmethod
+    def plan(cls, sources):
+        '''Count the requests made by the queries of all sources (of all datasets)'''
+        uses = Counter()
+        for source in sources:
+            for query in source.fetch_queries:
+                key = query_key(query)
+                if key:
+                    uses[key] += 1
+        shared = cls(uses)
+        logging.info("Planned %d requests, %d of them are shared by several queries (%d queries)",
+                     len(uses), len(shared._uses), sum(shared._uses.values()))
+        return shared
+
+    def wants(self, method, url):
+        return request_key(method, url) in self._locks
+
+    def get(self, method, url, fetch):
+        '''Returns the response of the request, calling fetch() only the first time
+
+        Concurrent calls for the same request wait for the first one
+        '''
+        key = request_key(method, url)
+        lock = self._locks.get(key)
+        if lock is None:
+            return fetch()
+
+        with lock:
+            res = self.take(method, url)
+            if res is not None:
+                return res
+            res = fetch()
+            self.put(method, url, res)
+            return res
+
+    async def get_async(self, method, url, fetch):
+        '''asyncio equivalent of get, fetch is a coroutine function'''
+        key = request_key(method, url)
+        if key not in self._locks:
+            return await fetch()
+
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            # every dataset of the run has its own loop, and the locks are bound to theirs
+            self._async_locks = {}
+            self._async_loop = loop
+        lock = self._async_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            res = self.take(method, url)
+            if res is not None:
+                return res
+            res = await fetch()
+            self.put(method, url, res)
+            return res
+
+    def take(self, method, url):
+        '''Returns the kept response of the request, or None'''
+        key = request_key(method, url)
+        with self._lock:
+            res = self._responses.get(key)
+            if res is None:
+                return None
+            self.stats['shared'] += 1
+        return res
+
+    def put(self, method, url, res):
+        '''Keep the response of a request that was just made, for the next queries that make it'''
+        key = request_key(method, url)
+        with self._lock:
+            self.stats['fetched'] += 1
+            if key in self._uses:
+                self._responses[key] = res
+
+    def done(self, query):
+        '''A planned query is done fetching (whether it made its planned request or not)'''
+        key = query_key(query)
+        with self._lock:
+            if key in self._uses:
+                self._done[key] += 1
+                self._use(key)
+
+    def finish(self, sources):
+        '''The queries of sources (the states of a dataset) are done fetching: release the
+        requests they planned but never got to, e.g. the queries after a failed one
+
+        Datasets are fetched one after the other, so the queries done since the last
+        finish are the queries of sources
+        '''
+        planned = Counter(query_key(query) for source in sources for query in source.fetch_queries)
+        with self._lock:
+            for key, n in planned.items():
+                for _ in range(n - self._done[key]):
+                    if key not in self._uses:
+                        break
+                    self._use(key)
+            self._done.clear()
+
+    def _use(self, key):
+        self._uses[key] -= 1
+        if self._uses[key] <= 0:
+            # no more queries need it
+            self._responses.pop(key, None)
+            del self._uses[key]
+
+    def report(self):
+        logging.info("Shared responses: %(fetched)d fetched, %(shared)d reused", self.stats)
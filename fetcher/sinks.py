@@ -0,0 +1,234 @@
+'''Where the output of a dataset is written
+
+A sink is written with the frame of a dataset, or with the frames of its states one
+after the other (see build_dataframe_chunks in fetcher.lib), and closed once all of
+them are written, or when writing them failed (used as a context manager).
+'''
+
+from datetime import datetime
+import gzip
+import logging
+import os
+import shutil
+import time
+
+import pandas as pd
+
+from fetcher.utils import Fields
+
+
+STATE = Fields.STATE.name
+# partition of the Parquet output, the day of the run
+FETCH_DATE = 'FETCH_DATE'
+FORMATS = ['csv', 'parquet']
+
+
+# extension of the CSV files by compression
+CSV_COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def csv_names(filename, compression=None):
+    '''The timestamped and the latest CSV files of the output'''
+    ext = '.csv' + CSV_COMPRESSIONS[compression or 'none']
+    return ['{}_{}{}'.format(filename, datetime.now().strftime('%Y%m%d%H%M%S'), ext), filename + ext]
+
+
+class Sink:
+    '''Written with frames, and closed when done (or when writing failed)'''
+
+    def write(self, df):
+        raise NotImplementedError
+
+    def close(self, complete=True):
+        '''complete: whether all the frames were written'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
+
+
+def _open_text(name, compression):
+    if compression == 'gzip':
+        return gzip.open(name, 'wt', newline='', encoding='utf-8')
+    if compression == 'zstd':
+        # imported here to not force it as a dependency if not compressing with zstd
+        import zstandard
+        return zstandard.open(name, 'wt', newline='', encoding='utf-8')
+    return open(name, 'w', newline='', encoding='utf-8')
+
+
+def _derive(source, name):
+    '''Replace name with the content of source (a hard link, or a copy where links aren't
+    supported), atomically: readers see the previous file or the new one'''
+    tmp = name + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(source, tmp)
+        how = 'Linked'
+    except OSError:
+        shutil.copyfile(source, tmp)
+        how = 'Copied'
+    os.replace(tmp, name)
+    return how
+
+
+class CsvSink(Sink):
+    '''The output as CSV, serialized once to {output}_{timestamp}.csv and linked to
+    {output}.csv once it's complete (see csv_names). Compressed with gzip or zstd while
+    it's written, if asked to.
+    '''
+
+    def __init__(self, names, compression=None):
+        self.names = names
+        self.compression = compression or 'none'
+        if self.compression not in CSV_COMPRESSIONS:
+            raise ValueError("Unknown CSV compression {}, expected one of {}".format(
+                compression, list(CSV_COMPRESSIONS)))
+        self.file = None
+        self.seconds = 0
+
+    def write(self, df):
+        start = time.perf_counter()
+        header = self.file is None
+        if self.file is None:
+            self.file = _open_text(self.names[0], self.compression)
+        df.to_csv(self.file, header=header)
+        # readers see every frame once it's written
+        self.file.flush()
+        self.seconds += time.perf_counter() - start
+
+    def close(self, complete=True):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        written = self.names[0]
+        logging.info("Wrote %s: %d bytes in %.2fs", written, os.path.getsize(written), self.seconds)
+        if not complete:
+            # the latest files are left as they were
+            logging.warning("Writing %s failed, not updating %s", written, ', '.join(self.names[1:]) or 'others')
+            return
+        for name in self.names[1:]:
+            start = time.perf_counter()
+            how = _derive(written, name)
+            logging.info("%s %s: %d bytes in %.3fs", how, name, os.path.getsize(name), time.perf_counter() - start)
+
+
+def _arrow_columns(df):
+    '''df, with the object columns that mix numbers and text (which Arrow can't type) as text'''
+    for c in df.columns:
+        if df[c].dtype == object and pd.api.types.infer_dtype(df[c], skipna=True) in ('mixed', 'mixed-integer'):
+            df[c] = df[c].where(df[c].isna(), df[c].astype(str))
+    return df
+
+
+class ParquetSink(Sink):
+    '''The output as a Parquet dataset, partitioned by STATE and by the day of the run:
+        {root}/STATE=CA/FETCH_DATE=2020-10-01/part-0.parquet
+
+    A run replaces the partitions of the day of the states it writes, so the dataset has
+    the last run of every day. Columns keep their dtypes (see `dtypes` of the datasets).
+    '''
+
+    def __init__(self, root, compression='zstd', fetch_date=None):
+        # imported here to not force it as a dependency when not writing parquet,
+        # and to fail before fetching when it's missing
+        import pyarrow.parquet  # noqa: F401
+
+        self.root = root
+        self.compression = compression or 'none'
+        self.fetch_date = fetch_date or datetime.now().strftime('%Y-%m-%d')
+        self.size = 0
+        self.seconds = 0
+
+    def write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        def written(f):
+            self.size += os.path.getsize(f.path)
+
+        start = time.perf_counter()
+        df = _arrow_columns(df.reset_index())
+        df[FETCH_DATE] = self.fetch_date
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_to_dataset(
+            table, self.root, partition_cols=[STATE, FETCH_DATE], compression=self.compression,
+            basename_template='part-{i}.parquet', existing_data_behavior='delete_matching', file_visitor=written)
+        self.seconds += time.perf_counter() - start
+
+    def close(self, complete=True):
+        logging.info("Wrote %s: %d bytes in %.2fs", self.root, self.size, self.seconds)
+
+
+def save_df_to_db(db_config, df):
+    # verify again that we should store to db
+    if not db_config.store:
+        return
+
+    print("Storing to DB {db_name}.{table}".format(**db_config))
+
+    # import it here to not force it as a dependency if not storing anywhere
+    from sqlalchemy import create_engine
+
+    renames = Fields.map()
+    df.rename(columns=renames, inplace=True)
+    df.index.rename([renames[x] for x in df.index.names], inplace=True)
+    engine_conf = "{driver}://{username}:{password}@{host}:{port}/{db_name}".format(
+        **db_config)
+    engine = create_engine(engine_conf)
+    df.to_sql(db_config.table, engine, if_exists='append', chunksize=200, method='multi')
+
+
+class DbSink(Sink):
+    '''The output appended to the dataset's DB table'''
+
+    def __init__(self, db_config):
+        self.db_config = db_config
+
+    def write(self, df):
+        # the columns are renamed for the DB, not in the frame of the other sinks
+        df = df.copy(deep=False)
+        df.index = df.index.copy()
+        save_df_to_db(self.db_config, df)
+
+
+def open_sinks(cfg):
+    '''The sinks of the output of the dataset of cfg: the files of `output_format`, and the
+    DB when the dataset stores to it'''
+    formats = cfg.get('output_format') or ['csv']
+    formats = formats.split(',') if isinstance(formats, str) else list(formats)
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError("Unknown output formats {}, expected some of {}".format(sorted(unknown), FORMATS))
+
+    sinks = []
+    if cfg.output and 'csv' in formats:
+        compression = (cfg.get('csv') or {}).get('compression')
+        sinks.append(CsvSink(csv_names(cfg.output, compression), compression))
+    if cfg.output and 'parquet' in formats:
+        parquet = cfg.get('parquet') or {}
+        sinks.append(ParquetSink('{}_parquet'.format(cfg.output), parquet.get('compression', 'zstd')))
+    if 'db' in cfg.dataset and cfg.dataset.db.store:
+        sinks.append(DbSink(cfg.dataset.db))
+    logging.debug("Writing the output to %s", [type(s).__name__ for s in sinks])
+    return sinks
+
+
+def split_stream_sinks(cfg, sinks):
+    '''The sinks of the output when streaming it (see `stream` in config.yaml), as (stream, final):
+    the sinks the states are written to as soon as they're parsed, and the ones that are written
+    once all of them are.
+
+    Parquet and the DB have the same rows when they get the states one by one (the DB gets no
+    rows for states without data); the CSV files need all the states (sorted and reindexed by
+    state), and {output}_stream.csv gets the rows of the states as they come instead.
+    '''
+    final = [sink for sink in sinks if isinstance(sink, CsvSink)]
+    stream = [sink for sink in sinks if not isinstance(sink, CsvSink)]
+    if final:
+        stream.insert(0, CsvSink(['{}_stream.csv'.format(cfg.output)]))
+    return stream, final
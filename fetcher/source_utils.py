@@ -1,55 +1,120 @@
-from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import inspect
 import logging
 import typing
 
+import numpy as np
+import pandas as pd
+
+from fetcher.aggregate import fetch_aggregated
+from fetcher.arcgis import fetch_arcgis
+from fetcher.client import current_client
+from fetcher.projection import fetch_projected
+from fetcher.streaming import extracted_records, request_and_extract
 from fetcher.utils import Fields, request, request_and_parse, request_csv, request_soup, \
     request_pandas, request_tableau_scraper, extract_attributes, extract_arcgis_attributes
 
 
 MS_FILTER = datetime(2019, 12, 30, 0, 0).timestamp() * 1000
+# Types of epoch timestamps (s or ms) that are converted once per value
+EPOCH_TYPES = {int, float, np.int64, np.int32, np.float64}
+# Query types that make a request to query.url
+NETWORK_QUERY_TYPES = [
+    'arcgis', 'json', 'ckan', 'soda', 'csv', 'html', 'html:soup', 'pandas', 'xls', 'xlsx', 'tableau']
 # Indices
 TS = 'TIMESTAMP'
 STATE = Fields.STATE.name
 
 
-def fetch_query(state, query):
-    # TODO: make a better mapping here
-    res = None
+def fetch_query(state, query, scheduler=None, mapping=None):
+    '''Fetch a single query
+
+    scheduler: an optional HostScheduler, limiting concurrent requests per host
+    mapping: the source mapping, needed for streamed queries (see fetcher.streaming)
+    '''
+    def fetch(query):
+        return fetch_projected(query, lambda q: _fetch_query(q, scheduler, mapping))
+
     try:
-        if query.type in ['arcgis', 'json', 'ckan', 'soda']:
-            res = request_and_parse(query.url, query.params, query.method)
-        elif query.type in ['csv']:
-            res = request_csv(
-                query.url, query.params,
-                header=query.header, encoding=query.encoding)
-        elif query.type in ['html']:
-            res = request(query.url, query.params, query.encoding)
-        elif query.type in ['html:soup']:
-            res = request_soup(query.url, query.params, query.encoding)
-        elif query.type in ['pandas', 'xls', 'xlsx']:
-            res = request_pandas(query)
-        elif query.type.lower() in ['tableau']:
-            # The thing I tried so hard to avoid
-            res = request_tableau_scraper(query)
-        else:
-            # the default is to send the URL as is
-            # TODO: It's used for something, but it's not great
-            res = query.url
+        res = fetch_aggregated(query, fetch) if query.aggregate else fetch(query)
     except Exception:
         logging.error("{}: Failed to fetch {}".format(state, query.url), exc_info=True)
         raise
+    finally:
+        release_shared(query)
+
+    return res
+
+
+def release_shared(query):
+    '''Let go of the shared response query planned (see fetcher.shared)'''
+    client = current_client()
+    if client and client.shared:
+        client.shared.done(query)
+
+
+def _fetch_query(query, scheduler=None, mapping=None):
+    if query.type == 'arcgis':
+        # it can take several requests (pages), each one waits for its own slot
+        return fetch_arcgis(query, scheduler, mapping)
+    if scheduler and query.type in NETWORK_QUERY_TYPES:
+        with scheduler.slot(query.url):
+            return _request_query(query, mapping)
+    return _request_query(query, mapping)
+
+
+def _request_query(query, mapping=None):
+    # TODO: make a better mapping here
+    res = None
+    if query.type in ['arcgis']:
+        res = fetch_arcgis(query, mapping=mapping)
+    elif query.stream:
+        res = request_and_extract(query, query.params, mapping)
+    elif query.type in ['json', 'ckan', 'soda']:
+        res = request_and_parse(query.url, query.params, query.method)
+    elif query.type in ['csv']:
+        res = request_csv(
+            query.url, query.params,
+            header=query.header, encoding=query.encoding)
+    elif query.type in ['html']:
+        res = request(query.url, query.params, query.encoding)
+    elif query.type in ['html:soup']:
+        res = request_soup(query.url, query.params, query.encoding)
+    elif query.type in ['pandas', 'xls', 'xlsx']:
+        res = request_pandas(query)
+    elif query.type.lower() in ['tableau']:
+        # The thing I tried so hard to avoid
+        res = request_tableau_scraper(query)
+    else:
+        # the default is to send the URL as is
+        # TODO: It's used for something, but it's not great
+        res = query.url
 
     return res
 
 
-def fetch_source(source):
-    results = []
+def fetch_source(source, workers=1, scheduler=None):
+    '''Fetch all the queries of a source, returning the results in query order
+
+    workers: number of queries to run concurrently. Results are always in the
+        same order as `source.queries`, because extras handlers index them by position
+    scheduler: an optional HostScheduler, limiting concurrent requests per host
+    '''
+    queries = source.fetch_queries
+    if workers <= 1 or len(queries) <= 1:
+        return source.split_results([
+            fetch_query(source.name, query, scheduler, mapping=source.mapping) for query in queries])
 
-    for query in source.queries:
-        res = fetch_query(source.name, query)
-        results.append(res)
-    return results
+    # submit queries round-robin by host, so a busy host doesn't hold back the others
+    order = scheduler.interleave(queries) if scheduler else range(len(queries))
+    with ThreadPoolExecutor(max_workers=min(workers, len(queries)),
+                            thread_name_prefix=source.name) as executor:
+        futures = {
+            i: executor.submit(fetch_query, source.name, queries[i], scheduler, mapping=source.mapping)
+            for i in order}
+        # Like the sequential version, the first failure fails the source
+        return source.split_results([futures[i].result() for i in range(len(queries))])
 
 
 def process_source_responses(source, results):
@@ -63,7 +128,10 @@ def process_source_responses(source, results):
     else:
         for i, result in enumerate(results):
             query = source.queries[i]
-            if query.type == 'arcgis':
+            if query.stream:
+                # already extracted while fetching
+                partial = extracted_records(query, result)
+            elif query.type == 'arcgis':
                 partial = extract_arcgis_attributes(result, source.mapping, source.name)
             else:
                 # This is a guess; getting an unknown top level object
@@ -89,54 +157,119 @@ def _aggregate_state_results(source, results):
     '''
     This function handles all the results (post-processing) from
     all queries to a single state.
-    Result is always a flat list of dictionary records
+    Result is a flat list of dictionary records, or a DataFrame when
+    an extras handler returned (some) DataFrames
     '''
 
     # special casing here for extras handling
-    if isinstance(results, typing.Dict):
+    if isinstance(results, (typing.Dict, pd.DataFrame)):
         # does it ever happen??
         results = [results]
 
     mapping = source.mapping
     state = source.name
     data = []
+    frames = []
 
     # all the stuff we need to append to the results
     timestamp = datetime.now()
+    dateformat = mapping.get('__strptime')
     for i, x in enumerate(results):
         constants = source.queries[i].constants if not source.extras else {}
         if constants is None:
             constants = {}
+        if isinstance(x, pd.DataFrame) and _needs_records(x, dateformat):
+            x = x.to_dict(orient='records')
+        if isinstance(x, pd.DataFrame):
+            x = _tag_frame(state, x, timestamp)
+            _update_frame_constants(x, constants)
+            if data:
+                frames.append(pd.DataFrame(data))
+                data = []
+            frames.append(x)
+            continue
         if isinstance(x, typing.Dict):
-            _tag_and_timestamp(state, x, timestamp, mapping.get('__strptime'))
-            _update_constants(x, constants)
-            data.append(x)
-        elif isinstance(x, typing.List):
-            for record in x:
-                _tag_and_timestamp(state, record, timestamp, mapping.get('__strptime'))
-                _update_constants(record, constants)
-                data.append(record)
+            x = [x]
+        if isinstance(x, typing.List):
+            _tag_and_timestamp_all(state, x, timestamp, dateformat)
+            if constants:
+                for record in x:
+                    _update_constants(record, constants)
+            data.extend(x)
         else:
             # should not happen
             logging.warning("Unexpected type in results: %r", x)
 
-    return data
+    if not frames:
+        return data
+    if data:
+        frames.append(pd.DataFrame(data))
+    return pd.concat(frames, ignore_index=True)
 
 
-def _tag_and_timestamp(state, data, timestamp, dateformat=None):
-    data[Fields.FETCH_TIMESTAMP.name] = timestamp
-    data[STATE] = state
-
-    # we should also make sure that the timestamp field is datetime format
-    # or parse the Date field
-    if TS in data and data[TS]:
-        # Check whether it's s or ms and convert to datetime
-        ts = data[TS]
-        if not isinstance(ts, datetime) or not isinstance(ts, date):
-            data[TS] = datetime.fromtimestamp(ts/1000 if ts > MS_FILTER else ts)
-    elif 'DATE' in data and data['DATE'] and dateformat:
-        d = data['DATE']
-        data[TS] = d if isinstance(d, datetime) else datetime.strptime(d, dateformat)
-    else:
-        # TODO: Should I add now time?
-        pass
+def _needs_records(df, dateformat=None):
+    '''Whether a frame is processed as records: when its TIMESTAMP needs converting
+    (see _tag_and_timestamp_all), or when columns were renamed to the same name'''
+    if not df.columns.is_unique:
+        return True
+    if TS in df.columns:
+        return not pd.api.types.is_datetime64_any_dtype(df[TS])
+    return bool(dateformat) and 'DATE' in df.columns
+
+
+def _tag_frame(state, df, timestamp):
+    '''Tag a frame with the state and fetch timestamp, as columns'''
+    # don't add columns to the handler's frame
+    df = df.copy(deep=False)
+    df[Fields.FETCH_TIMESTAMP.name] = timestamp
+    df[STATE] = state
+    return df
+
+
+def _update_frame_constants(df, updates):
+    '''_update_constants for a DataFrame'''
+    for k, v in updates.items():
+        if isinstance(v, str) and v.startswith("$"):
+            copy_key = v[1:]
+            df[k] = df[copy_key] if copy_key in df.columns else None
+        else:
+            df[k] = v
+
+
+def _tag_and_timestamp_all(state, records, timestamp, dateformat=None):
+    '''Tag the records with the state and fetch timestamp, and make sure TIMESTAMP
+    is a datetime: converted from an epoch in s or ms, or parsed from DATE
+
+    A state's records are a few timeseries over the same days, so each distinct
+    epoch is converted (and each distinct date parsed) once, for all the records
+    that have it.
+    '''
+    converted = {}
+    parsed = {}
+    fetch_ts = Fields.FETCH_TIMESTAMP.name
+    for data in records:
+        data[fetch_ts] = timestamp
+        data[STATE] = state
+        ts = data.get(TS)
+        if ts:
+            if isinstance(ts, datetime):
+                continue
+            if ts.__class__ not in EPOCH_TYPES:
+                # not a number, fails the same way it always did
+                data[TS] = datetime.fromtimestamp(ts/1000 if ts > MS_FILTER else ts)
+                continue
+            local = converted.get(ts)
+            if local is None:
+                local = converted[ts] = datetime.fromtimestamp(ts/1000 if ts > MS_FILTER else ts)
+            data[TS] = local
+        elif dateformat:
+            d = data.get('DATE')
+            if not d:
+                continue
+            if isinstance(d, datetime):
+                data[TS] = d
+                continue
+            local = parsed.get(d)
+            if local is None:
+                local = parsed[d] = datetime.strptime(d, dateformat)
+            data[TS] = local
@@ -10,6 +10,12 @@ import os
 from typing import List, Dict, Any
 import yaml
 
+from fetcher.aggregate import validate as validate_aggregate
+from fetcher.planner import plan_sources
+from fetcher.projection import project_source
+from fetcher.streaming import validate as validate_stream
+from fetcher.utils import Mapping, compile_data_path
+
 
 def _read_yaml(parent_dir, filename):
     content = yaml.load(open(os.path.join(parent_dir, filename), 'r'), Loader=yaml.SafeLoader)
@@ -29,7 +35,13 @@ def _read_extras(extras_module_name, keys):
     return extras
 
 
-def build_sources(url_file, mappings_file, extras_module=None):
+def build_sources(url_file, mappings_file, extras_module=None, coalesce=False, conditional=False,
+                  project=False):
+    '''
+    project: rewrite queries to ask only for the fields in the mapping (see fetcher.projection)
+    coalesce: merge ArcGIS statistics queries to the same layer (see fetcher.planner)
+    conditional: merge them even when their filters differ, into conditional statistics
+    '''
     sources_raw = _read_yaml(".", url_file)
     mappings = _read_yaml(".", mappings_file)
     extras = {}
@@ -43,11 +55,25 @@ def build_sources(url_file, mappings_file, extras_module=None):
             # need to rename "type" to 'query_type'
             q['query_type'] = q.pop('type')
             query = Query(**q)
+            # compiled once, the results of every run are extracted with it
+            compile_data_path(query.data_path)
+            if query.aggregate:
+                validate_aggregate(query)
             state_queries.append(query)
 
         extras_func = extras.get(state)
-        source = Source(state, state_queries, mapping=mappings.get(state, {}), extras=extras_func)
+        # compiled once, for all the records of the state
+        mapping = Mapping(mappings.get(state) or {})
+        source = Source(state, state_queries, mapping=mapping, extras=extras_func)
+        for query in state_queries:
+            if query.stream:
+                validate_stream(query, source)
+        if project:
+            project_source(source)
         sources[state] = source
+
+    if coalesce:
+        plan_sources(sources, conditional)
     return sources
 
 
@@ -62,6 +88,10 @@ class Query:
     header: bool = True  # Remove this, used only once, and maybe should be stripped
     encoding: str = None
     desc: str = ""
+    aggregate: dict = None  # field -> sum|count, see fetcher.aggregate
+    project: bool = None  # ask only for the mapped fields, see fetcher.projection
+    full_params: dict = None  # the params before the projection
+    stream: bool = False  # extract records while the response arrives, see fetcher.streaming
 
     @property
     def type(self):
@@ -75,3 +105,13 @@ class Source:
     queries: List[Query]
     mapping: Dict[str, str]
     extras: Any = None  # function
+    plan: Any = None  # QueryPlan, when some queries are merged into one request
+
+    @property
+    def fetch_queries(self):
+        '''The queries to fetch: the planned ones, or the source queries'''
+        return self.plan.queries if self.plan else self.queries
+
+    def split_results(self, results):
+        '''Results of fetch_queries, back to results of the source queries'''
+        return self.plan.split(results) if self.plan else results
@@ -0,0 +1,147 @@
+'''
+Streaming extraction of JSON responses.
+
+`request_and_parse` loads a whole response, and `_extract_attributes` walks it, so for
+large responses (backfill layers with years of daily rows) several copies of the data
+are in memory at once. A query with `stream: true` is parsed incrementally instead:
+its `data_path` is compiled into an ijson prefix, the objects at that prefix are built
+one at a time as the bytes arrive, and each one is mapped right away.
+
+    - url: .../FeatureServer/0/query
+      params: {where: 1=1, outFields: '*', f: json}
+      type: arcgis
+      stream: true
+
+The result of a streamed query is the list of mapped records (for arcgis, in the
+`features` of the response, so pagination works the same way).
+
+The path is followed up to its `[]` (or its first index), the rest of it is
+applied to each object the same way `extract_attributes` does. Unlike
+`extract_attributes`, keys missing before that point are not skipped: they select
+nothing. A path with a `[]` or an index after its first `[]` can't be streamed:
+`extract_attributes` returns a list per item for it, and the stream would return
+a single flat list. Streaming is for sources without an extras handler, since
+handlers get the raw responses.
+
+ijson is imported only when streaming, it's not needed otherwise.
+'''
+
+from io import BytesIO
+
+from fetcher.client import current_client
+from fetcher.utils import compile_data_path, request_stream
+
+
+STREAM_QUERY_TYPES = ['arcgis', 'json', 'ckan', 'soda']
+ARCGIS_PATH = ['features', [], 'attributes']
+SCALAR_EVENTS = ['null', 'boolean', 'integer', 'double', 'number', 'string']
+
+
+def compile_path(path):
+    '''Returns (prefix, index, rest)
+
+    prefix: the ijson prefix of the objects that path selects
+    index: select only the object at this index among them, None for all of them
+    rest: the rest of path, to apply to each selected object
+    '''
+    parts = []
+    end = 0
+    for i, step in enumerate(path):
+        if isinstance(step, list):
+            parts.append('item')
+            end = i + 1
+        elif isinstance(step, int):
+            parts.append('item')
+            return '.'.join(parts), step, list(path[i + 1:])
+        else:
+            parts.append(str(step))
+    # every step is a part of the prefix
+    return '.'.join(parts[:end]), None, list(path[end:])
+
+
+def is_nested(path):
+    '''Whether path has a [] or an index after its first [] (see validate)'''
+    each = False
+    for step in path:
+        if each and isinstance(step, (list, int)):
+            return True
+        each = each or isinstance(step, list)
+    return False
+
+
+def _tap_root(events, root):
+    '''Pass the events through, keeping the top level scalars (and error) in root'''
+    for prefix, event, value in events:
+        if event in SCALAR_EVENTS and prefix:
+            if '.' not in prefix:
+                root[prefix] = value
+            elif prefix.startswith('error.') and prefix.count('.') == 1:
+                root.setdefault('error', {})[prefix[len('error.'):]] = value
+        yield prefix, event, value
+
+
+def stream_extract(f, path, mapping, debug_state=None):
+    '''Extract the mapped records at path from the JSON in file object f
+
+    Returns (records, root): root has the top level scalar values of the response
+    (e.g. exceededTransferLimit), and its error, if there's one
+    '''
+    # imported here to not force it as a dependency if not streaming
+    import ijson
+
+    prefix, index, rest = compile_path(path)
+    extract = compile_data_path(rest)
+    root = {}
+    records = []
+    events = _tap_root(ijson.parse(f, use_float=True), root)
+    for i, item in enumerate(ijson.items(events, prefix)):
+        if index is not None and i != index:
+            continue
+        res = extract(item, mapping, debug_state)
+        if isinstance(res, list):
+            records.extend(res)
+        else:
+            records.append(res)
+    return records, root
+
+
+def request_and_extract(query, params, mapping, debug_state=None):
+    '''Stream a json query, returning its mapped records
+
+    arcgis queries return the response with the records in `features`
+    '''
+    verify = None if current_client() else False
+    with request_stream(query.url, params, query.method, verify=verify) as f:
+        return _extract(query, f, mapping, debug_state)
+
+
+def extract_body(query, body, mapping, debug_state=None):
+    '''Same as request_and_extract, for a body that was already read (bytes)'''
+    return _extract(query, BytesIO(body), mapping, debug_state)
+
+
+def _extract(query, f, mapping, debug_state):
+    path = ARCGIS_PATH if query.type == 'arcgis' else query.data_path
+    records, root = stream_extract(f, path, mapping, debug_state)
+    if query.type == 'arcgis':
+        return dict(root, features=records)
+    return records
+
+
+def validate(query, source):
+    '''Raises ValueError if query can't be streamed'''
+    if query.type not in STREAM_QUERY_TYPES:
+        raise ValueError("stream is not supported for {} queries ({})".format(query.type, query.url))
+    if source.extras:
+        raise ValueError("{}: stream is not supported with an extras handler ({})".format(
+            source.name, query.url))
+    if query.aggregate:
+        raise ValueError("stream and aggregate can't be used together ({})".format(query.url))
+    if query.type != 'arcgis' and is_nested(query.data_path):
+        raise ValueError("stream is not supported for a data_path with nested [] ({})".format(query.url))
+
+
+def extracted_records(query, result):
+    '''The records of a streamed query's result, like extract_attributes returns them'''
+    records = result.get('features', []) if query.type == 'arcgis' else result
+    return records[0] if len(records) == 1 else records
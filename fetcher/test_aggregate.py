@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from fetcher.aggregate import fetch_aggregated, pushdown, validate
+from fetcher.sources import Query
+
+
+def test_arcgis_pushdown():
+    query = Query("http://example.com/query", 'arcgis', {'where': 'x=1', 'outFields': '*', 'f': 'json'},
+                  aggregate={'vent': 'sum', 'FID': 'count'})
+    pushed = pushdown(query)
+    assert pushed.aggregate is None
+    assert pushed.params['where'] == 'x=1'
+    assert 'outFields' not in pushed.params
+    assert json.loads(pushed.params['outStatistics']) == [
+        {'statisticType': 'sum', 'onStatisticField': 'vent', 'outStatisticFieldName': 'vent'},
+        {'statisticType': 'count', 'onStatisticField': 'FID', 'outStatisticFieldName': 'FID'}]
+
+
+def test_soda_pushdown():
+    query = Query("http://example.com/a.json", 'soda', {'$where': 'x=1', '$limit': 10}, aggregate={'tests': 'sum'})
+    assert pushdown(query).params == {'$where': 'x=1', '$select': 'sum(tests) as tests'}
+
+    calls = []
+
+    def fetch(q):
+        calls.append(q)
+        return [{'tests': '1234'}]
+    assert fetch_aggregated(query, fetch) == [{'tests': 1234}]
+    assert len(calls) == 1
+    # full SoQL queries aren't rewritten
+    assert pushdown(Query("http://example.com/a.json", 'soda', {'$query': 'select *'}, aggregate={'a': 'sum'})) is None
+
+
+def test_local_fallback():
+    query = Query("http://example.com/query", 'arcgis', {'where': '1=1'}, aggregate={'vent': 'sum', 'id': 'count'})
+    calls = []
+
+    def fetch(q):
+        calls.append(q)
+        if 'outStatistics' in q.params:
+            return {'error': {'code': 400, 'message': 'Statistics not supported'}}
+        return {'features': [{'attributes': {'vent': v, 'id': i}} for i, v in enumerate([1, 2, None, 4])]}
+
+    assert fetch_aggregated(query, fetch) == {'features': [{'attributes': {'vent': 7, 'id': 4}}]}
+    assert len(calls) == 2
+    assert calls[1].params == {'where': '1=1'}
+
+
+def test_validate():
+    with pytest.raises(ValueError):
+        validate(Query("http://example.com/a.xlsx", 'xlsx', aggregate={'a': 'sum'}))
+    with pytest.raises(ValueError):
+        validate(Query("http://example.com/query", 'arcgis', aggregate={'a': 'avg'}))
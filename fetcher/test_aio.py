@@ -0,0 +1,145 @@
+import asyncio
+import json
+import socket
+import threading
+import types
+
+import pytest
+from omegaconf import OmegaConf
+
+from fetcher.scheduler import HostScheduler
+from fetcher.sources import Query, Source
+
+aiohttp = pytest.importorskip('aiohttp')
+web = pytest.importorskip('aiohttp.web')
+aio = pytest.importorskip('fetcher.aio')
+
+
+@pytest.fixture
+def server():
+    '''A local server answering json, csv and a failing endpoint'''
+    async def handle_json(request):
+        await asyncio.sleep(float(request.query.get('sleep', 0)))
+        return web.json_response({'features': [{'attributes': {'value': int(request.query['v'])}}]})
+
+    async def handle_csv(request):
+        return web.Response(text="a,b\n1,2\n3,4\n")
+
+    app = web.Application()
+    app.router.add_get('/json', handle_json)
+    app.router.add_get('/csv', handle_csv)
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.SockSite(runner, sock).start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    yield "http://127.0.0.1:{}".format(port)
+
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def test_fetch_states(server):
+    sources = {
+        'FOO': Source('FOO', [
+            Query(server + '/json', 'arcgis', params={'v': 1, 'sleep': 0.05}),
+            Query(server + '/json', 'arcgis', params={'v': 2}),
+            Query(server + '/csv', 'csv'),
+        ], mapping={'value': 'POSITIVE'}, extras=lambda res, mapping: [
+            {'POSITIVE': res[0]['features'][0]['attributes']['value']},
+            {'TOTAL': res[1]['features'][0]['attributes']['value']},
+            {'NEGATIVE': json.dumps(res[2])},
+        ]),
+        'BAR': Source('BAR', [Query(server + '/missing', 'json')], mapping={}),
+    }
+    fetcher = types.SimpleNamespace(
+        sources=sources, scheduler=HostScheduler(), workers=2, max_in_flight=10)
+
+    done = []
+    (ok_foo, res_foo, data_foo), (ok_bar, _, _) = aio.fetch_states(
+        fetcher, ['FOO', 'BAR'], lambda state, outcome: done.append((state, threading.current_thread().name)))
+
+    assert ok_foo and not ok_bar
+    assert [x.get('POSITIVE') for x in data_foo] == [1, None, None]
+    assert data_foo[1]['TOTAL'] == 2
+    assert json.loads(data_foo[2]['NEGATIVE']) == [{'a': '1', 'b': '2'}, {'a': '3', 'b': '4'}]
+    assert fetcher.scheduler.stats()['127.0.0.1']['requests'] == 4
+    # off the event loop, in the output thread
+    assert sorted(state for state, _ in done) == ['BAR', 'FOO']
+    assert all(name.startswith('output') for _, name in done)
+
+
+def test_failed_source_cancels_queries(monkeypatch):
+    cancelled = []
+
+    async def fetch_query(session, state, query, *args):
+        if query.url == 'slow':
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(query.url)
+                raise
+        raise ValueError('failed')
+
+    monkeypatch.setattr(aio, 'fetch_query_async', fetch_query)
+    source = Source('FOO', [Query('slow', 'json'), Query('failing', 'json')], mapping={})
+
+    async def fetch():
+        with pytest.raises(ValueError):
+            await aio.fetch_source_async(None, source)
+        # by the time the source failed
+        return list(cancelled)
+
+    assert asyncio.run(fetch()) == ['slow']
+
+
+def test_run_datasets(server, tmp_path, monkeypatch):
+    lib = pytest.importorskip('fetcher.lib')
+    urls = {
+        # the first query of FOO is the same in both datasets
+        'a': {'FOO': [{'url': server + '/json', 'params': {'v': 1}, 'type': 'arcgis'},
+                      {'url': server + '/json', 'params': {'v': 2}, 'type': 'arcgis'}],
+              'BAR': [{'url': server + '/json', 'params': {'v': 3}, 'type': 'arcgis'}]},
+        'b': {'FOO': [{'url': server + '/json', 'params': {'v': 1}, 'type': 'arcgis'},
+                      {'url': server + '/missing', 'type': 'json'}],
+              'BAR': [{'url': server + '/json', 'params': {'v': 4}, 'type': 'arcgis'}]},
+    }
+
+    mappings = {'FOO': {'value': 'POSITIVE'}, 'BAR': {'value': 'POSITIVE'}}
+
+    def dataset_config(cfg, name):
+        for part, content in [('urls', urls[name]), ('mappings', mappings)]:
+            with open(tmp_path / '{}_{}.json'.format(name, part), 'w') as f:
+                json.dump(content, f)
+        dataset_cfg = OmegaConf.merge(cfg, {'output': str(tmp_path / name), 'dataset': {
+            'name': name, 'sources_file': str(tmp_path / '{}_urls.json'.format(name)),
+            'mapping_file': str(tmp_path / '{}_mappings.json'.format(name)), 'extras_module': None,
+            'index': 'STATE', 'fields': ['POSITIVE'], 'db': {'store': False},
+            'dtypes': {'default': 'Int32', 'STATE': 'object'}}})
+        return dataset_cfg
+
+    monkeypatch.setattr(lib, 'dataset_config', dataset_config)
+    # a single request at a time: every dataset waits on the host limit, on its own loop
+    cfg = OmegaConf.create({
+        'state': ['FOO', 'BAR'], 'output_date_format': '%Y%m%d',
+        'fetch': {'engine': 'asyncio', 'hosts': {'default': {'concurrency': 1}}}})
+    planned = []
+    plan = lib.SharedResponses.plan
+    monkeypatch.setattr(lib.SharedResponses, 'plan', lambda sources: planned.append(plan(sources)) or planned[0])
+    lib.run_datasets(cfg, ['a', 'b'])
+
+    with open(tmp_path / 'a.csv') as f:
+        assert f.read().split() == ['STATE,POSITIVE', 'BAR,3', 'FOO,2']
+    # FOO failed in b
+    with open(tmp_path / 'b.csv') as f:
+        assert f.read().split() == ['STATE,POSITIVE', 'BAR,4', 'FOO,']
+    # made once, and not kept once both datasets are done
+    assert planned[0].stats == {'fetched': 1, 'shared': 1}
+    assert not planned[0]._responses and not planned[0]._uses
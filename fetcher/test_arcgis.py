@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+import fetcher.arcgis as arcgis
+from fetcher.scheduler import HostScheduler
+from fetcher.sources import Query
+
+
+def fake_layer(num_features, max_records, requests, pagination=True):
+    '''A request_and_parse for a layer with num_features features'''
+    def request_and_parse(url, params=None, method=None):
+        requests.append(dict(params))
+        if params.get('returnCountOnly'):
+            return {'count': num_features}
+        # without pagination, the offset is ignored
+        start = int(params.get('resultOffset', 0)) if pagination else 0
+        count = min(max_records, int(params.get('resultRecordCount') or max_records))
+        end = min(start + count, num_features)
+        ids = range(start, end)
+        if not params.get('orderByFields'):
+            # the server's order: not the same from one request to the other
+            ids = reversed(ids)
+        res = {'objectIdFieldName': 'id', 'features': [{'attributes': {'id': i}} for i in ids]}
+        if end < num_features:
+            res['exceededTransferLimit'] = True
+        return res
+    return request_and_parse
+
+
+def ids(res):
+    return [f['attributes']['id'] for f in res['features']]
+
+
+@pytest.mark.parametrize("scheduler", [None, HostScheduler({'default': {'concurrency': 2}})])
+def test_pages(monkeypatch, scheduler):
+    requests = []
+    monkeypatch.setattr(arcgis, 'request_and_parse', fake_layer(10, 3, requests))
+    res = arcgis.fetch_arcgis(Query("http://example.com/query", 'arcgis', {'where': '1=1'}), scheduler)
+
+    assert ids(res) == list(range(10))
+    assert 'exceededTransferLimit' not in res
+    # first page, count, then the first page again and the 3 other pages, ordered
+    assert len(requests) == 6
+    assert sorted(p.get('resultOffset', 0) for p in requests[2:]) == [0, 3, 6, 9]
+    assert all(p['orderByFields'] == 'id' for p in requests[2:])
+
+    # already ordered: the first page is used as is
+    requests.clear()
+    query = Query("http://example.com/query", 'arcgis', {'orderByFields': 'id'})
+    assert ids(arcgis.fetch_arcgis(query, scheduler)) == list(range(10))
+    assert len(requests) == 5
+
+
+def test_record_count_is_a_limit(monkeypatch):
+    requests = []
+    monkeypatch.setattr(arcgis, 'request_and_parse', fake_layer(10, 3, requests))
+
+    latest = arcgis.fetch_arcgis(Query("http://example.com/query", 'arcgis', {'resultRecordCount': 1}))
+    assert ids(latest) == [0]
+    assert len(requests) == 1
+
+    res = arcgis.fetch_arcgis(Query("http://example.com/query", 'arcgis', {'resultRecordCount': 7}))
+    assert ids(res) == list(range(7))
+
+
+def test_no_pagination(monkeypatch):
+    monkeypatch.setattr(arcgis, 'request_and_parse', fake_layer(10, 3, [], pagination=False))
+    with pytest.raises(ValueError):
+        arcgis.fetch_arcgis(Query("http://example.com/query", 'arcgis', {'where': '1=1'}))
+
+    # without ids in the features too
+    def no_ids(url, params=None, method=None):
+        res = fake_layer(10, 3, [], pagination=False)(url, params, method)
+        if 'features' in res:
+            res['features'] = [{'attributes': {'value': 1}} for _ in res['features']]
+        return res
+
+    monkeypatch.setattr(arcgis, 'request_and_parse', no_ids)
+    with pytest.raises(ValueError):
+        arcgis.fetch_arcgis(Query("http://example.com/query", 'arcgis', {'where': '1=1'}))
+
+
+def test_pages_async(monkeypatch):
+    requests = []
+    request_and_parse = fake_layer(10, 4, requests)
+
+    async def request_json(params):
+        await asyncio.sleep(0)
+        return request_and_parse("http://example.com/query", params)
+
+    query = Query("http://example.com/query", 'arcgis', {'where': '1=1'})
+    res = asyncio.run(arcgis.fetch_arcgis_async(query, request_json))
+    assert ids(res) == list(range(10))
+    assert requests[2]['orderByFields'] == 'id'
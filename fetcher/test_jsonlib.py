@@ -0,0 +1,33 @@
+import pytest
+
+from fetcher import jsonlib
+
+
+BODY = b'{"features": [{"attributes": {"Positive": 12, "Rate": 1.5, "County": "Caf\xc3\xa9", "Note": null}}]}'
+
+
+@pytest.fixture
+def backend():
+    previous = jsonlib.backend()
+    yield
+    jsonlib.use(previous)
+
+
+@pytest.mark.parametrize('name', list(jsonlib.BACKENDS))
+def test_backends_decode_the_same(backend, name):
+    pytest.importorskip(name)
+    assert jsonlib.use(name) == name
+    assert jsonlib.loads(BODY) == {
+        'features': [{'attributes': {'Positive': 12, 'Rate': 1.5, 'County': 'Café', 'Note': None}}]}
+    assert jsonlib.loads(BODY.decode('utf-8')) == jsonlib.loads(BODY)
+    # not supported by every backend, decoded by json
+    nan = jsonlib.loads(b'{"a": NaN, "b": 123456789012345678901234567890}')
+    assert nan['a'] != nan['a'] and nan['b'] == 123456789012345678901234567890
+    with pytest.raises(ValueError):
+        jsonlib.loads(b'{"a": ')
+
+
+def test_unknown_backend(backend):
+    with pytest.raises(ValueError):
+        jsonlib.use('simdjson')
+    assert jsonlib.use('auto') in jsonlib.BACKENDS
@@ -1,9 +1,14 @@
+import copy
 from datetime import datetime
+import time
 import types
 import pandas as pd
 import numpy as np
+from omegaconf import OmegaConf
 
 import fetcher.lib as lib
+from fetcher.client import HttpClient
+from fetcher.scheduler import HostScheduler
 
 
 COLUMNS = ['a', 'b', 'c']
@@ -144,3 +149,140 @@ class TestDataFrame:
         ]
 
         self.build_and_compare_1col([test_items], [expected])
+
+    def test_frames_same_as_records(self):
+        cfg = types.SimpleNamespace(index=[lib.STATE, lib.TS], fields=COLUMNS[:2])
+        frame = pd.DataFrame({
+            lib.TS: pd.to_datetime(['2020-10-01', '2020-10-03']), 'a': [1, 2], 'x': ['y', 'z']})
+        frame[lib.STATE] = 'ARG'
+        records = [{lib.STATE: 'BAR', lib.TS: datetime(2020, 10, 2), 'b': 3}]
+
+        expected = lib.build_dataframe(
+            {'ARG': frame.to_dict(orient='records'), 'BAR': records}, [STATES], cfg, '%Y%m%d')
+        df = lib.build_dataframe({'ARG': frame, 'BAR': records}, [STATES], cfg, '%Y%m%d')
+        pd.testing.assert_frame_equal(df, expected)
+
+    def test_daily_ffill(self):
+        index = [lib.STATE, lib.TS, 'DATE_USED']
+        df = pd.DataFrame({
+            lib.STATE: ['ARG', 'ARG', 'ARG', 'ARG', 'BAR', 'BAR'],
+            'DATE_USED': ['a', 'a', 'a', 'b', 'a', 'a'],
+            lib.TS: pd.to_datetime(['2020-10-01 10:00', '2020-10-01 20:00', '2020-10-04 00:00', '2020-10-02 00:00',
+                                    '2020-10-01 00:00', '2020-10-03 01:00']),
+            'a': [1, np.nan, 3, 4, 5, np.nan], 'b': ['x', 'y', None, 'z', None, 'w'],
+        }).set_index(index).sort_index()
+        part = [lib.STATE, 'DATE_USED']
+        expected = df.reset_index(part).groupby(part).apply(
+            lambda d: d.ffill().resample('1D', closed='right').ffill()).drop(columns=part)
+        pd.testing.assert_frame_equal(lib.daily_ffill(df, part), expected)
+
+    def test_typed_columns(self, caplog):
+        fields = [lib.STATE, lib.TS, 'DATE_USED', 'a', 'b', 'c']
+        dtypes = {'default': 'Int32', lib.STATE: 'category', 'DATE_USED': 'category',
+                  lib.TS: 'datetime64[ns]'}
+        results = {
+            'ARG': [{lib.STATE: 'ARG', lib.TS: datetime(2020, 10, 1), 'DATE_USED': 'x', 'a': 1, 'b': np.int64(2)},
+                    {lib.STATE: 'ARG', lib.TS: datetime(2020, 10, 3), 'a': '3', 'b': 'n/a', 'c': 1.5}],
+            'BAR': [{lib.STATE: 'BAR', lib.TS: datetime(2020, 10, 2), 'DATE_USED': 'x', 'a': 4.0}],
+        }
+        cfg = types.SimpleNamespace(index=[lib.STATE, lib.TS, 'DATE_USED'], fields=fields)
+        expected = lib.build_dataframe(copy.deepcopy(results), [STATES], cfg, '%Y%m%d')
+        cfg = types.SimpleNamespace(index=[lib.STATE, lib.TS, 'DATE_USED'], fields=list(fields), dtypes=dtypes)
+        df = lib.build_dataframe(results, [STATES], cfg, '%Y%m%d')
+
+        # counts are integers, text and fractions are left as is
+        assert df['a'].dtype == 'Int32' and df['b'].dtype == object and df['c'].dtype == float
+        assert sorted(r.args[0] for r in caplog.records if r.levelname == 'WARNING') == ['b', 'c']
+        assert list(df['a']) == [3, 1, 4]
+        pd.testing.assert_frame_equal(df.astype({'a': float}), expected.astype({'a': float}), check_index_type=False)
+
+    def test_chunks_same_as_whole(self):
+        fields = [lib.STATE, lib.TS, 'DATE_USED', 'a', 'b', 'c']
+        frame = pd.DataFrame({lib.TS: pd.to_datetime(['2020-10-01', '2020-10-04']), 'a': [1, 2], 'c': [3, 4]})
+        frame[lib.STATE] = 'ARG'
+        results = {
+            'FOO': [{lib.STATE: 'FOO', lib.TS: datetime(2020, 10, 1), 'DATE_USED': 'x', 'a': 1, 'c': 2},
+                    {lib.STATE: 'FOO', lib.TS: datetime(2020, 10, 3), 'DATE_USED': 'y', 'b': 'n/a', 'c': '7'}],
+            'ARG': frame,
+            # fractions: c isn't a count in any state
+            'BAR': [{lib.STATE: 'BAR', lib.TS: datetime(2020, 10, 2), 'a': 4.0, 'c': 1.5}],
+        }
+        for dtypes in [None, {'default': 'Int32', lib.STATE: 'category', lib.TS: 'datetime64[ns]',
+                              'DATE_USED': 'object'}]:
+            cfg = types.SimpleNamespace(index=[lib.STATE, lib.TS, 'DATE_USED'], fields=list(fields), dtypes=dtypes)
+            expected = lib.build_dataframe(copy.deepcopy(results), [STATES], cfg, '%Y%m%d')
+            chunks = list(lib.build_dataframe_chunks(copy.deepcopy(results), [STATES], cfg, '%Y%m%d'))
+            assert len(chunks) == 3
+            assert ''.join(df.to_csv(header=i == 0) for i, df in enumerate(chunks)) == expected.to_csv()
+
+        # the rows of a state alone are the same, cast to the schema whatever the values
+        states = [lib.build_state_frame(s, results[s], cfg, '%Y%m%d') for s in ['ARG', 'FOO']]
+        assert [list(df.dtypes) for df in states] == [[float, float, float, object]] * 2
+        assert states[1].index.equals(chunks[2].index) and states[1]['b'].isna().all()
+        assert list(states[1]['c']) == [float(v) for v in chunks[2]['c']]
+
+        # not chunked: reindexed by all the states
+        cfg = types.SimpleNamespace(index=lib.STATE, fields=['a'])
+        assert not lib.can_chunk(cfg)
+        chunks = list(lib.build_dataframe_chunks({'FOO': [{lib.STATE: 'FOO', 'a': 1}]}, STATES, cfg, '%Y%m%d'))
+        assert len(chunks) == 1 and len(chunks[0]) == 3
+
+
+class TestFetcher:
+
+    def make_fetcher(self, workers, fetch_state):
+        fetcher = lib.Fetcher.__new__(lib.Fetcher)
+        fetcher.sources = {s: None for s in STATES}
+        fetcher.workers = workers
+        fetcher.scheduler = HostScheduler()
+        fetcher.engine = 'threads'
+        fetcher.client = HttpClient()
+        fetcher.fetch_state = fetch_state
+        return fetcher
+
+    def fetch_state(self, state):
+        if state == 'BAR':
+            raise ValueError("failed fetching")
+        if state == 'FOO':
+            # fetched, but nothing was parsed
+            return [{}], {}
+        return [{}], [{lib.STATE: state}]
+
+    def test_fetch_all_sequential(self):
+        fetcher = self.make_fetcher(1, self.fetch_state)
+        results = fetcher.fetch_all(STATES + ['BAZ'])
+        assert results == {'ARG': [{lib.STATE: 'ARG'}]}
+
+    def test_fetch_all_parallel(self):
+        fetcher = self.make_fetcher(4, self.fetch_state)
+        results = fetcher.fetch_all(STATES + ['BAZ'])
+        assert results == {'ARG': [{lib.STATE: 'ARG'}]}
+
+    def test_fetch_all_on_state(self):
+        def fetch_state(state):
+            if state == 'ARG':
+                # the slowest state is written last
+                time.sleep(0.1)
+            return [{}], [{lib.STATE: state}]
+
+        for workers in [1, 3]:
+            written = []
+            fetcher = self.make_fetcher(workers, fetch_state)
+            results = fetcher.fetch_all(STATES, on_state=lambda state, data: written.append(state))
+            assert list(results) == STATES
+            assert sorted(written) == STATES
+            if workers > 1:
+                assert written[-1] == 'ARG'
+
+    def test_stream_output(self, tmp_path):
+        cfg = OmegaConf.create({
+            'stream': True, 'output': str(tmp_path / 'states'), 'state': ['FOO', 'ARG', 'BAR'],
+            'output_date_format': '%Y%m%d', 'dataset': {'index': lib.STATE, 'fields': ['a'], 'db': {'store': False}}})
+        fetcher = self.make_fetcher(1, lambda state: ([{}], [{lib.STATE: state, 'a': len(state)}]))
+        lib.fetch_and_output(cfg, fetcher, lib.open_sinks(cfg))
+
+        # the states as they're fetched, then sorted
+        with open(tmp_path / 'states_stream.csv') as f:
+            assert f.read().split() == ['STATE,a', 'FOO,3', 'ARG,3', 'BAR,3']
+        with open(tmp_path / 'states.csv') as f:
+            assert f.read().split() == ['STATE,a', 'ARG,3', 'BAR,3', 'FOO,3']
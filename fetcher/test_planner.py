@@ -0,0 +1,60 @@
+import json
+
+from fetcher.planner import plan_queries
+from fetcher.sources import Query
+
+
+URL = "https://services1.arcgis.com/x/arcgis/rest/services/Tests/FeatureServer/0/query"
+
+
+def stats_query(where, name, stat='count', field='FID', url=URL):
+    return Query(url, 'arcgis', {
+        'where': where, 'f': 'json',
+        'outStatistics': [{'statisticType': stat, 'onStatisticField': field, 'outStatisticFieldName': name}]})
+
+
+def response(**attributes):
+    return {'features': [{'attributes': attributes}]}
+
+
+def test_same_filter_merged():
+    queries = [
+        stats_query('1=1', 'total'),
+        Query("https://example.com/data.json", 'json'),
+        stats_query('1=1', 'deaths', 'sum', 'daily_deaths'),
+    ]
+    plan = plan_queries(queries)
+    assert [q.url for q in plan.queries] == [URL, "https://example.com/data.json"]
+    stats = json.loads(plan.queries[0].params['outStatistics'])
+    assert [s['outStatisticFieldName'] for s in stats] == ['total', 'deaths']
+
+    results = plan.split([response(total=10, deaths=2), {'json': True}])
+    assert results == [response(total=10), {'json': True}, response(deaths=2)]
+
+
+def test_conditional_is_opt_in():
+    queries = [stats_query('1=1', 'total'), stats_query("Result = 'Positive'", 'positive')]
+    assert plan_queries(queries) is None
+
+    plan = plan_queries(queries, conditional=True)
+    assert len(plan.queries) == 1
+    params = plan.queries[0].params
+    assert params['where'] == "(1=1) OR (Result = 'Positive')"
+    stats = json.loads(params['outStatistics'])
+    assert stats[1] == {
+        'statisticType': 'sum', 'outStatisticFieldName': 'positive',
+        'onStatisticField': "CASE WHEN (Result = 'Positive') AND FID IS NOT NULL THEN 1 ELSE 0 END"}
+    assert plan.split([response(total=10, positive=3)]) == [response(total=10), response(positive=3)]
+
+
+def test_not_merged():
+    # different layers, clashing names, statistics that can't be conditional
+    assert plan_queries([stats_query('1=1', 'a'), stats_query('1=1', 'b', url=URL + '2')]) is None
+    assert plan_queries([stats_query('1=1', 'a'), stats_query('x=1', 'a')], conditional=True) is None
+    assert plan_queries([stats_query('1=1', 'a', 'max'), stats_query('x=1', 'b')], conditional=True) is None
+
+
+def test_errors_go_to_every_query():
+    plan = plan_queries([stats_query('1=1', 'a'), stats_query('1=1', 'b')])
+    error = {'error': {'code': 400}}
+    assert plan.split([error]) == [error, error]
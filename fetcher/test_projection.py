@@ -0,0 +1,100 @@
+import urllib.error
+
+import pytest
+
+from fetcher.projection import fetch_projected, project_params, project_source
+from fetcher.sources import Query, Source
+
+
+MAPPING = {'Positive': 'POSITIVE', 'Deaths': 'DEATH', 'date': 'DATE', '__strptime': '%Y-%m-%d'}
+
+
+def test_arcgis_projection():
+    query = Query("http://example.com/query", 'arcgis', {'where': '1=1', 'outFields': '*, ReportDate as date'})
+    assert project_params(query, ['Deaths', 'Positive', 'date']) == {
+        'where': '1=1', 'outFields': 'Deaths,Positive,ReportDate as date', 'returnGeometry': 'false'}
+    # explicit fields, or statistics: as is
+    assert project_params(Query("http://example.com/query", 'arcgis', {'outFields': 'Deaths'}), ['Deaths']) is None
+    assert project_params(
+        Query("http://example.com/query", 'arcgis', {'outStatistics': [{}]}), ['Deaths']) is None
+
+
+def test_soda_projection():
+    query = Query("http://example.com/a.json", 'soda', {'$where': 'x=1'})
+    assert project_params(query, ['a', 'b']) == {'$where': 'x=1', '$select': 'a,b'}
+    assert project_params(Query("http://example.com/a.json", 'soda', {'$query': 'select *'}), ['a']) is None
+
+
+def test_ckan_projection():
+    url = "http://example.com/api/3/action/datastore_search"
+    query = Query(url, 'ckan', {'resource_id': 'x'})
+    assert project_params(query, ['date', 'tested']) == {'resource_id': 'x', 'fields': 'date,tested'}
+    assert project_params(Query(url, 'ckan', {'fields': 'date'}), ['a']) is None
+    assert project_params(Query("http://example.com/api/3/action/datastore_search_sql", 'ckan', {}), ['a']) is None
+
+
+def test_project_source_opt_out():
+    queries = [
+        Query("http://example.com/query", 'arcgis', {'outFields': '*'}, project=True),
+        Query("http://example.com/query", 'arcgis', {'outFields': '*'}, project=False),
+    ]
+    source = Source('FOO', queries, MAPPING)
+    assert project_source(source) == 1
+    assert source.queries[0].params['outFields'] == 'Deaths,Positive,date'
+    assert source.queries[0].full_params == {'outFields': '*'}
+    assert source.queries[1].params == {'outFields': '*'}
+
+    # several queries share the mapping: only when asked for
+    queries = [Query("http://example.com/query", 'arcgis', {'outFields': '*'}) for _ in range(2)]
+    assert project_source(Source('FOO', queries, MAPPING)) == 0
+    source = Source('FOO', queries[:1], MAPPING)
+    assert project_source(source) == 1 and source.queries[0].params['outFields'] == 'Deaths,Positive,date'
+
+    # handlers can read unmapped fields: only when asked for
+    source = Source('FOO', [Query("http://example.com/query", 'arcgis', {'outFields': '*'})], MAPPING, extras=print)
+    assert project_source(source) == 0
+
+
+def test_rejected_projection_falls_back():
+    query = Query("http://example.com/query", 'arcgis', {'outFields': 'Deaths'}, full_params={'outFields': '*'})
+    calls = []
+
+    def fetch(q):
+        calls.append(q.params)
+        if q.params['outFields'] != '*':
+            return {'error': {'code': 400, 'message': 'Invalid field'}}
+        return {'features': []}
+    assert fetch_projected(query, fetch) == {'features': []}
+    assert calls == [{'outFields': 'Deaths'}, {'outFields': '*'}]
+
+    soda = Query("http://example.com/a.json", 'soda', {'$select': 'a'}, full_params={})
+
+    def fetch_soda(q):
+        if q.params:
+            raise urllib.error.HTTPError(q.url, 400, 'Bad Request', {}, None)
+        return [{'a': 1}]
+    assert fetch_projected(soda, fetch_soda) == [{'a': 1}]
+
+
+def test_rejected_ckan_projection_falls_back():
+    url = "http://example.com/api/3/action/datastore_search"
+    query = Query(url, 'ckan', {'resource_id': 'x', 'fields': 'a,b'}, full_params={'resource_id': 'x'})
+    full = {'success': True, 'result': {'records': [{'a': 1}]}}
+
+    def fetch_409(q):
+        if 'fields' in q.params:
+            raise urllib.error.HTTPError(q.url, 409, 'Conflict', {}, None)
+        return full
+    assert fetch_projected(query, fetch_409) == full
+
+    def fetch_unsuccessful(q):
+        if 'fields' in q.params:
+            return {'success': False, 'error': {'fields': ['field "b" not in resource']}}
+        return full
+    assert fetch_projected(query, fetch_unsuccessful) == full
+
+    # other errors aren't a rejection
+    def fetch_500(q):
+        raise urllib.error.HTTPError(q.url, 500, 'Server Error', {}, None)
+    with pytest.raises(urllib.error.HTTPError):
+        fetch_projected(query, fetch_500)
@@ -0,0 +1,108 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from fetcher import source_utils
+from fetcher.client import HttpClient, use_client
+from fetcher.shared import SharedResponses, query_key
+from fetcher.sources import Query, Source
+
+
+def test_query_key():
+    assert query_key(Query("http://example.com/q", 'arcgis', {'f': 'json'}, 'post')) == \
+        ('POST', "http://example.com/q?f=json")
+    # pandas params are read_csv args
+    assert query_key(Query("http://example.com/a.csv", 'pandas', {'skiprows': 1})) == \
+        ('GET', "http://example.com/a.csv")
+    assert query_key(Query("http://example.com/t", 'tableau')) is None
+
+
+def test_shared_requests_are_made_once():
+    states = Source('FOO', [Query("http://example.com/1", 'json'), Query("http://example.com/2", 'json')], {})
+    backfill = Source('FOO', [Query("http://example.com/1", 'json'), Query("http://example.com/3", 'csv')], {})
+    shared = SharedResponses.plan([states, backfill])
+    assert shared.wants('GET', "http://example.com/1")
+    assert not shared.wants('GET', "http://example.com/2")
+
+    calls = []
+    lock = threading.Lock()
+
+    def fetch(url):
+        def f():
+            with lock:
+                calls.append(url)
+            time.sleep(0.01)
+            return url.encode()
+        return f
+
+    urls = ["http://example.com/1", "http://example.com/1", "http://example.com/2", "http://example.com/3"]
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda url: shared.get('GET', url, fetch(url)), urls))
+
+    assert results == [url.encode() for url in urls]
+    assert sorted(calls) == ["http://example.com/1", "http://example.com/2", "http://example.com/3"]
+    assert shared.stats['shared'] == 1
+    # kept until the queries that planned it are done
+    shared.done(states.queries[0])
+    assert shared._responses
+    shared.done(backfill.queries[0])
+    assert not shared._responses
+
+
+def test_shared_response_released_by_other_requests():
+    query = Query("http://example.com/1", 'arcgis', {'f': 'json'})
+    shared = SharedResponses.plan([Source('FOO', [query], {}), Source('FOO', [query], {})])
+    # the first query made its request, the other one made others (e.g. pages)
+    shared.get(*query_key(query), lambda: b'1')
+    shared.done(query)
+    assert shared._responses
+    shared.done(query)
+    assert not shared._responses and not shared._uses
+
+
+def test_shared_requests_are_made_once_async():
+    source = Source('FOO', [Query("http://example.com/1", 'json')] * 3, {})
+    shared = SharedResponses.plan([source])
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return b'1'
+
+    async def get_all():
+        return await asyncio.gather(*[shared.get_async('GET', "http://example.com/1", fetch) for _ in range(3)])
+
+    # in flight at the same time, fetched once
+    assert asyncio.run(get_all()) == [b'1'] * 3
+    assert len(calls) == 1
+    for query in source.queries:
+        shared.done(query)
+    assert not shared._responses
+
+
+def test_fetch_query_releases_shared(monkeypatch):
+    query = Query("http://example.com/1", 'arcgis', {'f': 'json'})
+    shared = SharedResponses.plan([Source('FOO', [query], {}), Source('BAR', [query], {})])
+    shared.put(*query_key(query), b'1')
+    # fetched with other requests, without taking the planned one
+    monkeypatch.setattr(source_utils, '_fetch_query', lambda query, scheduler, mapping: {'features': []})
+    with HttpClient() as client, use_client(client):
+        client.shared = shared
+        for state in ['FOO', 'BAR']:
+            source_utils.fetch_query(state, query)
+    assert not shared._responses
+
+
+def test_finish_releases_queries_not_fetched():
+    query = Query("http://example.com/1", 'json')
+    states, backfill = Source('FOO', [query], {}), Source('FOO', [Query("http://example.com/2", 'json'), query], {})
+    shared = SharedResponses.plan([states, backfill])
+    shared.put(*query_key(query), b'1')
+    shared.done(query)
+    shared.finish([states])
+    assert shared._responses
+    # the query after a failed one in backfill: never fetched
+    shared.finish([backfill])
+    assert not shared._responses and not shared._uses
@@ -0,0 +1,89 @@
+import gzip
+import os
+
+from omegaconf import OmegaConf
+import pandas as pd
+import pytest
+
+from fetcher import sinks
+
+
+def frame():
+    df = pd.DataFrame({
+        'STATE': ['AK', 'AK', 'AL'], 'TIMESTAMP': pd.to_datetime(['2020-10-02', '2020-10-01', '2020-10-01']),
+        'POSITIVE': pd.array([2, None, 5], dtype='Int32'), 'NOTE': [1, 'text', None]})
+    return df.set_index(['STATE', 'TIMESTAMP'])
+
+
+def test_csv_sink_chunks(tmp_path):
+    names = [str(tmp_path / 'a_1.csv'), str(tmp_path / 'a.csv')]
+    df = frame()
+    with sinks.CsvSink(names) as sink:
+        sink.write(df.iloc[:2])
+        sink.write(df.iloc[2:])
+    for name in names:
+        with open(name) as f:
+            assert f.read() == df.to_csv()
+    # serialized once
+    assert os.path.samefile(*names)
+
+
+def test_csv_sink_latest(tmp_path):
+    names = [str(tmp_path / 'a_2.csv.gz'), str(tmp_path / 'a.csv.gz')]
+    with open(names[1], 'w') as f:
+        f.write('previous')
+    # failed while writing: the latest file is left as is
+    with pytest.raises(ValueError):
+        with sinks.CsvSink(names, 'gzip') as sink:
+            sink.write(frame())
+            raise ValueError('failed')
+    with open(names[1]) as f:
+        assert f.read() == 'previous'
+
+    with sinks.CsvSink(names, 'gzip') as sink:
+        sink.write(frame())
+    with gzip.open(names[1], 'rt') as f:
+        assert f.read() == frame().to_csv()
+    assert sinks.csv_names('out', 'zstd')[1] == 'out.csv.zst'
+
+
+def test_arrow_columns():
+    df = sinks._arrow_columns(frame().reset_index())
+    assert list(df['NOTE']) == ['1', 'text', None]
+    assert df['POSITIVE'].dtype == 'Int32'
+
+
+def test_open_sinks(tmp_path):
+    cfg = OmegaConf.create({
+        'output': str(tmp_path / 'states'), 'output_format': 'csv', 'dataset': {'db': {'store': False}}})
+    opened = sinks.open_sinks(cfg)
+    assert [type(s) for s in opened] == [sinks.CsvSink]
+    assert opened[0].names[1] == str(tmp_path / 'states.csv')
+
+    cfg.output_format = ['csv', 'xlsx']
+    with pytest.raises(ValueError):
+        sinks.open_sinks(cfg)
+
+
+def test_parquet_sink(tmp_path):
+    pytest.importorskip('pyarrow')
+    root = str(tmp_path / 'states_parquet')
+    sink = sinks.ParquetSink(root, 'zstd', fetch_date='2020-10-02')
+    df = frame()
+    sink.write(df.iloc[:2])
+    sink.write(df.iloc[2:])
+    # the same day again: replaces the partition
+    sink.write(df.iloc[2:])
+
+    res = pd.read_parquet(root, filters=[('STATE', '=', 'AL')])
+    assert len(res) == 1 and res['POSITIVE'].iloc[0] == 5
+    assert list(pd.read_parquet(root)['FETCH_DATE'].astype(str).unique()) == ['2020-10-02']
+
+
+def test_split_stream_sinks(tmp_path):
+    cfg = OmegaConf.create({'output': str(tmp_path / 'states')})
+    csv = sinks.CsvSink(sinks.csv_names(cfg.output))
+    db = sinks.DbSink({'store': True})
+    stream, final = sinks.split_stream_sinks(cfg, [csv, db])
+    assert final == [csv]
+    assert stream[1:] == [db] and stream[0].names == [str(tmp_path / 'states_stream.csv')]
@@ -0,0 +1,104 @@
+from datetime import datetime
+import time
+
+import pandas as pd
+import pytest
+
+import fetcher.source_utils as source_utils
+from fetcher.scheduler import HostScheduler
+from fetcher.sources import Query, Source
+
+
+def make_source(num_queries):
+    queries = [Query("http://example.com/{}".format(i), 'json') for i in range(num_queries)]
+    return Source('FOO', queries, mapping={})
+
+
+class TestFetchSource:
+
+    @pytest.mark.parametrize("workers", [1, 4])
+    def test_results_in_query_order(self, monkeypatch, workers):
+        def fetch_query(state, query, scheduler=None, mapping=None):
+            # later queries finish first
+            index = int(query.url.rsplit('/', 1)[-1])
+            time.sleep(0.01 * (5 - index))
+            return index
+
+        monkeypatch.setattr(source_utils, 'fetch_query', fetch_query)
+        assert source_utils.fetch_source(make_source(5), workers) == list(range(5))
+
+    def test_failure_fails_source(self, monkeypatch):
+        def fetch_query(state, query, scheduler=None, mapping=None):
+            if query.url.endswith('/2'):
+                raise ValueError("failed")
+            return query.url
+
+        monkeypatch.setattr(source_utils, 'fetch_query', fetch_query)
+        with pytest.raises(ValueError):
+            source_utils.fetch_source(make_source(5), 4)
+
+
+class TestHostScheduler:
+
+    def test_interleave_by_host(self):
+        urls = ['http://a.com/1', 'http://a.com/2', 'http://a.com/3', 'http://b.com/1', 'http://c.com/1']
+        queries = [Query(url, 'json') for url in urls]
+        assert HostScheduler().interleave(queries) == [0, 3, 4, 1, 2]
+
+    def test_host_patterns(self):
+        scheduler = HostScheduler({
+            'default': {'concurrency': 2},
+            'services*.arcgis.com': {'concurrency': 8, 'rate': 10}})
+        limit = scheduler.limit_for('services7.arcgis.com')
+        assert (limit.concurrency, limit.rate) == (8, 10)
+        limit = scheduler.limit_for('data.ca.gov')
+        assert (limit.concurrency, limit.rate) == (2, None)
+
+    def test_concurrency_limit(self, monkeypatch):
+        scheduler = HostScheduler({'default': {'concurrency': 1}})
+        in_flight = []
+
+        def fetch_query(query, mapping=None):
+            in_flight.append(1)
+            assert len(in_flight) == 1
+            time.sleep(0.01)
+            in_flight.pop()
+            return query.url
+
+        monkeypatch.setattr(source_utils, '_request_query', fetch_query)
+        source = make_source(4)
+        assert source_utils.fetch_source(source, 4, scheduler) == [q.url for q in source.queries]
+        stats = scheduler.stats()['example.com']
+        assert stats['requests'] == 4
+        assert stats['total_wait'] > 0
+
+
+def test_tag_and_timestamp_all():
+    ms = 1600000000000
+    records = [
+        {'TIMESTAMP': ms}, {'TIMESTAMP': ms}, {'TIMESTAMP': ms / 1000}, {'TIMESTAMP': float(ms + 1)},
+        {'TIMESTAMP': datetime(2020, 3, 1)}, {'DATE': '2020-03-02'}, {'DATE': '2020-03-02'}, {'TIMESTAMP': 0}]
+    now = datetime.now()
+    source_utils._tag_and_timestamp_all('FOO', records, now, '%Y-%m-%d')
+    assert [r['TIMESTAMP'] for r in records[:-1]] == [
+        datetime.fromtimestamp(ms / 1000), datetime.fromtimestamp(ms / 1000), datetime.fromtimestamp(ms / 1000),
+        datetime.fromtimestamp((ms + 1) / 1000), datetime(2020, 3, 1), datetime(2020, 3, 2), datetime(2020, 3, 2)]
+    assert records[-1]['TIMESTAMP'] == 0
+    assert all(r['STATE'] == 'FOO' and r['FETCH_TIMESTAMP'] == now for r in records)
+
+
+def test_handler_frames():
+    frame = pd.DataFrame({'TIMESTAMP': pd.to_datetime(['2020-03-01', '2020-03-02']), 'POSITIVE': [1, 2]})
+    source = Source('FOO', [Query("http://example.com", 'json')], {},
+                    extras=lambda res, mapping: [frame, {'TIMESTAMP': 1600000000, 'POSITIVE': 3}])
+    data = source_utils.process_source_responses(source, [None])
+    assert isinstance(data, pd.DataFrame) and list(frame.columns) == ['TIMESTAMP', 'POSITIVE']
+    assert data['STATE'].tolist() == ['FOO'] * 3
+    assert data['TIMESTAMP'].tolist() == [
+        datetime(2020, 3, 1), datetime(2020, 3, 2), datetime.fromtimestamp(1600000000)]
+
+    # epochs are converted like records
+    epochs = pd.DataFrame({'TIMESTAMP': [1600000000000], 'POSITIVE': [1]})
+    source.extras = lambda res, mapping: epochs
+    assert source_utils.process_source_responses(source, [None])[0]['TIMESTAMP'] == \
+        datetime.fromtimestamp(1600000000)
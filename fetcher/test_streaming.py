@@ -0,0 +1,78 @@
+from io import BytesIO
+import json
+
+import pytest
+
+from fetcher.sources import Query, Source
+from fetcher.source_utils import process_source_responses
+from fetcher.streaming import compile_path, extract_body, is_nested, stream_extract, validate
+from fetcher.utils import extract_arcgis_attributes, extract_attributes
+
+
+MAPPING = {'Date': 'DATE', 'Cases': 'POSITIVE'}
+ARCGIS = {
+    'objectIdFieldName': 'FID',
+    'features': [{'attributes': {'Date': '2020-10-{}'.format(i), 'Cases': i, 'Other': 'x'},
+                  'geometry': {'x': 1, 'y': 2}} for i in range(10, 15)],
+    'exceededTransferLimit': True,
+}
+
+
+@pytest.mark.parametrize("path, compiled", [
+    (['features', [], 'attributes'], ('features.item', None, ['attributes'])),
+    (['result', 'records', []], ('result.records.item', None, [])),
+    ([0, 0], ('item', 0, [0])),
+    (['data'], ('', None, ['data'])),
+    ([], ('', None, [])),
+])
+def test_compile_path(path, compiled):
+    assert compile_path(path) == compiled
+
+
+def test_same_records_as_extract():
+    records, root = stream_extract(
+        BytesIO(json.dumps(ARCGIS).encode()), ['features', [], 'attributes'], MAPPING)
+    assert records == extract_arcgis_attributes(ARCGIS, MAPPING)
+    assert root == {'objectIdFieldName': 'FID', 'exceededTransferLimit': True}
+
+    ckan = {'result': {'records': [{'Date': '2020-10-10', 'Cases': 1.5}], 'total': 1}}
+    path = ['result', 'records', []]
+    records, _ = stream_extract(BytesIO(json.dumps(ckan).encode()), path, MAPPING)
+    assert records == [extract_attributes(ckan, path, MAPPING)]
+
+    nested = [[{'Cases': 3}], [{'Cases': 4}]]
+    records, _ = stream_extract(BytesIO(json.dumps(nested).encode()), [1, 0], MAPPING)
+    assert records == [extract_attributes(nested, [1, 0], MAPPING)]
+
+
+def test_nested_path():
+    result = {'pages': [{'rows': [{'Cases': 1}, {'Cases': 2}]}, {'rows': [{'Cases': 3}]}]}
+    # an index before the []: the same records
+    path = ['pages', 0, 'rows', []]
+    records, _ = stream_extract(BytesIO(json.dumps(result).encode()), path, MAPPING)
+    assert records == extract_attributes(result, path, MAPPING)
+    assert not is_nested(path)
+
+    # a list per page, which the stream would flatten: can't be streamed
+    path = ['pages', [], 'rows', []]
+    assert extract_attributes(result, path, MAPPING) == [[{'POSITIVE': 1}, {'POSITIVE': 2}], {'POSITIVE': 3}]
+    records, _ = stream_extract(BytesIO(json.dumps(result).encode()), path, MAPPING)
+    assert records == [{'POSITIVE': 1}, {'POSITIVE': 2}, {'POSITIVE': 3}]
+    assert is_nested(path) and is_nested(['pages', [], 'rows', 0])
+    with pytest.raises(ValueError):
+        validate(Query("http://example.com/data", 'json', data_path=path, stream=True), Source('FOO', [], {}))
+
+
+def test_streamed_source():
+    query = Query("http://example.com/query", 'arcgis', stream=True)
+    source = Source('FOO', [query], MAPPING)
+    result = extract_body(query, json.dumps(ARCGIS).encode(), MAPPING)
+    data = process_source_responses(source, [result])
+    assert [d['POSITIVE'] for d in data] == list(range(10, 15))
+
+
+def test_validate():
+    with pytest.raises(ValueError):
+        validate(Query("http://example.com/a.csv", 'csv', stream=True), Source('FOO', [], {}))
+    with pytest.raises(ValueError):
+        validate(Query("http://example.com/query", 'arcgis', stream=True), Source('FOO', [], {}, extras=print))
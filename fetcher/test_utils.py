@@ -0,0 +1,79 @@
+import pandas as pd
+
+from fetcher.utils import Mapping, arcgis_frame, extract_arcgis_attributes, extract_attributes, map_attributes
+
+
+RESULT = {
+    'fields': [
+        {'name': 'Date_Collected', 'type': 'esriFieldTypeDate'},
+        {'name': 'All_Tests', 'type': 'esriFieldTypeInteger'},
+        {'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+    ],
+    'features': [
+        {'attributes': {'Date_Collected': 1584057600000, 'All_Tests': 10, 'OBJECTID': 1}},
+        {'attributes': {'Date_Collected': 1584144000000, 'All_Tests': None, 'OBJECTID': 2}},
+    ],
+}
+MAPPING = {'Date_Collected': 'TIMESTAMP', 'All_Tests': 'SPECIMENS'}
+
+
+def test_arcgis_frame():
+    df = arcgis_frame(RESULT, MAPPING)
+    expected = pd.DataFrame(extract_arcgis_attributes(RESULT, MAPPING))
+    expected['TIMESTAMP'] = pd.to_datetime(expected['TIMESTAMP'], unit='ms')
+    pd.testing.assert_frame_equal(df, expected)
+
+    # no features: still the mapped columns
+    empty = arcgis_frame(dict(RESULT, features=[]), MAPPING)
+    assert list(empty.columns) == ['TIMESTAMP', 'SPECIMENS'] and empty.empty
+
+
+def test_arcgis_frame_keys():
+    res = {
+        'fields': [{'name': 'day', 'type': 'esriFieldTypeDate'}, {'name': 'updated', 'type': 'esriFieldTypeDate'}],
+        'features': [
+            {'attributes': {'day': 1584057600000, 'updated': 1584057600000}},
+            # a key the first feature doesn't have
+            {'attributes': {'day': 1584144000000, 'updated': 1584144000000, 'cases': 4}},
+        ]}
+    mapping = {'day': 'TIMESTAMP', 'updated': 'DATE', 'cases': 'POSITIVE'}
+    df = arcgis_frame(res, mapping)
+    assert list(df.columns) == ['TIMESTAMP', 'DATE', 'POSITIVE']
+    assert df['POSITIVE'].tolist()[1] == 4
+    # only the TIMESTAMP is converted
+    assert df['TIMESTAMP'].tolist()[0] == pd.Timestamp('2020-03-13')
+    assert df['DATE'].tolist() == [1584057600000, 1584144000000]
+
+
+def test_arcgis_frame_strptime():
+    res = {'features': [{'attributes': {'day': '2020-03-20', 'cases': 4}}]}
+    mapping = {'day': 'DATE', 'cases': 'POSITIVE', '__strptime': '%Y-%m-%d'}
+    df = arcgis_frame(res, mapping)
+    assert df.to_dict(orient='records') == [extract_arcgis_attributes(res, mapping)]
+
+
+def test_compiled_mapping():
+    mapping = {'Positive ': 'POSITIVE', 'day': 'DATE', '__strptime': '%Y-%m-%d'}
+    compiled = Mapping(mapping)
+    assert compiled == mapping and compiled.fields == ['Positive', 'day']
+    records = [{' Positive': 1, 'day': '2020-03-20', 'other': 2}, {'Positive': 3, 'day': None}]
+    for record in records + records:
+        assert map_attributes(record, compiled) == map_attributes(record, mapping)
+
+    # changes are compiled too
+    compiled['other'] = 'NEGATIVE'
+    assert map_attributes(records[0], compiled)['NEGATIVE'] == 2
+
+
+def test_extract_attributes_paths():
+    mapping = {'a': 'A', 'b': 'B'}
+    result = {'data': {'rows': [{'v': {'a': 1}}, {'v': {'a': 2, 'c': 3}}], 'one': [{'b': 4}]}}
+    assert extract_attributes(result, ['data', 'rows', [], 'v'], mapping) == [{'A': 1}, {'A': 2}]
+    # a single item is unwrapped, missing keys and [] on a dict are skipped
+    assert extract_attributes(result, ['data', 'one', [], 'missing'], mapping) == {'B': 4}
+    assert extract_attributes(result, ['data', [], 'one', 0], mapping) == {'B': 4}
+    # nested []
+    nested = {'pages': [{'rows': [{'a': 1}, {'a': 2}]}, {'rows': [{'b': 3}]}, {'rows': []}]}
+    assert extract_attributes(nested, ['pages', [], 'rows', []], Mapping(mapping)) == [
+        [{'A': 1}, {'A': 2}], {'B': 3}, []]
+    assert extract_attributes({'a': 5}, [], mapping) == {'A': 5}
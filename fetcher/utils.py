@@ -4,14 +4,13 @@ a request. Utils methods are used both by the main library and by state specific
 extras module
 """
 
+from contextlib import contextmanager
 from datetime import datetime
 from enum import Enum
-from io import StringIO
+from io import BytesIO, StringIO
 import csv
-import json
 import logging
 import ssl
-import typing
 import urllib
 import urllib.request
 
@@ -19,6 +18,9 @@ import pandas as pd
 from bs4 import BeautifulSoup
 from tableauscraper import TableauScraper
 
+from fetcher import jsonlib
+from fetcher.client import current_client
+
 
 # TODO: It's not used as an effective enum
 # TODO: move this to a yaml somewhere
@@ -96,25 +98,89 @@ class Fields(Enum):
         return {f.name: f.value for f in Fields}
 
 
-def request(url, query=None, encoding=None, method=None):
+USER_AGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:79.0) Gecko/20100101 Firefox/79.0'
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.zip': 'zip', '.xz': 'xz', '.zst': 'zstd'}
+
+
+def build_url(url, query=None):
+    if query:
+        url = "{}?{}".format(url, urllib.parse.urlencode(query))
+    return url
+
+
+def request(url, query=None, encoding=None, method=None, verify=None):
     if not encoding:
         encoding = 'utf-8'
+    res = request_bytes(url, query, method, verify)
+    return res.decode(encoding)
+
+
+def request_bytes(url, query=None, method=None, verify=None):
+    '''Make a request and return the response body as bytes
+
+    Uses the run client (see fetcher.client) when one is installed, and urllib otherwise.
+    verify: False to skip certificate verification when using urllib, the run client
+        decides per host (fetch.insecure_hosts)
+    '''
     if not method:
         method = 'GET'
-    if query:
-        url = "{}?{}".format(url, urllib.parse.urlencode(query))
-    res = {}
+    url = build_url(url, query)
+
+    client = current_client()
+    if client:
+        return client.request(url, method)
+
     req = urllib.request.Request(url, method=method, headers={
-        'user-agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:79.0) Gecko/20100101 Firefox/79.0'
+        'user-agent': USER_AGENT
     })
-    with urllib.request.urlopen(req) as f:
-        res = f.read().decode(encoding)
+    context = ssl._create_unverified_context() if verify is False else None
+    with urllib.request.urlopen(req, context=context) as f:
+        res = f.read()
     return res
 
 
+@contextmanager
+def request_stream(url, query=None, method=None, verify=None):
+    '''Make a request, yielding a file object to read the response body from as it arrives
+
+    Same as request_bytes otherwise
+    '''
+    if not method:
+        method = 'GET'
+    url = build_url(url, query)
+
+    client = current_client()
+    if client:
+        with client.stream(url, method) as f:
+            yield f
+        return
+
+    req = urllib.request.Request(url, method=method, headers={
+        'user-agent': USER_AGENT
+    })
+    context = ssl._create_unverified_context() if verify is False else None
+    with urllib.request.urlopen(req, context=context) as f:
+        yield f
+
+
+def _infer_compression(url):
+    # pandas infers the compression from the file name, which a buffer doesn't have
+    path = urllib.parse.urlsplit(url).path
+    for ext, compression in COMPRESSION_EXTENSIONS.items():
+        if path.endswith(ext):
+            return compression
+    return None
+
+
 def request_pandas(query):
     url = query.url
     params = {} if not query.params else query.params
+    if current_client():
+        # download with the run client, and let pandas read it from memory
+        url = BytesIO(request_bytes(query.url))
+        if query.type not in ['xlsx', 'xls'] and 'compression' not in params:
+            params = {**params, 'compression': _infer_compression(query.url)}
+
     # Use params as **kwargs for pandas call
     if query.type in ['xlsx', 'xls']:
         df = pd.read_excel(url, **params)
@@ -131,16 +197,19 @@ def request_soup(url, query=None, encoding=None):
 
 def request_and_parse(url, query=None, method=None):
     # skip cert verification for PR (because who knows why)
-    if getattr(ssl, '_create_unverified_context', None):
-        ssl._create_default_https_context = ssl._create_unverified_context
+    # The run client has a per host policy for that instead
+    verify = None if current_client() else False
 
-    res = request(url, query, method=method)
-    res = json.loads(res)
-    return res
+    res = request_bytes(url, query, method=method, verify=verify)
+    return jsonlib.loads(res)
 
 
 def request_csv(url, query=None, dialect=None, header=True, encoding=None):
     res = request(url, query, encoding)
+    return parse_csv(res, dialect, header)
+
+
+def parse_csv(res, dialect=None, header=True):
     if not dialect:
         dialect = 'unix'
     if header:
@@ -152,6 +221,19 @@ def request_csv(url, query=None, dialect=None, header=True, encoding=None):
 
 
 def request_tableau_scraper(query):
+    # The scraper makes its own requests, so record/replay the parsed result
+    client = current_client()
+    archive = client.archive if client else None
+    if archive and archive.replaying:
+        return archive.replay_object('tableau', query.url, query.params)
+
+    dfs = _scrape_tableau(query)
+    if archive:
+        archive.record_object('tableau', query.url, query.params, dfs)
+    return dfs
+
+
+def _scrape_tableau(query):
     ts = TableauScraper()
     ts.loads(query.url)
     dashboard = ts.getWorkbook()
@@ -167,7 +249,93 @@ def request_tableau_scraper(query):
     return dfs
 
 
+# Mapping.name of a field without mapping
+UNMAPPED = object()
+
+
+class Mapping(dict):
+    '''A state's mapping (source field -> our field name), compiled once
+
+    It's the same dict the handlers get, and it keeps what map_attributes needs
+    ready for every record: the field name of every key seen so far (with the
+    key stripped), the mapped fields for the projection, and the parsed dates.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._compile()
+
+    def _compile(self):
+        # record key -> field name, UNMAPPED for keys without mapping
+        self._names = {}
+        self._dates = {}
+        self.strptime = self.get('__strptime')
+        self.fields = sorted(k.strip() for k in self if not k.startswith('__'))
+
+    def name(self, key, debug_state=None):
+        '''The field name of a record key, UNMAPPED if it has no mapping'''
+        name = self._names.get(key, None)
+        if name is None:
+            stripped = key.strip()
+            if stripped in self:
+                name = self[stripped]
+            else:
+                # report value without mapping, once
+                logging.debug("[{}] Field {} has no mapping".format(debug_state, key))
+                name = UNMAPPED
+            self._names[key] = name
+        return name
+
+    def timestamp(self, d):
+        '''Timestamp of a date, parsed with __strptime'''
+        ts = self._dates.get(d)
+        if ts is None:
+            ts = self._dates[d] = datetime.strptime(d, self.strptime).timestamp()
+        return ts
+
+    def map(self, original, debug_state=None):
+        '''Same as map_attributes'''
+        tagged_attributes = {}
+        names = self._names
+        for k, v in original.items():
+            name = names[k] if k in names else self.name(k, debug_state)
+            if name is not UNMAPPED:
+                tagged_attributes[name] = v
+        if '__strptime' in self \
+           and Fields.TIMESTAMP.name not in tagged_attributes \
+           and Fields.DATE.name in tagged_attributes:
+            d = tagged_attributes[Fields.DATE.name]
+            if d:
+                tagged_attributes[Fields.TIMESTAMP.name] = self.timestamp(d)
+        return tagged_attributes
+
+    # changing the mapping compiles it again
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._compile()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._compile()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._compile()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._compile()
+        return value
+
+    def setdefault(self, key, default=None):
+        value = super().setdefault(key, default)
+        self._compile()
+        return value
+
+
 def map_attributes(original, mapping, debug_state=None):
+    if isinstance(mapping, Mapping):
+        return mapping.map(original, debug_state)
+
     tagged_attributes = {}
     for k, v in original.items():
         if k.strip() in mapping:
@@ -194,18 +362,43 @@ def extract_arcgis_attributes(dict_result, mapping, debug_state=None):
     return extract_attributes(dict_result, path, mapping, debug_state)
 
 
-def extract_attributes(dict_result, path, mapping, debug_state=None):
-    res = _extract_attributes(dict_result, path, mapping, debug_state)
-    if isinstance(res, typing.List) and len(res) > 1:
-        return res
-    if isinstance(res, typing.List) and len(res) == 1:
-        return res[0]
-    return res
+def arcgis_frame(dict_result, mapping, debug_state=None):
+    '''Build a DataFrame of the mapped attributes of an arcgis result
 
+    Same columns as pd.DataFrame(extract_arcgis_attributes(dict_result, mapping)),
+    but built column by column from the features, without a mapped dict per
+    feature. The date field (esriFieldTypeDate in the result's fields) mapped to
+    TIMESTAMP is converted from epoch ms to datetime, other fields are left as is.
+    '''
+    features = dict_result.get('features', [])
+    attributes = [f['attributes'] for f in features]
+    # features can leave out null attributes: all the keys, in the order they're seen
+    keys = list(dict.fromkeys(k for a in attributes for k in a)) if attributes else \
+        [f['name'] for f in dict_result.get('fields', [])]
+    date_fields = {f['name'] for f in dict_result.get('fields', []) if f.get('type') == 'esriFieldTypeDate'}
+
+    columns = {}
+    for k in keys:
+        if k.strip() not in mapping:
+            logging.debug("[{}] Field {} has no mapping".format(debug_state, k))
+            continue
+        values = [a.get(k) for a in attributes]
+        if k in date_fields and mapping[k.strip()] == Fields.TIMESTAMP.name:
+            values = pd.to_datetime(values, unit='ms')
+        columns[mapping[k.strip()]] = values
+    df = pd.DataFrame(columns, columns=list(columns))
+
+    # same as map_attributes
+    if Fields.TIMESTAMP.name not in df and Fields.DATE.name in df and '__strptime' in mapping:
+        df[Fields.TIMESTAMP.name] = [
+            datetime.strptime(d, mapping['__strptime']).timestamp() if d else None
+            for d in df[Fields.DATE.name]]
+    return df
 
-def _extract_attributes(dict_result, path, mapping, debug_state=None):
+
+def extract_attributes(dict_result, path, mapping, debug_state=None):
     '''Uses mapping to extract attributes from dict_result
-    Retruns tagged attributes
+    Retruns tagged attributes: a list of them, or a single one
 
     dict_result: the object we get from maping a call to api/url
     path: the path in the result dict where all the mappings should apply
@@ -214,23 +407,89 @@ def _extract_attributes(dict_result, path, mapping, debug_state=None):
           This is like the cheap version of a `jq` expression
     mapping: the mapping from the given tags/terms to our common field names
     '''
+    return compile_data_path(path)(dict_result, mapping, debug_state)
+
+
+# Kinds of data_path steps
+_KEY, _INDEX, _EACH, _SKIP = range(4)
+# data_path (repr) -> PathExtractor
+_extractors = {}
+
+
+def compile_data_path(path):
+    '''The PathExtractor of a data_path, compiled once'''
+    key = repr(path)
+    extractor = _extractors.get(key)
+    if extractor is None:
+        extractor = _extractors[key] = PathExtractor(path)
+    return extractor
+
+
+class PathExtractor:
+    '''A data_path, compiled to extract the attributes of a result in a flat loop
+
+    A step is a dict key, a list index, or [] for every item of a list. A step
+    that doesn't apply to where the walk is (a missing key, or [] on a dict) is
+    skipped. The path after a [] is compiled too, and when it has no other [],
+    the items are walked and mapped in a single loop.
+    '''
+    def __init__(self, path):
+        self.path = list(path)
+        self._steps = []
+        for i, step in enumerate(self.path):
+            if isinstance(step, list):
+                kind = _SKIP if step else _EACH
+            elif isinstance(step, int):
+                kind = _INDEX
+            else:
+                kind = _KEY
+            # the path of each item, for []
+            rest = compile_data_path(self.path[i + 1:]) if kind == _EACH else None
+            self._steps.append((kind, step, rest))
+        self.each = any(kind == _EACH for kind, _, _ in self._steps)
+
+    def __call__(self, dict_result, mapping, debug_state=None):
+        '''Same as extract_attributes'''
+        res = self.records(dict_result, mapping, debug_state)
+        if isinstance(res, list) and len(res) == 1:
+            return res[0]
+        return res
 
-    res = dict_result
-    mapped = []
-    for i, step in enumerate(path):
-        # need to distinguish between list index and dict key:
-        if isinstance(res, typing.List) and step == []:
-            for item in res:
-                mapped.append(extract_attributes(item, path[i+1:], mapping, debug_state))
-            return mapped
-        if isinstance(res, typing.List) and isinstance(step, int):
-            res = res[step]
-        elif isinstance(res, typing.Dict) and not isinstance(step, list) and step in res:
-            res = res[step]
-
-    # now that res is the correct place in the result object, we can map the values
-    mapped = map_attributes(res, mapping, debug_state)
-    return mapped
+    def records(self, dict_result, mapping, debug_state=None):
+        '''The tagged attributes: a list of them for a [] that applies, a single one otherwise'''
+        res = dict_result
+        for kind, step, rest in self._steps:
+            if kind == _KEY:
+                if isinstance(res, dict) and step in res:
+                    res = res[step]
+            elif kind == _INDEX:
+                if isinstance(res, list):
+                    res = res[step]
+                elif isinstance(res, dict) and step in res:
+                    res = res[step]
+            elif kind == _EACH and isinstance(res, list):
+                if rest.each:
+                    return [rest(item, mapping, debug_state) for item in res]
+                walk = rest.walk
+                if isinstance(mapping, Mapping):
+                    return [mapping.map(walk(item), debug_state) for item in res]
+                return [map_attributes(walk(item), mapping, debug_state) for item in res]
+
+        # now that res is the correct place in the result object, we can map the values
+        return map_attributes(res, mapping, debug_state)
+
+    def walk(self, res):
+        '''Follow a path without [] steps'''
+        for kind, step, _ in self._steps:
+            if kind == _KEY:
+                if isinstance(res, dict) and step in res:
+                    res = res[step]
+            elif kind == _INDEX:
+                if isinstance(res, list):
+                    res = res[step]
+                elif isinstance(res, dict) and step in res:
+                    res = res[step]
+        return res
 
 
 def csv_sum(data, columns=None):
@@ -0,0 +1,109 @@
+''' Benchmark of the data_path extraction (see PathExtractor in fetcher/utils.py)
+
+Extracts the JSON responses of a recorded run (fetch.mode=record) of a dataset with the
+compiled extractors, and with the recursive version they replaced:
+    python tools/bench_extract.py output_archive dataset/states
+
+Without an archive, it extracts synthetic ArcGIS and nested JSON responses.
+'''
+
+import glob
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fetcher.sources import build_sources  # noqa: E402
+from fetcher.utils import build_url, compile_data_path, map_attributes  # noqa: E402
+
+
+REPEAT = 5
+ARCGIS_PATH = ['features', [], 'attributes']
+
+
+def recursive_extract_attributes(dict_result, path, mapping, debug_state=None):
+    '''extract_attributes, before data paths were compiled'''
+    res = _recursive_extract_attributes(dict_result, path, mapping, debug_state)
+    if isinstance(res, list) and len(res) > 1:
+        return res
+    if isinstance(res, list) and len(res) == 1:
+        return res[0]
+    return res
+
+
+def _recursive_extract_attributes(dict_result, path, mapping, debug_state=None):
+    res = dict_result
+    mapped = []
+    for i, step in enumerate(path):
+        if isinstance(res, list) and step == []:
+            for item in res:
+                mapped.append(recursive_extract_attributes(item, path[i+1:], mapping, debug_state))
+            return mapped
+        if isinstance(res, list) and isinstance(step, int):
+            res = res[step]
+        elif isinstance(res, dict) and not isinstance(step, list) and step in res:
+            res = res[step]
+    return map_attributes(res, mapping, debug_state)
+
+
+def recorded_cases(directory, dataset):
+    '''(result, path, mapping) of the recorded responses of the json queries of dataset'''
+    sources = build_sources(os.path.join(dataset, 'urls.yaml'), os.path.join(dataset, 'mappings.yaml'))
+    queries = {}
+    for source in sources.values():
+        for query in source.queries:
+            if query.type in ['arcgis', 'json', 'ckan', 'soda']:
+                path = ARCGIS_PATH if query.type == 'arcgis' else query.data_path
+                queries[build_url(query.url, query.params)] = (path, source.mapping)
+
+    cases = []
+    for meta_path in glob.glob(os.path.join(directory, '*.json')):
+        with open(meta_path) as f:
+            url = json.load(f).get('url')
+        if url not in queries:
+            continue
+        with open(meta_path[:-len('.json')] + '.body', 'rb') as f:
+            try:
+                result = json.loads(f.read())
+            except ValueError:
+                continue
+        cases.append((result,) + queries[url])
+    return cases
+
+
+def synthetic_cases():
+    sources = build_sources('dataset/backfill/urls.yaml', 'dataset/backfill/mappings.yaml')
+    mapping = sources['AK'].mapping
+    fields = list(mapping)[:6] + ['OBJECTID', 'Region', 'Shape__Area', 'Note']
+    arcgis = {'features': [{'attributes': {f: i for f in fields}} for i in range(20000)]}
+    nested = {'data': {'rows': [{'values': {f: i for f in fields}} for i in range(20000)]}}
+    return [(arcgis, ARCGIS_PATH, mapping), (nested, ['data', 'rows', [], 'values'], mapping)]
+
+
+def timed(extract, cases):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        for result, path, mapping in cases:
+            extract(result, path, mapping)
+    return (time.perf_counter() - start) / REPEAT * 1000
+
+
+def main(args):
+    cases = recorded_cases(*args) if args else synthetic_cases()
+    if not cases:
+        sys.exit("No recorded responses of {} in {}".format(args[1], args[0]))
+    print("{} responses".format(len(cases)))
+
+    def compiled(result, path, mapping):
+        return compile_data_path(path)(result, mapping)
+
+    for result, path, mapping in cases:
+        assert compiled(result, path, mapping) == recursive_extract_attributes(result, path, mapping)
+    print("recursive {:8.1f} ms".format(timed(recursive_extract_attributes, cases)))
+    print("compiled  {:8.1f} ms".format(timed(compiled, cases)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
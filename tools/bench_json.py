@@ -0,0 +1,75 @@
+''' Micro-benchmark of the JSON decoding backends (see fetcher/jsonlib.py)
+
+Decodes the ArcGIS responses of a recorded run (fetch.mode=record) with every installed
+backend:
+    python tools/bench_json.py output_archive
+
+Without an archive, it decodes synthetic ArcGIS responses (daily rows of a few layers).
+'''
+
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fetcher import jsonlib  # noqa: E402
+
+
+REPEAT = 5
+
+
+def recorded_bodies(directory):
+    '''The recorded arcgis response bodies in an archive directory'''
+    bodies = []
+    for meta_path in glob.glob(os.path.join(directory, '*.json')):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if '/query' not in meta.get('url', ''):
+            continue
+        with open(meta_path[:-len('.json')] + '.body', 'rb') as f:
+            bodies.append(f.read())
+    return bodies
+
+
+def synthetic_bodies():
+    rng = random.Random(0)
+    bodies = []
+    for rows in [1, 50, 500, 2000, 2000, 2000]:
+        features = [{'attributes': {
+            'OBJECTID': i, 'Date': 1584000000000 + i * 86400000, 'County': 'County {}'.format(i % 80),
+            'Positive': rng.randint(0, 10**6), 'Negative': rng.randint(0, 10**7), 'Deaths': rng.randint(0, 10**4),
+            'Rate': rng.random() * 100, 'Note': None}} for i in range(rows)]
+        res = {'objectIdFieldName': 'OBJECTID', 'geometryType': 'esriGeometryPoint',
+               'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}],
+               'exceededTransferLimit': rows == 2000, 'features': features}
+        bodies.append(json.dumps(res).encode('utf-8'))
+    return bodies
+
+
+def main(args):
+    bodies = recorded_bodies(args[0]) if args else synthetic_bodies()
+    if not bodies:
+        sys.exit("No recorded ArcGIS responses in {}".format(args[0]))
+    print("{} responses, {:.1f} MB".format(len(bodies), sum(map(len, bodies)) / 2**20))
+
+    expected = [json.loads(body) for body in bodies]
+    for name in jsonlib.BACKENDS:
+        try:
+            jsonlib.use(name)
+        except ImportError:
+            print("{:8} not installed".format(name))
+            continue
+        assert [jsonlib.loads(body) for body in bodies] == expected
+        start = time.perf_counter()
+        for _ in range(REPEAT):
+            for body in bodies:
+                jsonlib.loads(body)
+        print("{:8} {:8.1f} ms".format(name, (time.perf_counter() - start) / REPEAT * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
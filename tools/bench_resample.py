@@ -0,0 +1,66 @@
+''' Benchmark of the daily resample of build_dataframe (see daily_ffill in fetcher/lib.py)
+
+Resamples a synthetic backfill sized frame (56 states, 4 DATE_USED series each, over
+a year and a half of days with gaps) with daily_ffill, and with the per series
+resample it replaced:
+    python tools/bench_resample.py
+'''
+
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fetcher.lib import STATE, TS, _resample_ffill, daily_ffill  # noqa: E402
+
+
+STATES = 56
+DATES_USED = ['Specimen Collection', 'Test Result', 'Report', 'n/a']
+DAYS = 550
+COLUMNS = ['POSITIVE', 'DEATH', 'SPECIMENS', 'TOTAL', 'HOSP', 'ICU']
+
+
+def backfill_frame():
+    rng = np.random.default_rng(0)
+    frames = []
+    for state in range(STATES):
+        for date_used in DATES_USED:
+            days = pd.date_range('2020-03-01', periods=DAYS, freq='D')
+            # some days are missing, and some values
+            days = days[rng.random(DAYS) > 0.1]
+            values = rng.random((len(days), len(COLUMNS))).cumsum(axis=0)
+            values[rng.random(values.shape) < 0.2] = np.nan
+            df = pd.DataFrame(values, columns=COLUMNS)
+            df[STATE] = 'S{:02}'.format(state)
+            df['DATE_USED'] = date_used
+            df[TS] = days
+            frames.append(df)
+    df = pd.concat(frames).set_index([STATE, TS, 'DATE_USED'])
+    return df.groupby(level=df.index.names).last()
+
+
+def main():
+    df = backfill_frame()
+    part = [STATE, 'DATE_USED']
+    print("{} rows, {} series".format(len(df), STATES * len(DATES_USED)))
+
+    with warnings.catch_warnings():
+        # groupby.apply on the grouping columns
+        warnings.simplefilter('ignore', DeprecationWarning)
+        start = time.perf_counter()
+        expected = _resample_ffill(df, part)
+        print("resample per series {:8.1f} ms".format((time.perf_counter() - start) * 1000))
+
+    start = time.perf_counter()
+    res = daily_ffill(df, part)
+    print("daily_ffill          {:8.1f} ms".format((time.perf_counter() - start) * 1000))
+    pd.testing.assert_frame_equal(res, expected)
+
+
+if __name__ == '__main__':
+    main()